@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""Shows that fix_equations scales linearly with the length of
+a SHIFT+ENTER aligned equation now that depth queries go through
+DepthIndex instead of rescanning the row from the start.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_depth_index.py
+
+Each line reports the equation length and the time per character.
+If the time per character grows with the length, something went quadratic.
+"""
+
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deprecated'))
+
+from ms_word_eqn_filter import DepthIndex, fix_equations  # noqa: E402
+
+ROW = R'\left( x_{1} + \frac{a}{b} \right) + \overset{⃑}{v} \leq \sqrt{n^{2}} + \left| y \right| '
+SIZES = [1_000, 2_000, 4_000, 8_000]
+REPEATS = 3
+
+
+def long_aligned_equation(length: int, rows: int = 4) -> str:
+    """Return an MS Word style aligned equation that is roughly length characters long."""
+    per_row = max(1, length // (rows * len(ROW)))
+    return ''.join('{' + ROW * per_row + '}' for _ in range(rows))
+
+
+def best_of(func, arg) -> float:
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    per_char = []
+    for size in SIZES:
+        eqn = long_aligned_equation(size)
+        t_index = best_of(DepthIndex, eqn)
+        t_fix = best_of(fix_equations, eqn)
+        per_char.append(t_fix / len(eqn))
+        print(f'{len(eqn):>8} chars  DepthIndex {t_index * 1e3:8.3f} ms  '
+              f'fix_equations {t_fix * 1e3:8.3f} ms  ({per_char[-1] * 1e6:.3f} us/char)')
+    growth = per_char[-1] / per_char[0]
+    print(f'time per character grew {growth:.2f}x over a {SIZES[-1] // SIZES[0]}x longer equation')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""Runs fix_equations over a corpus of equations as pandoc emits them
+when it reads Microsoft Word equations, and compares the output against
+what was recorded in eqn_corpus.json.
+
+Equations with the Word XML (OMML) they were read from are also
+translated with omml_reader.py, which has to give the same output.
+
+Run from the root of the repository:
+
+    python benchmarks/check_corpus.py
+
+If you changed how equations are fixed ON PURPOSE, record the new outputs with
+
+    python benchmarks/check_corpus.py --record
+"""
+
+
+import json
+import os
+import sys
+from xml.etree import ElementTree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'deprecated'))
+
+from ms_word_eqn_filter import fix_equations  # noqa: E402
+from omml_reader import M, W, UnsupportedOMML, equation_latex  # noqa: E402
+
+CORPUS = os.path.join(HERE, 'eqn_corpus.json')
+
+
+def read_omml(omml: str) -> str:
+    """Translate an m:oMath or m:oMathPara with omml_reader."""
+    root = ElementTree.fromstring(f'<root xmlns:m="{M[1:-1]}" xmlns:w="{W[1:-1]}">{omml}</root>')
+    try:
+        return equation_latex(root[0])
+    except UnsupportedOMML as e:
+        return f'(not translated: {e})'
+
+
+def main() -> int:
+    with open(CORPUS, encoding='utf-8') as f:
+        corpus = json.load(f)
+    if '--record' in sys.argv[1:]:
+        for case in corpus:
+            case['expected'] = fix_equations(case['input'])
+        with open(CORPUS, 'w', encoding='utf-8') as f:
+            json.dump(corpus, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f'recorded {len(corpus)} equations')
+        return 0
+
+    failures = 0
+    for case in corpus:
+        actual = fix_equations(case['input'])
+        if actual != case['expected']:
+            failures += 1
+            print(f'MISMATCH {case["input"]!r}\n  expected {case["expected"]!r}\n  actual   {actual!r}')
+    print(f'{len(corpus) - failures}/{len(corpus)} equations match')
+
+    read_failures = 0
+    read = [case for case in corpus if 'omml' in case]
+    for case in read:
+        actual = read_omml(case['omml'])
+        if actual != case['expected']:
+            read_failures += 1
+            print(f'MISMATCH (omml_reader) {case["input"]!r}\n  expected {case["expected"]!r}\n  actual   {actual!r}')
+    print(f'{len(read) - read_failures}/{len(read)} equations read from OMML match')
+    return 1 if failures or read_failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
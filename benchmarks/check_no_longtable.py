@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""Checks that no_longtable.lua writes the same LaTeX whether or not a
+table is written out in chunks (NO_LONGTABLE_CHUNK_ROWS), and that no
+tabular has a blank line in it, which LaTeX would take as a paragraph break.
+
+Run from the root of the repository:
+
+    python benchmarks/check_no_longtable.py
+
+If pdflatex is installed, the chunked output is also compiled.
+"""
+
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FILTER = os.path.join(HERE, '..', 'no_longtable.lua')
+
+CELLS = ['0', '-', 'x', '$x^2$', '**bold**', 'a few words in a cell', '`code`', '']
+CHUNK_ROWS = [1, 2, 5, 7, 50]
+
+
+def make_document(seed: int) -> str:
+    """A document with a few tables of random cells, some with captions."""
+    rng = random.Random(seed)
+    parts = ['Text before the tables.']
+    for table in range(3):
+        columns = rng.randint(1, 4)
+        parts.append('| ' + ' | '.join(f'h{i}' for i in range(columns)) + ' |\n'
+                     + '|' + '|'.join(rng.choice([':--', '--:', '---']) for _ in range(columns)) + '|\n'
+                     + '\n'.join('| ' + ' | '.join(rng.choice(CELLS) for _ in range(columns)) + ' |'
+                                 for _ in range(rng.randint(1, 30))))
+        if rng.random() < 0.5:
+            parts.append(f': Table {table}')
+        parts.append('Text between the tables.')
+    return '\n\n'.join(parts) + '\n'
+
+
+def write_latex(markdown: str, chunk_rows: int, standalone: bool = False) -> str:
+    env = dict(os.environ, NO_LONGTABLE_CHUNK_ROWS=str(chunk_rows))
+    return subprocess.run(['pandoc', '-f', 'markdown', '-t', 'latex', '--lua-filter', FILTER,
+                           *(['-s'] if standalone else [])],
+                          input=markdown, env=env, capture_output=True, text=True, check=True).stdout
+
+
+def blank_line_in_tabular(latex: str) -> bool:
+    start = 0
+    while (start := latex.find('\\begin{tabular}', start)) != -1:
+        stop = latex.find('\\end{tabular}', start)
+        if '\n\n' in latex[start:stop]:
+            return True
+        start = stop
+    return False
+
+
+def compiles(latex: str) -> bool:
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'tables.tex'), 'w', encoding='utf-8') as f:
+            f.write(latex)
+        result = subprocess.run(['pdflatex', '-interaction=nonstopmode', '-halt-on-error', 'tables.tex'],
+                                cwd=folder, capture_output=True)
+        return result.returncode == 0
+
+
+def main() -> int:
+    failures = 0
+    documents = [make_document(seed) for seed in range(10)]
+    for seed, markdown in enumerate(documents):
+        whole = write_latex(markdown, 0)
+        if blank_line_in_tabular(whole):
+            failures += 1
+            print(f'BLANK LINE in a tabular (document {seed}, not chunked)')
+        for chunk_rows in CHUNK_ROWS:
+            if write_latex(markdown, chunk_rows) != whole:
+                failures += 1
+                print(f'MISMATCH document {seed}, NO_LONGTABLE_CHUNK_ROWS={chunk_rows}')
+    print(f'{len(documents) * len(CHUNK_ROWS) - failures}/{len(documents) * len(CHUNK_ROWS)} '
+          f'chunked outputs match')
+
+    if shutil.which('pdflatex') is None:
+        print('pdflatex not found, not compiling')
+    elif not compiles(write_latex(documents[0], CHUNK_ROWS[1], standalone=True)):
+        failures += 1
+        print('FAILED to compile the chunked output')
+    else:
+        print('chunked output compiles')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""Makes pandoc JSON ASTs that look like what pandoc reads out of
+Microsoft Word documents, at any size, for the benchmarks.
+
+Run from the root of the repository to write a whole document to a file
+that pandoc (or the filters) can read:
+
+    python benchmarks/corpus.py --scale 8 > big.json
+    pandoc big.json -f json -o big.pdf --filter=deprecated/combined_filter.py
+
+The same seed always makes the same document.
+"""
+
+
+import argparse
+import json
+import os
+import random
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API_VERSION = [1, 23, 1, 1]
+
+# Equations as pandoc reads them out of Word, taken from the regression corpus
+with open(os.path.join(HERE, 'eqn_corpus.json'), encoding='utf-8') as _corpus:
+    WORD_EQUATIONS = [case['input'] for case in json.load(_corpus)]
+INLINE_EQUATIONS = [eqn for eqn in WORD_EQUATIONS if not eqn.startswith('{')]
+
+ALIGNED_ROWS = [
+    R'\left( x_{1} + \frac{a}{b} \right) = \overset{⃑}{v} + \sqrt{n^{2}}',
+    R'\leq \left| y \right| + \underset{n\text{ times}}{\overset{1 + \cdots + 1}{︸}}',
+    R"\Rightarrow f^{'}(x) = 2x + \overrightarrow{AB}",
+    R'\approx \sum_{i = 1}^{n}i \neq \frac{n(n + 1)}{2}',
+]
+CODE_LINES = [
+    'def f(x):',
+    '\tif x > 0:',
+    '\t\treturn “positive” + ‘!’',
+    '    return x – 1  # ÔÇ£mojibakeÔÇØ',
+    '',
+]
+ENVIRONMENTS = [('note', 'note'), ('tip', 'tip'), ('warning', 'warning'), ('proof', 'QED'),
+                ('definition', 'definition'), ('box', 'box')]
+
+
+def words(text: str) -> list[dict]:
+    """Return text as pandoc inlines: Str separated by Space."""
+    inlines = []
+    for word in text.split(' '):
+        if inlines:
+            inlines.append({'t': 'Space'})
+        inlines.append({'t': 'Str', 'c': word})
+    return inlines
+
+
+def para(*inlines: dict) -> dict:
+    return {'t': 'Para', 'c': list(inlines)}
+
+
+def math(eqn: str, display: bool = False) -> dict:
+    return {'t': 'Math', 'c': [{'t': 'DisplayMath' if display else 'InlineMath'}, eqn]}
+
+
+def document(blocks: list[dict]) -> dict:
+    return {'pandoc-api-version': API_VERSION, 'meta': {}, 'blocks': blocks}
+
+
+def inline_math_blocks(count: int, rng: random.Random) -> list[dict]:
+    """Paragraphs with count inline equations, a few to a paragraph."""
+    blocks = []
+    while count > 0:
+        inlines = words('By the lemma,')
+        for _ in range(min(count, rng.randint(1, 6))):
+            inlines += [{'t': 'Space'}, math(rng.choice(INLINE_EQUATIONS)), {'t': 'Space'}] + words('and so')
+            count -= 1
+        blocks.append(para(*inlines))
+    return blocks
+
+
+def nested_accent_equation(depth: int) -> str:
+    """An equation with depth accents and underbraces inside one another."""
+    eqn = 'x'
+    for i in range(depth):
+        kind = i % 3
+        if kind == 0:
+            eqn = R'\overset{⃑}{' + eqn + '}'
+        elif kind == 1:
+            eqn = R'\underset{\text{part ' + str(i) + R'}}{\overset{' + eqn + ' + y}{︸}}'
+        else:
+            eqn = R'\overrightarrow{' + eqn + '}'
+    return eqn
+
+
+def aligned_equation(rows: int) -> str:
+    """A SHIFT+ENTER aligned equation with rows rows."""
+    return ''.join('{' + ALIGNED_ROWS[i % len(ALIGNED_ROWS)] + '}' for i in range(rows))
+
+
+def code_listing(lines: int, language: str = 'Python') -> str:
+    """The text of a Word code block with a language line on top."""
+    return language + '\n' + '\n'.join(CODE_LINES[i % len(CODE_LINES)] for i in range(lines))
+
+
+def code_block(lines: int) -> dict:
+    return {'t': 'CodeBlock', 'c': [['', [], []], code_listing(lines)]}
+
+
+def environment_blocks(count: int, rng: random.Random) -> list[dict]:
+    """count ::: / /// environments, some of them inside another."""
+    blocks = []
+    for i in range(count):
+        kind, end = rng.choice(ENVIRONMENTS)
+        blocks.append(para(*words(f'::: {kind} Title {i}')))
+        blocks.append(para(*words('Some text inside the environment.')))
+        if i % 4 == 3:
+            blocks.append(para(*words('::: box Inner')))
+            blocks.append(para(*words('Nested.')))
+            blocks.append(para(*words('/// box')))
+        blocks.append(para(*words(f'/// {end}')))
+        blocks.append(para(*words('Text between environments.')))
+    return blocks
+
+
+def make_document(scale: int = 1, seed: int = 0) -> dict:
+    """A document with a bit of everything, growing linearly with scale."""
+    rng = random.Random(seed)
+    blocks = []
+    for _ in range(scale):
+        blocks += inline_math_blocks(200, rng)
+        blocks.append(para(math(nested_accent_equation(12), display=True)))
+        blocks.append(para(math(aligned_equation(20), display=True)))
+        blocks.append(code_block(200))
+        blocks += environment_blocks(25, rng)
+    return document(blocks)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Write a synthetic Word-like pandoc JSON AST to stdout.')
+    parser.add_argument('--scale', type=int, default=1, help='how many times over to repeat the content')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    json.dump(make_document(args.scale, args.seed), sys.stdout, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
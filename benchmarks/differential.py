@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""Runs the equation fixers side by side over the same equations, and
+shows where their outputs differ and how fast each one is.
+
+The fixers are the Python filter (deprecated/ms_word_eqn_filter.py),
+word_eqn.lua run by pandoc, and any other function that takes an
+equation and returns it fixed. The others are compared to the Python
+filter, or to the fixer named by --reference.
+
+Run from the root of the repository:
+
+    python benchmarks/differential.py
+    python benchmarks/differential.py --fuzz 5000 --show 10
+    python benchmarks/differential.py --engine fast=my_engine:fix_equations --check
+    python benchmarks/differential.py --input thesis.json    # pandoc thesis.docx -t json -o thesis.json
+
+The equations are the regression corpus (eqn_corpus.json), the synthetic
+ones from corpus.py, any equations in --input documents, and --fuzz cut
+and unbalanced copies of them. Each distinct equation is run once.
+
+Trailing whitespace is ignored unless --exact is given, since the filters
+pad equations differently and LaTeX doesn't care. --check fails if any
+fixer doesn't match the reference, so a faster fixer is only swapped in
+if it gives the same output.
+"""
+
+
+import argparse
+import importlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, os.path.join(ROOT, 'deprecated'))
+sys.path.insert(0, os.getcwd())
+
+import corpus  # noqa: E402
+from ms_word_eqn_filter import fix_equation_guarded  # noqa: E402
+
+LUA_FILTER = os.path.join(ROOT, 'word_eqn.lua')
+
+# Takes every equation and returns them fixed, in order, and how many
+# seconds the fixing itself took.
+Engine = Callable[[list[str]], tuple[list[str], float]]
+
+
+def python_engine(eqns: list[str]) -> tuple[list[str], float]:
+    start = time.perf_counter()
+    fixed = [fix_equation_guarded(eqn)[0] for eqn in eqns]
+    return fixed, time.perf_counter() - start
+
+
+def make_lua_engine(pandoc: str) -> Engine:
+    """Run word_eqn.lua with pandoc over a document holding every equation.
+    The time pandoc takes over the same document without the filter is
+    taken away, so only the filter is timed.
+    """
+    def lua_engine(eqns: list[str]) -> tuple[list[str], float]:
+        doc = corpus.document([corpus.para(corpus.math(eqn)) for eqn in eqns])
+        with tempfile.NamedTemporaryFile('w', suffix='.json', encoding='utf-8', delete=False) as f:
+            json.dump(doc, f, ensure_ascii=False)
+        try:
+            # Every equation is distinct, so the filter's cache only gets in the way
+            env = dict(os.environ, MS_WORD_EQN_CACHE_SIZE='0')
+            command = [pandoc, f.name, '-f', 'json', '-t', 'json']
+            start = time.perf_counter()
+            subprocess.run(command, env=env, check=True, capture_output=True)
+            overhead = time.perf_counter() - start
+            start = time.perf_counter()
+            result = subprocess.run(command + ['--lua-filter', LUA_FILTER], env=env, check=True,
+                                    capture_output=True)
+            seconds = time.perf_counter() - start
+        finally:
+            os.unlink(f.name)
+        blocks = json.loads(result.stdout)['blocks']
+        return [block['c'][0]['c'][1] for block in blocks], max(seconds - overhead, 0.0)
+
+    return lua_engine
+
+
+def load_engine(spec: str) -> tuple[str, Engine]:
+    """name=module:function, where function fixes one equation."""
+    name, _, target = spec.partition('=')
+    module_name, _, function_name = target.partition(':')
+    fix = getattr(importlib.import_module(module_name), function_name)
+
+    def engine(eqns: list[str]) -> tuple[list[str], float]:
+        start = time.perf_counter()
+        fixed = [fix(eqn) for eqn in eqns]
+        return fixed, time.perf_counter() - start
+
+    return name, engine
+
+
+def document_equations(path: str) -> list[str]:
+    """Every equation in a pandoc JSON document."""
+    with open(path, encoding='utf-8') as f:
+        doc = json.load(f)
+    eqns = []
+
+    def walk(node: object) -> None:
+        if isinstance(node, dict):
+            if node.get('t') == 'Math':
+                eqns.append(node['c'][1])
+            else:
+                walk(node.get('c'))
+        elif isinstance(node, list):
+            for child in node:
+                walk(child)
+
+    walk(doc['blocks'])
+    return eqns
+
+
+def fuzzed(eqns: list[str], count: int, rng: random.Random) -> list[str]:
+    """count equations made by cutting one of eqns somewhere, or
+    putting a stray brace in it, like a broken equation from Word."""
+    made = []
+    for _ in range(count):
+        eqn = rng.choice(eqns)
+        cut = rng.randint(0, len(eqn))
+        made.append(rng.choice((eqn[:cut], eqn[cut:], eqn[:cut] + '}' + eqn[cut:], eqn[:cut] + '{' + eqn[cut:])))
+    return made
+
+
+def gather(inputs: list[str], fuzz: int, seed: int) -> list[str]:
+    with open(os.path.join(HERE, 'eqn_corpus.json'), encoding='utf-8') as f:
+        eqns = [case['input'] for case in json.load(f)]
+    eqns += [corpus.nested_accent_equation(depth) for depth in range(1, 40)]
+    eqns += [corpus.aligned_equation(rows) for rows in range(2, 40)]
+    for path in inputs:
+        eqns += document_equations(path)
+    eqns += fuzzed(eqns, fuzz, random.Random(seed))
+    return list(dict.fromkeys(eqns))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Compare the equation fixers and time them.')
+    parser.add_argument('--engine', action='append', default=[], metavar='NAME=MODULE:FUNCTION',
+                        help='also run this function, which fixes one equation')
+    parser.add_argument('--reference', default='python', help='the fixer the others are compared to')
+    parser.add_argument('--no-lua', action='store_true', help="don't run word_eqn.lua")
+    parser.add_argument('--pandoc', default='pandoc')
+    parser.add_argument('--input', action='append', default=[], help='a pandoc JSON document to take equations from')
+    parser.add_argument('--fuzz', type=int, default=2000, help='how many broken equations to add')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--exact', action='store_true', help="don't ignore trailing whitespace")
+    parser.add_argument('--show', type=int, default=3, help='how many differences to print for each fixer')
+    parser.add_argument('--diffs', help='write every difference to this JSON file')
+    parser.add_argument('--check', action='store_true', help='fail if any fixer differs from the reference')
+    args = parser.parse_args()
+
+    engines: dict[str, Engine] = {'python': python_engine}
+    if not args.no_lua:
+        if shutil.which(args.pandoc) is None:
+            print(f"{args.pandoc} isn't installed, so word_eqn.lua isn't run")
+        else:
+            engines['lua'] = make_lua_engine(args.pandoc)
+    engines.update(load_engine(spec) for spec in args.engine)
+    if args.reference not in engines:
+        parser.error(f'no fixer called {args.reference}')
+
+    eqns = gather(args.input, args.fuzz, args.seed)
+    chars = sum(map(len, eqns))
+    print(f'{len(eqns)} distinct equations, {chars} characters')
+
+    outputs: dict[str, list[str]] = {}
+    print(f'  {"fixer":<12} {"seconds":>9} {"equations/s":>12} {"MB/s":>7}')
+    for name, engine in engines.items():
+        outputs[name], seconds = engine(eqns)
+        rate = len(eqns) / seconds if seconds else float('inf')
+        print(f'  {name:<12} {seconds:9.3f} {rate:12.0f} {chars / 1e6 / seconds if seconds else float("inf"):7.2f}')
+
+    def normal(text: str) -> str:
+        return text if args.exact else text.rstrip()
+
+    reference = outputs[args.reference]
+    all_diffs: dict[str, list[dict]] = {}
+    for name, fixed in outputs.items():
+        if name == args.reference:
+            continue
+        diffs = [{'input': eqn, args.reference: expected, name: actual}
+                 for eqn, expected, actual in zip(eqns, reference, fixed) if normal(expected) != normal(actual)]
+        all_diffs[name] = diffs
+        print(f'{name}: {len(eqns) - len(diffs)}/{len(eqns)} match {args.reference}')
+        for diff in diffs[:args.show]:
+            print(f'  input {diff["input"]!r}\n    {args.reference:<8} {diff[args.reference]!r}\n'
+                  f'    {name:<8} {diff[name]!r}')
+
+    if args.diffs:
+        with open(args.diffs, 'w', encoding='utf-8') as f:
+            json.dump(all_diffs, f, ensure_ascii=False, indent=2)
+    if args.check and any(all_diffs.values()):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Makes deprecated/omml_symbols.json, the table omml_reader.py looks
+characters up in, by asking pandoc how it writes each one.
+
+Every character is put in a Word equation between two letters, as in
+a+b, and read back with pandoc. Characters pandoc writes as they are
+aren't kept; the others are kept with what pandoc writes instead, and
+whether it puts spaces around them (relations and binary operators).
+
+Run from the root of the repository, with pandoc installed:
+
+    python benchmarks/make_omml_symbols.py
+"""
+
+
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OUTPUT = os.path.join(HERE, '..', 'deprecated', 'omml_symbols.json')
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+M = 'http://schemas.openxmlformats.org/officeDocument/2006/math'
+
+# Spaces, punctuation and symbols, Latin-1, Greek, and the Unicode blocks
+# of mathematical symbols and arrows
+RANGES = [(0x20, 0x7e), (0xa0, 0xff), (0x391, 0x3f6), (0x2000, 0x2064), (0x2100, 0x23ff),
+          (0x25a0, 0x25ff), (0x27c0, 0x27ff), (0x2900, 0x2aff)]
+
+
+def candidates() -> list[str]:
+    chars = []
+    for first, last in RANGES:
+        for code in range(first, last + 1):
+            char = chr(code)
+            if not char.isascii() or not char.isalnum():
+                chars.append(char)
+    return chars
+
+
+def escape(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def make_docx(path: str, runs: list[str], pandoc: str) -> None:
+    reference = subprocess.run([pandoc, '--print-default-data-file', 'reference.docx'],
+                               check=True, capture_output=True).stdout
+    paragraphs = ''.join(f'<w:p><m:oMath><m:r><m:t xml:space="preserve">{escape(run)}</m:t></m:r></m:oMath></w:p>'
+                         for run in runs)
+    document = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                f'<w:document xmlns:w="{W}" xmlns:m="{M}"><w:body>{paragraphs}</w:body></w:document>')
+    with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as f:
+        f.write(reference)
+    try:
+        with zipfile.ZipFile(f.name) as source, zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as target:
+            for item in source.infolist():
+                data = document.encode('utf-8') if item.filename == 'word/document.xml' else source.read(item)
+                target.writestr(item, data)
+    finally:
+        os.unlink(f.name)
+
+
+def read_equations(path: str, pandoc: str) -> list[str]:
+    doc = json.loads(subprocess.run([pandoc, path, '-t', 'json'], check=True, capture_output=True).stdout)
+    return [para['c'][0]['c'][1] for para in doc['blocks']]
+
+
+def main() -> int:
+    pandoc = sys.argv[1] if len(sys.argv) > 1 else 'pandoc'
+    chars = candidates()
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'symbols.docx')
+        make_docx(path, [f'a{char}b' for char in chars] + chars, pandoc)
+        written = read_equations(path, pandoc)
+    between, alone = written[:len(chars)], written[len(chars):]
+
+    symbols = {}
+    for char, tex, tex_alone in zip(chars, between, alone):
+        spaced = re.fullmatch(r'a (.+) b', tex)
+        if spaced:
+            symbols[char] = {'tex': spaced[1], 'spaced': True}
+        elif tex != f'a{char}b':
+            if tex.startswith('a') and tex.endswith('b'):
+                tex = tex[1:-1]
+                if tex.startswith('\\') and tex.endswith(' ') and tex != '\\ ':
+                    tex = tex[:-1]  # the space pandoc puts between a command and a letter
+            else:
+                tex = tex_alone
+            if tex != char:
+                symbols[char] = {'tex': tex, 'spaced': False}
+
+    with open(OUTPUT, 'w', encoding='utf-8') as f:
+        lines = [f'{json.dumps(char, ensure_ascii=False)}: {json.dumps(symbol, ensure_ascii=False)}'
+                 for char, symbol in sorted(symbols.items())]
+        f.write('{\n' + ',\n'.join(lines) + '\n}\n')
+    print(f'{len(symbols)} symbols written to {os.path.relpath(OUTPUT)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""Times the filters' hot functions on synthetic documents
+(see corpus.py) of growing size, and compares them to a baseline.
+
+Run from the root of the repository:
+
+    python benchmarks/suite.py            # print the timings
+    python benchmarks/suite.py --record   # store them in baseline.json
+    python benchmarks/suite.py --check    # flag regressions against baseline.json
+
+For each case, the timings at every size are fitted to time ~ size^slope.
+Linear work has a slope of about 1. --check fails if a case got slower
+than the baseline at its largest size by more than --tolerance, or if its
+slope grew by more than --slope-tolerance (from 1 if it was lower),
+which catches a function going quadratic even on a machine that is faster or slower overall.
+"""
+
+
+import argparse
+import copy
+import gc
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from typing import Any, Callable
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'deprecated'))
+
+import panflute as pf  # noqa: E402
+
+import corpus  # noqa: E402
+from code_block import set_code_block_language  # noqa: E402
+from ms_word_eqn_filter import bracket_layers, find_nth, fix_equations  # noqa: E402
+from start_wrapper import ASTProcessor, EnvironmentRegistry, make_processors  # noqa: E402
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+
+class Case:
+    """A function to time, and how to make its input at a given size.
+
+    make(size) is called outside the timer, once per run, since some
+    functions change their input. run(made) is what gets timed.
+    """
+    name: str
+    sizes: list[int]
+    make: Callable[[int], Any]
+    run: Callable[[Any], Any]
+
+    def __init__(self, name: str, sizes: list[int], make: Callable[[int], Any], run: Callable[[Any], Any]) -> None:
+        self.name = name
+        self.sizes = sizes
+        self.make = make
+        self.run = run
+
+    def time(self, size: int, repeats: int) -> float:
+        best = float('inf')
+        for _ in range(repeats):
+            made = self.make(size)
+            # Like timeit, keep the garbage collector from landing in one run but not another
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                self.run(made)
+                best = min(best, time.perf_counter() - start)
+            finally:
+                gc.enable()
+        return best
+
+
+def inline_equations(count: int) -> list[str]:
+    blocks = corpus.inline_math_blocks(count, random.Random(count))
+    return [inline['c'][1] for block in blocks for inline in block['c'] if inline['t'] == 'Math']
+
+
+def environments_ast(count: int) -> dict:
+    return corpus.document(corpus.environment_blocks(count, random.Random(count)))
+
+
+def run_note_processor(ast: dict) -> None:
+    ASTProcessor(ast, 'note', 'note', 'note', ':::', '///').process_ast_first_time()
+
+
+def run_registry(ast: dict) -> None:
+    EnvironmentRegistry(ast, make_processors(ast)).process()
+
+
+def fix_all(equations: list[str]) -> None:
+    for eqn in equations:
+        fix_equations(eqn)
+
+
+CASES = [
+    Case('fix_equations/inline', [500, 1000, 2000, 4000], inline_equations, fix_all),
+    Case('fix_equations/nested', [64, 128, 256, 512], corpus.nested_accent_equation, fix_equations),
+    Case('fix_equations/aligned', [25, 50, 100, 200], corpus.aligned_equation, fix_equations),
+    Case('bracket_layers', [2_000, 4_000, 8_000, 16_000],
+         lambda size: corpus.aligned_equation(size // 64),
+         lambda text: bracket_layers(text, len(text) - 1)),
+    Case('find_nth', [10_000, 20_000, 40_000, 80_000],
+         lambda size: ('a & b ' * size, size),
+         lambda made: find_nth(made[0], '&', made[1])),
+    Case('ASTProcessor.process_ast_first_time', [250, 500, 1000, 2000], environments_ast, run_note_processor),
+    Case('EnvironmentRegistry.process', [250, 500, 1000, 2000], environments_ast, run_registry),
+    Case('set_code_block_language', [5_000, 10_000, 20_000, 40_000],
+         lambda size: pf.CodeBlock(corpus.code_listing(size)),
+         lambda code: set_code_block_language(code, None)),
+]
+
+
+def slope(sizes: list[int], seconds: list[float]) -> float:
+    """The least squares slope of log(seconds) against log(size)."""
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in seconds]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+            / sum((x - mean_x) ** 2 for x in xs))
+
+
+def run_cases(cases: list[Case], repeats: int) -> dict:
+    results = {}
+    for case in cases:
+        seconds = []
+        for size in case.sizes:
+            seconds.append(case.time(size, repeats))
+            print(f'{case.name:40} {size:>8}  {seconds[-1] * 1e3:10.3f} ms')
+        results[case.name] = {'sizes': case.sizes, 'seconds': seconds, 'slope': slope(case.sizes, seconds)}
+        print(f'{case.name:40} slope {results[case.name]["slope"]:.2f}')
+    return results
+
+
+def check(results: dict, baseline: dict, tolerance: float, slope_tolerance: float) -> dict[str, list[str]]:
+    """Return what regressed in each case that regressed."""
+    problems = {}
+    for name, result in results.items():
+        old = baseline['cases'].get(name)
+        if old is None or old['sizes'] != result['sizes']:
+            print(f'{name}: not in the baseline, record it again to compare')
+            continue
+        ratio = result['seconds'][-1] / old['seconds'][-1]
+        if ratio > 1 + tolerance:
+            problems.setdefault(name, []).append(f'{ratio:.2f}x slower than the baseline at size {result["sizes"][-1]}')
+        # Slopes under 1 are mostly fixed costs, so growth is measured from linear at least
+        if result['slope'] > max(old['slope'], 1.0) + slope_tolerance:
+            problems.setdefault(name, []).append(f'scales as size^{result["slope"]:.2f}, was size^{old["slope"]:.2f}')
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the filters on synthetic documents.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', action='store_true', help='store the timings as the baseline')
+    mode.add_argument('--check', action='store_true', help='fail if a case regressed against the baseline')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--repeats', type=int, default=5, help='best of how many runs')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='allowed slowdown, 1.0 meaning twice as slow')
+    parser.add_argument('--slope-tolerance', type=float, default=0.3, help='allowed growth of the slope')
+    parser.add_argument('--only', help='only run cases whose name contains this')
+    args = parser.parse_args()
+
+    cases = [case for case in CASES if args.only is None or args.only in case.name]
+    results = run_cases(cases, args.repeats)
+
+    if args.record:
+        baseline = {'cases': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        baseline['python'] = platform.python_version()
+        baseline['machine'] = platform.machine()
+        baseline['cases'].update(copy.deepcopy(results))
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+            f.write('\n')
+        print(f'recorded {len(results)} cases in {args.baseline}')
+    elif args.check:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        problems = check(results, baseline, args.tolerance, args.slope_tolerance)
+        if problems:
+            # Timings are noisy, so make sure with more runs before calling it a regression
+            print(f'timing {", ".join(problems)} again to make sure')
+            again = run_cases([case for case in cases if case.name in problems], args.repeats * 3)
+            problems = check(again, baseline, args.tolerance, args.slope_tolerance)
+        for name, messages in problems.items():
+            for message in messages:
+                print(f'REGRESSION {name}: {message}')
+        print(f'{len(results) - len(problems)}/{len(results)} cases within tolerance')
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""Converts many Word documents at once, running every Python filter
+(see combined_filter.py) on each of them.
+
+    python batch_convert.py lectures/ -o build/ --ext pdf -- -s --pdf-engine=xelatex
+
+The inputs can be .docx files, folders (searched for .docx files) or
+manifests: text files that list one .docx file per line.
+Anything after -- is passed to pandoc when it writes the output.
+
+Conversions are spread over one worker process per CPU. Each worker
+imports the filters once and keeps them, so the only thing started
+per document is pandoc itself:
+
+    pandoc input.docx -t json  -->  filters, in the worker  -->  pandoc -f json -o output
+
+Since pandoc runs twice, images are extracted next to each output,
+in a folder named after it. Documents whose output is newer than the
+document itself are skipped, unless --force is given.
+
+The output format is picked from --ext the way pandoc picks it, or
+given with --to. With --docx-equations, each document's equations are
+read straight from its own .docx (see omml_reader.py).
+"""
+
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+
+import panflute as pf
+
+import combined_filter
+from json_backend import get_json_backend
+from ms_word_eqn_filter import DOCX_ENV, DOCX_META, WORKERS_ENV
+
+# The format pandoc writes for each output extension, as pandoc itself
+# guesses it. The filters see this format, as they would under pandoc.
+EXTENSION_FORMATS = {
+    'pdf': 'latex', 'tex': 'latex', 'latex': 'latex', 'ltx': 'latex',
+    'md': 'markdown', 'markdown': 'markdown', 'txt': 'plain',
+    'html': 'html', 'htm': 'html', 'xhtml': 'html',
+    'docx': 'docx', 'odt': 'odt', 'rtf': 'rtf', 'epub': 'epub',
+    'rst': 'rst', 'org': 'org', 'adoc': 'asciidoc', 'typ': 'typst',
+    'ipynb': 'ipynb', 'json': 'json', 'pptx': 'pptx',
+}
+
+
+def find_inputs(paths: list[str]) -> list[str]:
+    """Return every .docx file in paths, in order, without repeats."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.lower().endswith('.docx') and not name.startswith('~$'))
+        elif path.lower().endswith('.docx'):
+            found.append(path)
+        else:
+            base = os.path.dirname(path)
+            with open(path, encoding='utf-8') as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        found.append(os.path.join(base, line))
+    return list(dict.fromkeys(found))
+
+
+def output_path(source: str, out_dir: Optional[str], ext: str) -> str:
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(out_dir if out_dir is not None else os.path.dirname(source), stem + '.' + ext)
+
+
+def is_up_to_date(source: str, target: str) -> bool:
+    return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+
+def output_format(ext: str, to: Optional[str]) -> str:
+    """The format the output is written in: to if it's given, like pandoc's
+    --to, or else the one for ext. Extensions pandoc doesn't know are an error."""
+    if to is not None:
+        return to
+    try:
+        return EXTENSION_FORMATS[ext.lower()]
+    except KeyError:
+        raise ValueError(f'No format known for .{ext} outputs; pass --to') from None
+
+
+def convert(source: str, target: str, to: str, pandoc: str, pandoc_args: list[str],
+            docx_equations: bool = False) -> float:
+    """Convert source to target in the format to, running the filters
+    in this process. Return how many seconds it took.
+    """
+    start = time.perf_counter()
+    media_dir = os.path.splitext(target)[0] + '_media'
+    read = subprocess.run([pandoc, source, '-t', 'json', '--extract-media=' + media_dir],
+                          check=True, capture_output=True)
+    doc = pf.load(io.StringIO(read.stdout.decode('utf-8')))
+    doc.format = to
+    if docx_equations:
+        doc.metadata[DOCX_META] = pf.MetaString(os.path.abspath(source))
+    doc = combined_filter.main(doc)
+    subprocess.run([pandoc, '-f', 'json', '-t', to, '-o', target, *pandoc_args],
+                   input=get_json_backend().dumps(doc.to_json()), check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    pandoc_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, pandoc_args = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(description='Convert many Word documents with the Python filters.')
+    parser.add_argument('inputs', nargs='+', help='.docx files, folders of them, or manifests listing them')
+    parser.add_argument('-o', '--out-dir', help='where outputs go (default: next to each document)')
+    parser.add_argument('--ext', default='pdf', help='extension of the outputs, which picks the format')
+    parser.add_argument('-t', '--to', help='format of the outputs, as in pandoc (default: from --ext)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--pandoc', default='pandoc', help='the pandoc executable')
+    parser.add_argument('--force', action='store_true', help='convert documents even if they are up to date')
+    parser.add_argument('--docx-equations', action='store_true',
+                        help="read each document's equations straight from its .docx")
+    args = parser.parse_args(argv)
+    try:
+        to = output_format(args.ext, args.to)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Documents are already converted one per CPU, so each one fixes its equations on one
+    os.environ.setdefault(WORKERS_ENV, '1')
+    # MS_WORD_DOCX names a single .docx, so here it means each document's own
+    if os.environ.pop(DOCX_ENV, None):
+        args.docx_equations = True
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+    jobs = []
+    skipped = 0
+    for source in find_inputs(args.inputs):
+        target = output_path(source, args.out_dir, args.ext)
+        if not args.force and is_up_to_date(source, target):
+            skipped += 1
+            print(f'up to date  {source}')
+        else:
+            jobs.append((source, target))
+
+    failed = 0
+    total = 0.0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(jobs) or 1))) as pool:
+        futures = {pool.submit(convert, source, target, to, args.pandoc, pandoc_args, args.docx_equations): (source, target)
+                   for source, target in jobs}
+        for future in as_completed(futures):
+            source, target = futures[future]
+            try:
+                seconds = future.result()
+            except subprocess.CalledProcessError as e:
+                failed += 1
+                print(f'FAILED      {source}\n{e.stderr.decode("utf-8", "replace")}', file=sys.stderr)
+            except Exception as e:
+                failed += 1
+                print(f'FAILED      {source}: {e!r}', file=sys.stderr)
+            else:
+                total += seconds
+                print(f'{seconds:8.2f}s   {source} -> {target}')
+
+    print(f'{len(jobs) - failed} converted, {skipped} up to date, {failed} failed; '
+          f'{total:.2f}s of work in {time.perf_counter() - start:.2f}s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
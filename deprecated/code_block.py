@@ -14,10 +14,17 @@ strip it, lowercase it, and set it as the language of the code block.
 Also ensures that smart quotes are converted to regular
 quotes for both inline code and source code. Note that you cannot
 define languages for inline code blocks.
+
+If MS_WORD_CACHE_DIR is set, code blocks are looked up in the
+fragment cache (see fragment_cache.py) before they are redone.
 """
 
 
-import panflute as pf
+import json
+from typing import Optional
+
+from fragment_cache import finish_fragment_cache, get_fragment_cache, source_version
+from raw_filter import run_raw_filters
 
 CODE_LANG = {'80',
              'abap',
@@ -110,32 +117,115 @@ ALIASES = {
 }
 
 
+def replace_all(text: str, replacements: dict[str, str]) -> str:
+    """Replace every key of replacements in text by its value, in order.
+
+    str.replace is faster here than one str.translate or regex pass,
+    since it skips to each match with memchr and returns at once when
+    a key can't be in the text (e.g. a curly quote in an ASCII listing).
+    """
+    for old, new in replacements.items():
+        text = text.replace(old, new)
+    return text
+
+
+# Tabs become four spaces, smart quotes become regular quotes,
+# and ÔÇ£/ÔÇØ are smart quotes that were decoded the wrong way
+CODE_BLOCK_FIXES = {'\t': '    ', "‘": "'", "’": "'", '“': '"', '”': '"', 'ÔÇ£': '"', 'ÔÇØ': '"'}
+# Inline code also turns dashes into hyphens, and 'â' (what an en dash
+# starts with when decoded the wrong way) and 'ÔÇô' (an en dash decoded
+# as code page 437) into hyphens too
+CODE_FIXES = {**CODE_BLOCK_FIXES, '–': '-', 'â': '-', 'ÔÇô': '-'}
+
+
+def strip_bounds(text: str) -> tuple[int, int]:
+    """Return start, stop such that text[start:stop] == text.strip()."""
+    start, stop = 0, len(text)
+    while start < stop and text[start].isspace():
+        start += 1
+    while stop > start and text[stop - 1].isspace():
+        stop -= 1
+    return start, stop
+
+
+def split_language(text: str) -> tuple[Optional[str], str]:
+    """Return the language on the first line of a code block's text and
+    the code below it, or None and all of text if there's no language.
+    """
+    # Get the first line of the code block, without splitting the rest
+    start, stop = strip_bounds(text)
+    newline = text.find('\n', start, stop)
+    first_line = text[start:stop if newline == -1 else newline].lower()
+    # Is the first line a programming language
+    first_line = ALIASES.get(first_line, first_line)
+    if first_line in CODE_LANG:
+        return first_line, '' if newline == -1 else text[newline + 1:stop]
+    return None, text
+
+
 def set_code_block_language(code_block, doc):
     """Also ensures all tabs are four spaces"""
-    if type(code_block) == pf.Code:
-        code_block.text = code_block.text.replace('\t', '    ').replace("‘", "'")\
-            .replace("’", "'").replace('“', '"').replace('”', '"')\
-            .replace('ÔÇ£', '"').replace('ÔÇØ', '"').replace('–', '-').replace("â", "-").replace("ÔÇô", "-")
-    if type(code_block) == pf.CodeBlock:
-        # Get the first line of the code block
-        # pf.debug(dir(code_block))
-        # pf.debug(f'{code_block.classes} / {code_block.tag}')
-        first_line = code_block.text.strip().split('\n')[0]
-        # Is the first line a programming language
-        if first_line.lower() in ALIASES:
-            first_line = ALIASES[first_line.lower()]
-        if first_line.lower() in CODE_LANG:
+    if code_block.tag == 'Code':
+        code_block.text = replace_all(code_block.text, CODE_FIXES)
+    if code_block.tag == 'CodeBlock':
+        language, text = split_language(code_block.text)
+        if language is not None:
             # Apparently the classes is the language
-            code_block.classes = [first_line.lower()]
-            code_block.text = '\n'.join(code_block.text.strip().split('\n')[1:])
-        code_block.text = code_block.text.replace('\t', '    ').replace("‘", "'")\
-            .replace("’", "'").replace('“', '"').replace('”', '"')\
-            .replace('ÔÇ£', '"').replace('ÔÇØ', '"')
+            code_block.classes = [language]
+        code_block.text = replace_all(text, CODE_BLOCK_FIXES)
+
+
+FILTER_VERSION = source_version(__file__)
+
+
+def set_code_block_language_cached(code_block, doc):
+    """Same as set_code_block_language, but code blocks that were seen
+    before (by their JSON) are taken from the fragment cache.
+    Inline code is cheaper to redo than to look up, so it isn't cached.
+    """
+    cache = get_fragment_cache()
+    if cache is None or code_block.tag != 'CodeBlock':
+        return set_code_block_language(code_block, doc)
+    source = json.dumps(code_block.to_json())
+    cached = cache.get('CodeBlock', FILTER_VERSION, source)
+    if cached is not None:
+        code_block.classes, code_block.text = json.loads(cached)
+        return
+    set_code_block_language(code_block, doc)
+    cache.put('CodeBlock', FILTER_VERSION, source, json.dumps([code_block.classes, code_block.text]))
+
+
+def set_code_block_language_raw(code_block, doc):
+    """Same as set_code_block_language_cached, on a Code or CodeBlock's JSON.
+    It shares the fragment cache with it, since the JSON is the same."""
+    content = code_block['c']
+    if code_block['t'] == 'Code':
+        content[1] = replace_all(content[1], CODE_FIXES)
+        return
+    cache = get_fragment_cache()
+    if cache is not None:
+        source = json.dumps(code_block)
+        cached = cache.get('CodeBlock', FILTER_VERSION, source)
+        if cached is not None:
+            content[0][1], content[1] = json.loads(cached)
+            return
+    language, text = split_language(content[1])
+    if language is not None:
+        content[0][1] = [language]
+    content[1] = replace_all(text, CODE_BLOCK_FIXES)
+    if cache is not None:
+        cache.put('CodeBlock', FILTER_VERSION, source, json.dumps([content[0][1], content[1]]))
+
+
+RAW_ACTIONS = {'Code': [set_code_block_language_raw], 'CodeBlock': [set_code_block_language_raw]}
 
 
 def main(doc=None):
+    if doc is None:
+        return run_raw_filters(RAW_ACTIONS, finalize=finish_fragment_cache)
+    import panflute as pf
     # Iterate over all the code blocks in the document
-    return pf.run_filter(set_code_block_language, doc)
+    return pf.run_filter(set_code_block_language_cached, finalize=finish_fragment_cache, doc=doc)
 
 
 if __name__ == '__main__':
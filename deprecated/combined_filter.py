@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""Runs the equation, code block, image caption and environment
+filters in a single pass over the document, so pandoc only has to
+write the AST out, start Python and read it back once.
+
+    pandoc -s word_file.docx -o output.pdf --filter=combined_filter.py
+
+The output is the same as running each filter on its own, one after another.
+no_longtable.py can be run this way too, by adding tables to the list,
+and image_optimizer.py by adding media.
+
+To choose which filters run, and in what order, set the
+ms-word-filters metadata field. The default is
+
+    -M ms-word-filters=equations,code,images,environments
+
+Unless tables are written out too, the filters run over the raw JSON
+(see raw_filter.py), and panflute isn't imported at all.
+"""
+
+
+from __future__ import annotations
+
+import io
+from typing import Any, Callable, Optional, TYPE_CHECKING
+
+from code_block import RAW_ACTIONS as CODE_RAW_ACTIONS, set_code_block_language_cached
+from fragment_cache import finish_fragment_cache
+from image_captioner import RAW_ACTIONS as IMAGE_RAW_ACTIONS, make_image_caption
+from image_optimizer import RAW_ACTIONS as MEDIA_RAW_ACTIONS, collect_images, finish_image_optimizer, \
+    optimize_image_pf
+from json_backend import get_json_backend, write_json
+from ms_word_eqn_filter import RAW_ACTIONS as EQUATION_RAW_ACTIONS, collect_equations, finish_equation_filter, \
+    fix_equations_pf, start_equation_profile
+from raw_filter import RawAction, RawDoc, read_doc, run_raw_filter, write_doc
+from start_wrapper import ASTProcessor, EnvironmentRegistry, make_processors
+
+if TYPE_CHECKING:
+    import panflute as pf
+
+FILTERS_META = 'ms-word-filters'
+DEFAULT_FILTERS = ['equations', 'code', 'images', 'environments']
+
+# Elements whose content is a list of blocks
+BLOCK_CONTAINERS = {'Doc', 'Div', 'BlockQuote', 'ListItem', 'Definition', 'Figure'}
+
+
+class PanfluteEnvironmentRegistry(EnvironmentRegistry):
+    """EnvironmentRegistry for panflute elements instead of the raw JSON AST.
+
+    It doesn't go into child blocks by itself, since panflute's walk
+    already visits every block container, innermost first.
+    """
+
+    def child_block_lists(self, block: pf.Element) -> list:
+        return []
+
+    def flag_of(self, block: pf.Element) -> Optional[tuple[str, str]]:
+        if block.tag != 'Para' or len(block.content) < 3:
+            return None
+        first, space, second = block.content[0], block.content[1], block.content[2]
+        if first.tag != 'Str' or space.tag != 'Space' or second.tag != 'Str':
+            return None
+        return first.text, second.text
+
+    def title_of(self, processor: ASTProcessor, start_block: pf.Para) -> str:
+        skip = len(processor.start_block[0]['c'])
+        return ' '.join(item.text for item in start_block.content[skip:] if item.tag == 'Str')
+
+    def wrap(self, processor: ASTProcessor, inner_blocks: list, title: str) -> pf.Div:
+        import panflute as pf
+        attributes = {'title': title} if title != '' else {}
+        return pf.Div(*inner_blocks, classes=[processor.type_of], attributes=attributes)
+
+
+def make_wrap_environments(doc: pf.Doc) -> Callable[[pf.Element, pf.Doc], None]:
+    registry = PanfluteEnvironmentRegistry({}, make_processors({}))
+
+    def wrap_environments(elem: pf.Element, doc: pf.Doc) -> None:
+        if elem.tag in BLOCK_CONTAINERS:
+            elem.content = list(registry.iter_process_blocks(list(elem.content)))
+
+    return wrap_environments
+
+
+def make_fix_equations(doc: pf.Doc) -> Callable[[pf.Element, pf.Doc], Any]:
+    """Equations are collected and fixed together once the walk is done,
+    unless tables are written out too: a table is written out as LaTeX
+    as soon as it's reached, so the equations in it have to be fixed by then.
+    """
+    if 'tables' in doc.ms_word_filters:
+        return fix_equations_pf
+    doc.ms_word_equations = []
+    doc.ms_word_note_equations = set()
+    return collect_equations
+
+
+def make_optimize_images(doc: pf.Doc) -> Callable[[pf.Element, pf.Doc], Any]:
+    """Like equations, images are collected and optimized together at the end,
+    unless tables are written out too."""
+    if 'tables' in doc.ms_word_filters:
+        return optimize_image_pf
+    doc.ms_word_images = []
+    return collect_images
+
+
+def make_replace_tables(doc: pf.Doc) -> Callable[[pf.Element, pf.Doc], Any]:
+    from no_longtable import add_header_includes, is_latex, replace_table
+    if is_latex(doc):
+        add_header_includes(doc)
+    return replace_table
+
+
+FILTERS: dict[str, Callable[[pf.Doc], Callable[[pf.Element, pf.Doc], Any]]] = {
+    'equations': make_fix_equations,
+    'code': lambda doc: set_code_block_language_cached,
+    'images': lambda doc: make_image_caption,
+    'environments': make_wrap_environments,
+    'tables': make_replace_tables,
+    'media': make_optimize_images,
+}
+
+
+def make_fix_equations_raw(doc: RawDoc) -> dict[str, list[RawAction]]:
+    doc.ms_word_equations = []
+    doc.ms_word_note_equations = set()
+    return EQUATION_RAW_ACTIONS
+
+
+def make_optimize_images_raw(doc: RawDoc) -> dict[str, list[RawAction]]:
+    doc.ms_word_images = []
+    return MEDIA_RAW_ACTIONS
+
+
+# The filters that can run over the raw JSON, and the actions they run on
+# each kind of element. Environments are wrapped after the walk instead.
+RAW_FILTERS: dict[str, Callable[[RawDoc], dict[str, list[RawAction]]]] = {
+    'equations': make_fix_equations_raw,
+    'code': lambda doc: CODE_RAW_ACTIONS,
+    'images': lambda doc: IMAGE_RAW_ACTIONS,
+    'environments': lambda doc: {},
+    'media': make_optimize_images_raw,
+}
+
+
+def chosen_filters(doc: Any) -> list[str]:
+    """The filters ms-word-filters asks for, in order. doc is a panflute Doc or a RawDoc."""
+    names = doc.get_metadata(FILTERS_META, DEFAULT_FILTERS)
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    unknown = [name for name in names if name not in FILTERS]
+    if unknown:
+        raise ValueError(f'Unknown filters in {FILTERS_META}: {", ".join(unknown)}. '
+                         f'Choose from {", ".join(FILTERS)}')
+    return names
+
+
+def prepare(doc: pf.Doc) -> None:
+    names = chosen_filters(doc)
+    doc.ms_word_filters = names
+    doc.ms_word_actions = [FILTERS[name](doc) for name in names]
+    start_equation_profile(doc)
+
+
+def run_actions(elem: pf.Element, doc: pf.Doc) -> Any:
+    """Run every chosen filter on elem, in order. If a filter
+    replaces elem, the filters after it see the replacement."""
+    for action in doc.ms_word_actions:
+        result = action(elem, doc)
+        if result is not None:
+            elem = result
+    return elem
+
+
+def finalize(doc: pf.Doc) -> None:
+    finish_equation_filter(doc)
+    finish_image_optimizer(doc)
+    finish_fragment_cache(doc)
+    del doc.ms_word_actions
+    del doc.ms_word_filters
+
+
+def run_raw(doc: RawDoc, names: list[str]) -> RawDoc:
+    """Same as running the filters in names with panflute, over the raw JSON."""
+    actions: dict[str, list[RawAction]] = {}
+    for name in names:
+        for tag, tag_actions in RAW_FILTERS[name](doc).items():
+            actions.setdefault(tag, []).extend(tag_actions)
+    start_equation_profile(doc)
+
+    def finalize_raw(doc: RawDoc) -> None:
+        if 'environments' in names:
+            EnvironmentRegistry(doc.ast, make_processors(doc.ast)).process()
+        finish_equation_filter(doc)
+        finish_image_optimizer(doc)
+        finish_fragment_cache(doc)
+
+    return run_raw_filter(actions, doc, finalize=finalize_raw)
+
+
+def main(doc: Any = None) -> Any:
+    if doc is not None:
+        import panflute as pf
+        return pf.run_filter(run_actions, prepare=prepare, finalize=finalize, doc=doc)
+
+    raw_doc = read_doc()
+    names = chosen_filters(raw_doc)
+    if all(name in RAW_FILTERS for name in names):
+        write_doc(run_raw(raw_doc, names))
+        return None
+    # Tables are written out with panflute, so the document is made into its elements
+    import panflute as pf
+    text = get_json_backend().dumps(raw_doc.ast).decode('utf-8')
+    del raw_doc
+    doc = pf.load(io.StringIO(text))
+    pf.run_filter(run_actions, prepare=prepare, finalize=finalize, doc=doc)
+    write_json(doc.to_json())
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+"""Keeps the Python filters loaded in a long-running process, so an
+editor can preview equations without starting pandoc and Python for
+each one.
+
+    python fix_server.py --socket /tmp/ms-word.sock
+    python fix_server.py --stdio
+
+It speaks JSON-RPC 2.0, one request or response per line, over a Unix
+socket or over stdin and stdout:
+
+    fix_equation        {"equation": "x^{2}"}            -> "x^{2}  "
+    fix_equations       {"equations": ["x", "y"]}        -> ["x  ", "y  "]
+    fix_code_block      {"text": "python\\nprint(1)"}     -> {"language": "python", "text": "print(1)"}
+    fix_inline_code     {"text": "a – b"}                -> "a - b"
+    wrap_environments   {"blocks": [...]}                -> the blocks, as start_wrapper.py wraps them
+    stats               {}                               -> request counts, latencies and cache hits
+
+Requests are answered as they finish, so a client that sends several at
+once matches the answers up by their id. The fixing itself is done on one
+worker thread, while the server keeps reading requests and answering
+stats. Equations are fixed through the same cache as the filter
+(MS_WORD_EQN_CACHE_SIZE, MS_WORD_EQN_CACHE_DIR), which is made, used
+and saved on the worker thread only, since a cache on disk can't be
+shared between threads. It is saved when the server stops.
+
+FixClient talks to a server on a socket; LocalFixClient has the same
+methods but runs the requests in-process, with no server at all.
+"""
+
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from code_block import CODE_BLOCK_FIXES, CODE_FIXES, replace_all, split_language
+from fragment_cache import finish_fragment_cache
+from json_backend import get_json_backend
+from ms_word_eqn_filter import DEFAULT_PARALLEL_MIN, finish_equation_cache, get_equation_cache, peek_equation_cache
+from start_wrapper import EnvironmentRegistry, make_processors
+
+# Longest request line read, so a batch of equations fits in one
+MAX_LINE = 64 * 1024 * 1024
+
+# How many of the latest requests of each method percentiles are taken over
+RECENT_REQUESTS = 1000
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RequestError(Exception):
+    """Raised to answer a request with a JSON-RPC error."""
+
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class LatencyCounter:
+    """How many requests of one method were answered, and how long they took."""
+    count: int
+    errors: int
+    total: float
+    longest: float
+    recent: deque
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.recent = deque(maxlen=RECENT_REQUESTS)
+
+    def add(self, seconds: float, failed: bool) -> None:
+        self.count += 1
+        self.errors += int(failed)
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, fraction: float) -> float:
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+    def summary(self) -> dict:
+        return {'count': self.count, 'errors': self.errors,
+                'mean_ms': round(1000 * self.total / self.count, 3) if self.count else 0.0,
+                'p50_ms': round(1000 * self.percentile(0.5), 3),
+                'p95_ms': round(1000 * self.percentile(0.95), 3),
+                'max_ms': round(1000 * self.longest, 3)}
+
+
+def string_param(params: dict, name: str) -> str:
+    value = params.get(name)
+    if not isinstance(value, str):
+        raise RequestError(INVALID_PARAMS, f'{name} must be a string')
+    return value
+
+
+def list_param(params: dict, name: str) -> list:
+    value = params.get(name)
+    if not isinstance(value, list):
+        raise RequestError(INVALID_PARAMS, f'{name} must be a list')
+    return value
+
+
+def fix_equation(params: dict) -> str:
+    return get_equation_cache().fix(string_param(params, 'equation'))
+
+
+def fix_equations(params: dict) -> list[str]:
+    """Each distinct equation is fixed once, in this process: a server
+    answering one editor is better off not starting worker processes."""
+    equations = list_param(params, 'equations')
+    if not all(isinstance(eqn, str) for eqn in equations):
+        raise RequestError(INVALID_PARAMS, 'equations must be strings')
+    fixed = get_equation_cache().fix_many(equations, 1, DEFAULT_PARALLEL_MIN)
+    return [fixed[eqn] for eqn in equations]
+
+
+def fix_code_block(params: dict) -> dict:
+    """Same as code_block.py on a code block's text."""
+    language, text = split_language(string_param(params, 'text'))
+    return {'language': language, 'text': replace_all(text, CODE_BLOCK_FIXES)}
+
+
+def fix_inline_code(params: dict) -> str:
+    return replace_all(string_param(params, 'text'), CODE_FIXES)
+
+
+_registry: Optional[EnvironmentRegistry] = None
+
+
+def wrap_environments(params: dict) -> list:
+    """Same as start_wrapper.py on a list of pandoc's JSON blocks."""
+    global _registry
+    if _registry is None:
+        _registry = EnvironmentRegistry({}, make_processors({}))
+    return _registry.process_blocks(list_param(params, 'blocks'))
+
+
+# The methods run on the worker thread, by name
+METHODS: dict[str, Callable[[dict], Any]] = {
+    'fix_equation': fix_equation,
+    'fix_equations': fix_equations,
+    'fix_code_block': fix_code_block,
+    'fix_inline_code': fix_inline_code,
+    'wrap_environments': wrap_environments,
+}
+
+
+def finish_caches() -> None:
+    finish_equation_cache()
+    finish_fragment_cache()
+
+
+class FixService:
+    """Answers JSON-RPC requests, one line of JSON each, with METHODS.
+
+    Methods run one at a time on a single worker thread, since the
+    equation cache isn't shared between threads. stats is answered
+    straight away, from the event loop, and only reads the cache's counters.
+    """
+    worker: ThreadPoolExecutor
+    latencies: dict[str, LatencyCounter]
+    started: float
+
+    def __init__(self) -> None:
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fix-server')
+        self.latencies = {}
+        self.started = time.monotonic()
+        # Made on the worker, which is the only thread that may use it
+        self.worker.submit(get_equation_cache)
+
+    async def handle_line(self, line: bytes) -> Optional[bytes]:
+        """Return the response to one request line, or None for a notification."""
+        start = time.perf_counter()
+        backend = get_json_backend()
+        request_id = None
+        method = None
+        notification = False
+        failed = False
+        try:
+            try:
+                request = backend.loads(line)
+            except ValueError as error:
+                raise RequestError(PARSE_ERROR, f'Parse error: {error}')
+            if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+                raise RequestError(INVALID_REQUEST, 'Invalid request')
+            request_id = request.get('id')
+            notification = 'id' not in request
+            method = request['method']
+            params = request.get('params', {})
+            if not isinstance(params, dict):
+                raise RequestError(INVALID_PARAMS, 'params must be an object')
+            response: dict = {'jsonrpc': '2.0', 'id': request_id, 'result': await self.call(method, params)}
+        except RequestError as error:
+            failed = True
+            response = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': error.code, 'message': error.message}}
+        except Exception as error:  # the server keeps answering whatever one request trips over
+            failed = True
+            response = {'jsonrpc': '2.0', 'id': request_id,
+                        'error': {'code': INTERNAL_ERROR, 'message': f'{type(error).__name__}: {error}'}}
+        if method is not None:
+            self.latencies.setdefault(method, LatencyCounter()).add(time.perf_counter() - start, failed)
+        if notification:
+            return None
+        return backend.dumps(response) + b'\n'
+
+    async def call(self, method: str, params: dict) -> Any:
+        if method == 'stats':
+            return self.stats()
+        function = METHODS.get(method)
+        if function is None:
+            raise RequestError(METHOD_NOT_FOUND, f'Unknown method {method!r}. Choose from '
+                                                 f'{", ".join([*METHODS, "stats"])}')
+        return await asyncio.get_running_loop().run_in_executor(self.worker, function, params)
+
+    def stats(self) -> dict:
+        cache = peek_equation_cache()
+        if cache is None:
+            counts = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'size': 0}
+        else:
+            counts = {'hits': cache.hits, 'misses': cache.misses, 'disk_hits': cache.disk_hits,
+                      'size': len(cache.memo)}
+        return {'uptime_s': round(time.monotonic() - self.started, 3),
+                'requests': {method: counter.summary() for method, counter in self.latencies.items()},
+                'equation_cache': counts}
+
+    async def serve_connection(self, reader: Any, writer: Any) -> None:
+        """Answer every request line from reader on writer, each as soon
+        as it's done, until reader runs out."""
+        pending: set[asyncio.Task] = set()
+
+        async def answer(line: bytes) -> None:
+            response = await self.handle_line(line)
+            if response is not None:
+                writer.write(response)
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(answer(line))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            writer.close()
+
+    def close(self) -> None:
+        """Save the caches, on the worker that made them, and stop the worker."""
+        try:
+            self.worker.submit(finish_caches).result()
+        finally:
+            self.worker.shutdown(wait=True)
+
+
+async def serve_socket(service: FixService, path: str) -> None:
+    if os.path.exists(path):
+        os.unlink(path)  # left over from a server that didn't stop cleanly
+    server = await asyncio.start_unix_server(service.serve_connection, path, limit=MAX_LINE)
+    print(f'[fix_server] listening on {path}', file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+class StdinReader:
+    """Reads request lines from stdin on a thread of its own, so stdin
+    can be a pipe or a file."""
+
+    async def readline(self) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(None, sys.stdin.buffer.readline)
+
+
+class StdoutWriter:
+    """Writes each answer to stdout as soon as it's ready."""
+
+    def write(self, data: bytes) -> None:
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    async def drain(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+async def serve_stdio(service: FixService) -> None:
+    await service.serve_connection(StdinReader(), StdoutWriter())
+
+
+async def run(service: FixService, path: Optional[str]) -> None:
+    """Serve until stdin runs out, or until SIGINT or SIGTERM."""
+    serving = asyncio.ensure_future(serve_socket(service, path) if path else serve_stdio(service))
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, serving.cancel)
+    try:
+        await serving
+    except asyncio.CancelledError:
+        pass
+
+
+class FixClient:
+    """Sends requests to a fix_server.py listening on the socket at path,
+    one at a time, and waits for each answer."""
+    next_id: int
+    sock: Optional[socket.socket]
+    buffer: bytes
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.next_id = 0
+        self.sock = None
+        self.buffer = b''
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+
+    def call(self, method: str, **params: Any) -> Any:
+        """Return the result of method, or raise RequestError."""
+        self.next_id += 1
+        backend = get_json_backend()
+        line = backend.dumps({'jsonrpc': '2.0', 'id': self.next_id, 'method': method, 'params': params})
+        response = backend.loads(self.send(line + b'\n'))
+        if 'error' in response:
+            raise RequestError(response['error']['code'], response['error']['message'])
+        return response['result']
+
+    def send(self, line: bytes) -> bytes:
+        self.sock.sendall(line)
+        while b'\n' not in self.buffer:
+            data = self.sock.recv(1 << 16)
+            if not data:
+                raise ConnectionError('fix_server.py closed the connection')
+            self.buffer += data
+        response, self.buffer = self.buffer.split(b'\n', 1)
+        return response
+
+    def fix_equation(self, equation: str) -> str:
+        return self.call('fix_equation', equation=equation)
+
+    def fix_equations(self, equations: list[str]) -> list[str]:
+        return self.call('fix_equations', equations=equations)
+
+    def fix_code_block(self, text: str) -> dict:
+        return self.call('fix_code_block', text=text)
+
+    def fix_inline_code(self, text: str) -> str:
+        return self.call('fix_inline_code', text=text)
+
+    def wrap_environments(self, blocks: list) -> list:
+        return self.call('wrap_environments', blocks=blocks)
+
+    def stats(self) -> dict:
+        return self.call('stats')
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self) -> 'FixClient':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class LocalFixClient(FixClient):
+    """FixClient that answers its requests with a FixService in this
+    process, the same way a server would, without any socket."""
+    service: FixService
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.service = FixService()
+
+    def send(self, line: bytes) -> bytes:
+        return asyncio.run(self.service.handle_line(line)).rstrip(b'\n')
+
+    def close(self) -> None:
+        self.service.close()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Keep the Python filters loaded and fix equations on request.')
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--socket', help='the Unix socket to listen on')
+    where.add_argument('--stdio', action='store_true', help='read requests from stdin, answer on stdout')
+    args = parser.parse_args(argv)
+
+    service = FixService()
+    try:
+        asyncio.run(run(service, args.socket))
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
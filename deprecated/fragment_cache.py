@@ -0,0 +1,164 @@
+"""A cache on disk for what the filters turn pieces of a document into,
+so rebuilding a document where little has changed skips most of the work.
+
+Entries are keyed by a hash of what kind of piece it is, the version of the
+filter that made it, and the piece itself (usually its JSON), so entries from
+an older version of a filter are never used. They are kept in an SQLite file
+in a folder of your choosing:
+
+    MS_WORD_CACHE_DIR          folder to keep the cache in. No cache if unset.
+    MS_WORD_CACHE_MAX_ENTRIES  most entries to keep (default 100000)
+    MS_WORD_CACHE_MAX_MB       most megabytes of results to keep (default 256)
+    MS_WORD_CACHE_VERBOSE      if set, report hits and misses on stderr
+
+When there are too many entries, the ones used least recently are dropped.
+
+Several processes can share the folder (batch_convert.py does): new entries
+and the times entries were used are kept in memory and written in short
+transactions, so no process holds the database locked for long.
+"""
+
+
+import hashlib
+import os
+import sqlite3
+import sys
+from typing import Optional
+
+CACHE_DIR_ENV = 'MS_WORD_CACHE_DIR'
+MAX_ENTRIES_ENV = 'MS_WORD_CACHE_MAX_ENTRIES'
+MAX_MB_ENV = 'MS_WORD_CACHE_MAX_MB'
+VERBOSE_ENV = 'MS_WORD_CACHE_VERBOSE'
+DEFAULT_MAX_ENTRIES = 100_000
+DEFAULT_MAX_MB = 256
+CACHE_FILE = 'fragments.sqlite3'
+
+# New entries are written once there are this many of them
+WRITE_BATCH = 256
+
+# How long to wait for another process that is writing to the cache
+BUSY_TIMEOUT_MS = 30_000
+
+
+def source_version(path: str) -> str:
+    """Return a hash of the file at path. Pass a filter's __file__
+    to get a version that changes whenever the filter does."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+class FragmentCache:
+    """Maps pieces of a document to what a filter turned them into."""
+    db: sqlite3.Connection
+    max_entries: int
+    max_bytes: int
+    hits: dict[str, int]
+    misses: dict[str, int]
+    clock: int
+    pending: dict[str, tuple[str, str, int]]
+    used: dict[str, int]
+
+    def __init__(self, cache_dir: str, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Autocommit, so reading never leaves a transaction open
+        self.db = sqlite3.connect(os.path.join(cache_dir, CACHE_FILE), isolation_level=None)
+        self.db.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS fragments '
+                        '(key TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, last_used INTEGER NOT NULL)')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = {}
+        self.misses = {}
+        self.clock = self.db.execute('SELECT COALESCE(MAX(last_used), 0) FROM fragments').fetchone()[0]
+        self.pending = {}
+        self.used = {}
+
+    @staticmethod
+    def fingerprint(kind: str, version: str, source: str) -> str:
+        return hashlib.sha256('\0'.join((kind, version, source)).encode('utf-8')).hexdigest()
+
+    def get(self, kind: str, version: str, source: str) -> Optional[str]:
+        """Return what source was turned into last time, or None."""
+        key = self.fingerprint(kind, version, source)
+        if key in self.pending:
+            value = self.pending[key][1]
+        else:
+            row = self.db.execute('SELECT value FROM fragments WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+            value = row[0]
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+        self.clock += 1
+        self.used[key] = self.clock
+        return value
+
+    def put(self, kind: str, version: str, source: str, value: str) -> None:
+        """Remember that source was turned into value."""
+        self.clock += 1
+        self.pending[self.fingerprint(kind, version, source)] = (kind, value, self.clock)
+        if len(self.pending) >= WRITE_BATCH:
+            self.write()
+
+    def write(self) -> None:
+        """Write the new entries and when entries were used, in one transaction."""
+        if not self.pending and not self.used:
+            return
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?)',
+                                [(key, kind, value, used) for key, (kind, value, used) in self.pending.items()])
+            self.db.executemany('UPDATE fragments SET last_used = MAX(last_used, ?) WHERE key = ?',
+                                [(used, key) for key, used in self.used.items()])
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+        self.pending.clear()
+        self.used.clear()
+
+    def flush(self) -> None:
+        """Write everything to disk and drop the least recently used entries past the size limits."""
+        self.write()
+        self.db.execute('DELETE FROM fragments WHERE key IN ('
+                        'SELECT key FROM (SELECT key, '
+                        'ROW_NUMBER() OVER (ORDER BY last_used DESC) AS n, '
+                        'SUM(LENGTH(value)) OVER (ORDER BY last_used DESC) AS total '
+                        'FROM fragments) WHERE n > ? OR total > ?)',
+                        (self.max_entries, self.max_bytes))
+
+    def report(self) -> str:
+        kinds = sorted(set(self.hits) | set(self.misses))
+        counts = ', '.join(f'{kind}: {self.hits.get(kind, 0)} hits, {self.misses.get(kind, 0)} misses'
+                           for kind in kinds)
+        return f'[fragment_cache] {counts or "not used"}'
+
+
+_fragment_cache: Optional[FragmentCache] = None
+
+
+def open_fragment_cache(cache_dir: str) -> FragmentCache:
+    """Return a cache in cache_dir, limited by MS_WORD_CACHE_MAX_ENTRIES and MS_WORD_CACHE_MAX_MB."""
+    return FragmentCache(cache_dir,
+                         int(os.environ.get(MAX_ENTRIES_ENV, DEFAULT_MAX_ENTRIES)),
+                         int(float(os.environ.get(MAX_MB_ENV, DEFAULT_MAX_MB)) * 1024 * 1024))
+
+
+def get_fragment_cache() -> Optional[FragmentCache]:
+    """Return the cache set up by the environment variables above,
+    or None if MS_WORD_CACHE_DIR isn't set."""
+    global _fragment_cache
+    if _fragment_cache is None and os.environ.get(CACHE_DIR_ENV):
+        _fragment_cache = open_fragment_cache(os.environ[CACHE_DIR_ENV])
+    return _fragment_cache
+
+
+def finish_fragment_cache(doc: object = None) -> None:
+    """Save the cache, and report hits and misses if MS_WORD_CACHE_VERBOSE is set."""
+    if _fragment_cache is None:
+        return
+    _fragment_cache.flush()
+    if os.environ.get(VERBOSE_ENV):
+        print(_fragment_cache.report(), file=sys.stderr)
@@ -8,18 +8,31 @@ Images with NO ALT text will not be affected. In MS Word, mark those images as d
 """
 
 
-import panflute as pf
+from raw_filter import run_raw_filters
 
 
 def make_image_caption(elem, doc):
-    if type(elem) == pf.Image:
+    if elem.tag == 'Image':
         if len(elem.content) > 0:
             elem.title = 'fig:'
 
 
+def make_image_caption_raw(elem, doc):
+    """Same as make_image_caption, on an Image's JSON."""
+    _, alt, target = elem['c']
+    if len(alt) > 0:
+        target[1] = 'fig:'
+
+
+RAW_ACTIONS = {'Image': [make_image_caption_raw]}
+
+
 def main(doc=None):
+    if doc is None:
+        return run_raw_filters(RAW_ACTIONS)
+    import panflute as pf
     # Iterate over all the code blocks in the document
-    return pf.run_filter(make_image_caption, doc)
+    return pf.run_filter(make_image_caption, doc=doc)
 
 
 if __name__ == '__main__':
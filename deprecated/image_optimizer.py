@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""Pandoc filter that makes the images of a document take less space.
+
+Word often keeps the same screenshot many times over, and photos at
+full size. Images with the same contents are all pointed at one file,
+so it's only put in the output once, and images bigger than
+
+    MS_WORD_IMAGE_MAX_PIXELS   width times height (default 4000000, 0 for no limit)
+    MS_WORD_IMAGE_MAX_KB       size of the file (default 1024, 0 for no limit)
+
+are scaled down to fit, or saved again more compactly, next to the
+original as name-small.png. Only PNG and JPEG images are shrunk, and only
+if Pillow is installed (pip install Pillow). They're shrunk on
+MS_WORD_IMAGE_WORKERS threads (default: one per CPU).
+
+Only images that are files on disk can be looked at, so have pandoc
+write them out first:
+
+    pandoc word_file.docx --extract-media=media -o output.pdf --filter=image_optimizer.py
+
+If MS_WORD_CACHE_DIR is set, shrunk images are kept there by the hash of
+their contents, so the next build doesn't shrink them again.
+MS_WORD_IMAGE_VERBOSE reports how many bytes were saved.
+"""
+
+
+import hashlib
+import io
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from fragment_cache import CACHE_DIR_ENV, source_version
+from raw_filter import run_raw_filters
+
+MAX_PIXELS_ENV = 'MS_WORD_IMAGE_MAX_PIXELS'
+MAX_KB_ENV = 'MS_WORD_IMAGE_MAX_KB'
+WORKERS_ENV = 'MS_WORD_IMAGE_WORKERS'
+VERBOSE_ENV = 'MS_WORD_IMAGE_VERBOSE'
+DEFAULT_MAX_PIXELS = 4_000_000
+DEFAULT_MAX_KB = 1024
+JPEG_QUALITY = 85
+CACHE_FOLDER = 'images'
+
+# The images that are shrunk, and what Pillow calls their format
+SHRUNK_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG'}
+
+FILTER_VERSION = source_version(__file__)
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def is_local_file(url: str) -> bool:
+    return '://' not in url and not url.startswith('data:') and os.path.isfile(url)
+
+
+class ImageOptimizer:
+    """Points images with the same contents at one file, and shrinks
+    the ones over budget. Remembers every file it has seen, so images can
+    be handed to it all at once or a few at a time."""
+    max_pixels: int
+    max_bytes: int
+    workers: int
+    cache_dir: Optional[str]
+    files: dict[str, str]
+    first_with_hash: dict[str, str]
+    duplicates: int
+    shrunk: int
+    bytes_saved: int
+    not_shrunk: int
+    pillow_missing: bool
+
+    def __init__(self, max_pixels: int = DEFAULT_MAX_PIXELS, max_bytes: int = DEFAULT_MAX_KB * 1024,
+                 workers: int = 1, cache_dir: Optional[str] = None) -> None:
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.files = {}
+        self.first_with_hash = {}
+        self.duplicates = 0
+        self.shrunk = 0
+        self.bytes_saved = 0
+        self.not_shrunk = 0
+        self.pillow_missing = False
+
+    def optimize(self, images: list) -> None:
+        """Change the url of each of images (anything with a url attribute)
+        to the file it should use instead."""
+        new_paths = [url for url in dict.fromkeys(image.url for image in images)
+                     if url not in self.files and is_local_file(url)]
+        with ThreadPoolExecutor(max(1, self.workers)) as pool:
+            hashes = list(pool.map(file_hash, new_paths))
+            to_shrink = []
+            duplicates = []
+            for path, digest in zip(new_paths, hashes):
+                first = self.first_with_hash.get(digest)
+                if first is None:
+                    self.first_with_hash[digest] = path
+                    to_shrink.append((path, digest))
+                else:
+                    duplicates.append((path, first))
+            for (path, _), result in zip(to_shrink, pool.map(lambda item: self.shrink(*item), to_shrink)):
+                self.files[path] = result
+                if result != path:
+                    self.shrunk += 1
+                    self.bytes_saved += os.path.getsize(path) - os.path.getsize(result)
+                elif self.pillow_missing and self.over_budget(os.path.getsize(path)):
+                    self.not_shrunk += 1
+        for path, first in duplicates:
+            self.files[path] = self.files[first]
+            self.duplicates += 1
+            self.bytes_saved += os.path.getsize(path)
+        for image in images:
+            image.url = self.files.get(image.url, image.url)
+
+    def shrink(self, path: str, digest: str) -> str:
+        """Return the path of path's image shrunk to fit the budget,
+        or path itself if it already fits or can't be made smaller.
+        Runs on the thread pool, so it only writes files, not counts."""
+        extension = os.path.splitext(path)[1].lower()
+        size = os.path.getsize(path)
+        if extension not in SHRUNK_FORMATS:
+            return path
+        target = os.path.splitext(path)[0] + '-small' + extension
+        cached = self.cached_path(digest, extension)
+        if cached is not None and os.path.exists(cached):
+            # An empty file in the cache means the image can't be made smaller
+            with open(cached, 'rb') as f:
+                data = f.read()
+            if not data:
+                return path
+            write_atomically(target, data)
+            return target
+
+        try:
+            from PIL import Image
+        except ImportError:
+            self.pillow_missing = True
+            return path
+        with Image.open(path) as original:
+            width, height = original.size
+            too_many_pixels = self.max_pixels > 0 and width * height > self.max_pixels
+            if not too_many_pixels and not self.over_budget(size):
+                return path
+            image = original
+            if too_many_pixels:
+                scale = (self.max_pixels / (width * height)) ** 0.5
+                image = original.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+            image_format = SHRUNK_FORMATS[extension]
+            options: dict[str, Any] = {'optimize': True}
+            if image_format == 'JPEG':
+                if image.mode not in ('RGB', 'L', 'CMYK'):
+                    image = image.convert('RGB')
+                options.update(quality=JPEG_QUALITY, exif=original.info.get('exif', b''))
+            buffer = io.BytesIO()
+            image.save(buffer, image_format, **options)
+
+        data = buffer.getvalue() if buffer.tell() < size else b''
+        if cached is not None:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            write_atomically(cached, data)
+        if not data:
+            return path
+        write_atomically(target, data)
+        return target
+
+    def over_budget(self, size: int) -> bool:
+        return self.max_bytes > 0 and size > self.max_bytes
+
+    def cached_path(self, digest: str, extension: str) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        settings = f'{self.max_pixels}-{self.max_bytes}-{FILTER_VERSION}'
+        return os.path.join(self.cache_dir, CACHE_FOLDER, f'{digest}-{settings}{extension}')
+
+    def report(self) -> str:
+        lines = [f'Images: {self.duplicates} duplicates, {self.shrunk} shrunk, '
+                 f'{self.bytes_saved / 1024:.0f} KB saved']
+        if self.not_shrunk:
+            lines.append(f"{self.not_shrunk} images are over budget, but Pillow isn't installed to shrink them")
+        return '\n'.join(lines)
+
+
+# Read once at import, since setting the umask to read it isn't thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_atomically(path: str, data: bytes) -> None:
+    """Write data to path through a temporary file next to it, so another
+    process (batch_convert.py runs several) never sees it half written."""
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp makes the file private; give it the mode open() would have
+        os.chmod(temporary, 0o666 & ~_UMASK)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+_image_optimizer: Optional[ImageOptimizer] = None
+
+
+def get_image_optimizer() -> ImageOptimizer:
+    """Return the optimizer set up by the environment variables above."""
+    global _image_optimizer
+    if _image_optimizer is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV) or None
+        _image_optimizer = ImageOptimizer(int(os.environ.get(MAX_PIXELS_ENV, DEFAULT_MAX_PIXELS)),
+                                          int(float(os.environ.get(MAX_KB_ENV, DEFAULT_MAX_KB)) * 1024),
+                                          int(os.environ.get(WORKERS_ENV, os.cpu_count() or 1)),
+                                          cache_dir)
+    return _image_optimizer
+
+
+def start_image_optimizer(doc: Any = None) -> None:
+    doc.ms_word_images = []
+
+
+def finish_image_optimizer(doc: Any = None) -> None:
+    """Optimize the images collect_images found, if any, then report."""
+    if hasattr(doc, 'ms_word_images'):
+        images = doc.ms_word_images
+        del doc.ms_word_images
+        get_image_optimizer().optimize(images)
+    if _image_optimizer is not None and os.environ.get(VERBOSE_ENV):
+        print(_image_optimizer.report(), file=sys.stderr)
+
+
+def optimize_image_pf(elem: Any, doc: Any) -> None:
+    if elem.tag == 'Image':
+        get_image_optimizer().optimize([elem])
+
+
+def collect_images(elem: Any, doc: Any) -> None:
+    """Instead of optimizing each image as it's found, keep it in
+    doc.ms_word_images so they're hashed and shrunk together."""
+    if elem.tag == 'Image':
+        doc.ms_word_images.append(elem)
+
+
+class RawImage:
+    """An Image element's JSON, with a url attribute like panflute's Image."""
+    __slots__ = ('target',)
+
+    def __init__(self, elem: dict) -> None:
+        self.target = elem['c'][2]
+
+    @property
+    def url(self) -> str:
+        return self.target[0]
+
+    @url.setter
+    def url(self, url: str) -> None:
+        self.target[0] = url
+
+
+def collect_images_raw(elem: dict, doc: Any) -> None:
+    """Same as collect_images, on an Image's JSON."""
+    doc.ms_word_images.append(RawImage(elem))
+
+
+RAW_ACTIONS = {'Image': [collect_images_raw]}
+
+
+def main(doc: Any = None) -> Any:
+    if doc is None:
+        return run_raw_filters(RAW_ACTIONS, prepare=start_image_optimizer, finalize=finish_image_optimizer)
+    import panflute as pf
+    return pf.run_filter(collect_images, prepare=start_image_optimizer, finalize=finish_image_optimizer, doc=doc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Reads and writes pandoc's JSON AST for the filters, as bytes straight
+from stdin and to stdout, with the fastest JSON library that's installed.
+
+orjson is used if it's installed, and Python's json module otherwise.
+Both write what pandoc writes: UTF-8, no spaces, no escaped non-ASCII.
+
+    MS_WORD_JSON_BACKEND   json or orjson, to use that one instead of picking
+    MS_WORD_JSON_VERBOSE   if set, report on stderr which one is used
+"""
+
+
+import json
+import os
+import sys
+from abc import ABC, abstractmethod
+from typing import Any, BinaryIO, Callable, Optional
+
+BACKEND_ENV = 'MS_WORD_JSON_BACKEND'
+VERBOSE_ENV = 'MS_WORD_JSON_VERBOSE'
+
+# Turns what the library can't write (like a panflute element) into something it can
+Default = Optional[Callable[[Any], Any]]
+
+
+class JSONBackend(ABC):
+    """Turns bytes of JSON into Python values and back."""
+    name: str
+
+    @abstractmethod
+    def loads(self, data: bytes) -> Any:
+        ...
+
+    @abstractmethod
+    def dumps(self, value: Any, default: Default = None) -> bytes:
+        ...
+
+
+class StdlibJSON(JSONBackend):
+    """Python's json module."""
+    name = 'json'
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(self, value: Any, default: Default = None) -> bytes:
+        return json.dumps(value, default=default, check_circular=False,
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class OrJSON(JSONBackend):
+    """orjson, which reads and writes bytes in one go, several times faster."""
+    name = 'orjson'
+
+    def __init__(self) -> None:
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, data: bytes) -> Any:
+        return self.orjson.loads(data)
+
+    def dumps(self, value: Any, default: Default = None) -> bytes:
+        return self.orjson.dumps(value, default=default)
+
+
+BACKENDS: dict[str, Callable[[], JSONBackend]] = {'orjson': OrJSON, 'json': StdlibJSON}
+
+_backend: Optional[JSONBackend] = None
+
+
+def get_json_backend() -> JSONBackend:
+    """Return the backend MS_WORD_JSON_BACKEND asks for, or else the first
+    one in BACKENDS that's installed."""
+    global _backend
+    if _backend is not None:
+        return _backend
+    wanted = os.environ.get(BACKEND_ENV)
+    if wanted and wanted not in BACKENDS:
+        raise ValueError(f'Unknown {BACKEND_ENV} {wanted!r}. Choose from {", ".join(BACKENDS)}')
+    for name in [wanted] if wanted else BACKENDS:
+        try:
+            _backend = BACKENDS[name]()
+            break
+        except ImportError:
+            if wanted:
+                raise
+    if os.environ.get(VERBOSE_ENV):
+        print(f'JSON backend: {_backend.name}', file=sys.stderr)
+    return _backend
+
+
+def read_json(instream: Optional[BinaryIO] = None) -> Any:
+    """Read a JSON value from instream, stdin by default."""
+    if instream is None:
+        instream = sys.stdin.buffer
+    return get_json_backend().loads(instream.read())
+
+
+def write_json(value: Any, outstream: Optional[BinaryIO] = None, default: Default = None) -> None:
+    """Write value as JSON to outstream, stdout by default."""
+    if outstream is None:
+        outstream = sys.stdout.buffer
+    outstream.write(get_json_backend().dumps(value, default))
+    outstream.flush()
@@ -1,10 +1,62 @@
 #!/usr/bin/env python
 
+import heapq
+import json
 import math
+import os
 import re
-from typing import Optional, Union, Iterable, Any
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Union, Iterable, Any, Callable
 
-from panflute import Math, run_filter
+from fragment_cache import FragmentCache, get_fragment_cache, open_fragment_cache, source_version
+from raw_filter import run_raw_filters
+
+# Plain text replacements made on every equation before anything else.
+# They're shared with word_eqn.lua, so add new ones to the file.
+SYMBOL_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'eqn_rules.json')
+
+
+def load_symbol_rules(path: str = SYMBOL_RULES_FILE, implementation: str = 'python') -> list[tuple[str, str]]:
+    """Return the (old, new) pairs in the rule file at path that
+    apply to implementation, in the order they're made.
+    """
+    with open(path, encoding='utf-8') as f:
+        rules = json.load(f)['rules']
+    return [(rule['old'], rule['new']) for rule in rules if implementation in rule.get('filters', [implementation])]
+
+
+SYMBOL_RULES = load_symbol_rules()
+
+
+def load_relations(path: str = SYMBOL_RULES_FILE) -> list[list[str]]:
+    """Return the relations that aligned equations are lined up on,
+    most important first, from the rule file at path.
+    """
+    with open(path, encoding='utf-8') as f:
+        return [[symbol for symbol in row if symbol] for row in json.load(f)['relations']]
+
+
+def compile_relations(relations: list[list[str]]) -> re.Pattern:
+    """Return a pattern that finds every place any of relations starts,
+    overlapping or not, with group k + 1 matching if the most important
+    relation there is in relations[k].
+
+    The lookahead tries the rows in order and stops at the first one that
+    matches, and the character class in front skips every place no relation
+    starts with, so adding relations barely slows the scan down.
+    """
+    groups = '|'.join('(' + ('|'.join(re.escape(symbol) for symbol in row) or '(?!)') + ')' for row in relations)
+    first_chars = ''.join(sorted({re.escape(symbol[0]) for row in relations for symbol in row}))
+    if not first_chars:
+        return re.compile('(?!)')
+    return re.compile('(?=[' + first_chars + '])(?=' + groups + ')')
+
+
+RELATIONS = load_relations()
+RELATION_PATTERN = compile_relations(RELATIONS)
 
 
 def fix_equations(eqn: str) -> str:
@@ -18,231 +70,126 @@ def fix_equations(eqn: str) -> str:
             s = s.replace(old, new)
         return s
 
-    def brace_depth(s: str, index: int) -> int:
-        depth = 0
-        for i, char in enumerate(s):
-            if i == index:
-                break
-            if char == '{':
-                depth += 1
-            elif char == '}':
-                depth -= 1
-        return depth
-    
-    def left_right_depth(s: str, index: int) -> int:
-        """Returns how deep I am, left to right
-        Assume the start token is the backslash, and
-        we count everything BEFORE index
-        """
-        depth = 0
-        left = "\\left"
-        right = "\\right"
-        longer = max(len(left), len(right))
-        for i, _ in enumerate(s):
-            if i == index:
-                return depth
-            if s[i:longer].startswith(left):
-                depth += 1
-            elif s[i:longer].startswith(right):
-                depth -= 1
-        return depth
-
-    def fix_vectors_again(txt: str) -> str:
-        arg1 = "overset{⃑}"
-        replace1 = "mathbf"
-        x = re.sub("\\\\" + arg1, "\\\\" + replace1, txt)
-        return x
-
     def fix_accents(text: str) -> str:
         """Fix accents causing problems.
-        """
-
-        def find_next_closing_bracket(text_fncb: str, index: int) -> int:
-            """Find the next closing bracket.
-            Preconditions:
-                - text[index] != '{' or text[index] != '}'
-
-            Return -1 on failure.
-            """
-            skip_fncb = 1
-            while True:
-                ind = find_nth(text_fncb, '}', skip_fncb, index)
-                if ind == -1:
-                    return -1
-                if text_fncb[ind - 1] == '\\':
-                    skip_fncb += 1
-                    continue
-                if bracket_layers(text_fncb, ind, starting_index=index) != -1:
-                    skip_fncb += 1
-                    continue
-                else:
-                    return ind
-
-        def local_env_end(text_local_env_end: str, index: int) -> int:
-            """Return the position of the closing brace where the local environment ends.
-
-            It is strongly recommended that text[index] == '\\' and
-            is the start of a local environment declaration. Though the farthest
-            index can be is at the position of the opening brace.
-
-            Raise ValueError if an end cannot be found.
-            """
-            n = 1
-            while True:
-                closest_bracket = find_nth(text_local_env_end, '}', n, index)
-                if closest_bracket == -1:
-                    raise ValueError("Opening bracket without a closing bracket detected")
-                b_layer = bracket_layers(text_local_env_end, closest_bracket, starting_index=index)
-                if b_layer == 0:
-                    # cur_ind = closest_bracket
-                    break
-                else:
-                    n += 1
-            return closest_bracket
-
-        # Underbrace
-        skip = 1
-        while True:
-            # pattern:
-            # \overset{above}{︸}
-            overset_ind = find_nth(text, '\\overset', skip)
-            if overset_ind == -1:
-                break
-            overset_end = local_env_end(text, overset_ind)
-            contents = text[overset_ind + len('\\overset') + 1:overset_end]
-            if text[overset_end:overset_end + 5] == '}{︸}}':
-                text = text[:overset_ind] + '\\underbrace{' + contents + '}}' + text[overset_end + 5:]
-            else:
-                skip += 1
-
-        # weird left arrow
-        text = text.replace(R'\overset{⃐}', R'\mathbf')
-        # print(x)
-
-        # overleftrightarrow
-        skip = 1
-        while True:
-            over_lra = '\\overleftrightarrow{}}{'
-            os_ind = find_nth(text, '\\overset{', skip)
-            if os_ind == -1:
-                break
-            os_ind_after = os_ind + len('\\overset{')
-            if text[os_ind_after:os_ind_after + len(over_lra)] == '\\overleftrightarrow{}}{':
-                ending = find_next_closing_bracket(text, os_ind_after + len(over_lra))
-                assert ending != -1
-                contents = text[os_ind_after + len(over_lra):ending]
-                text = text[:os_ind] + '\\overleftrightarrow{' + contents + text[ending:]
-            else:
-                skip += 1
-        return text
 
-    def aug_matrix_spacing(__text: str) -> str:
-        """Spaces all augmented matrices.
+        This tokenizes text once, rewrites it with ACCENT_RULES
+        in a single walk and puts it back together once.
         """
-        __old = R'\end{matrix}\mid\begin{matrix}'
-        __new = R'\end{matrix}\;\middle|\;\begin{matrix}'
-        return __text.replace(__old, __new)
+        return detokenize_latex(rewrite_latex(tokenize_latex(text), ACCENT_RULES))
 
     def fix_equation_align_case(eqn_al: str) -> str:
         """Repair the equation, if applicable"""
-
-
         eqn_al = eqn_al.strip()
-        max_len = 9999999999
 
         if len(eqn_al) == 0 or eqn_al[0] != "{":
-            tm = None
             return eqn_al
 
-        def extract_ms_equation_substrings(s_sub: str) -> list[str]:
-            """Convert an equation in MS Word form with no conflicting braces
-            into a list of equations.
-            ASSUMPTIONS: No spaces, well-formed
-            If the equation isn't well-formed, immediately give up.
-            """
-            stack = []
-            result = []
-            depth = 0
-            previous_char = None
-            for i_ex_substr, char in enumerate(s_sub):
-                if char == '{':
-                    if depth == 0:
-                        if previous_char != "}" and previous_char is not None:
-                            return []
-                        stack.append('')
-                    else:
-                        stack[-1] += char
-                    depth += 1
-                elif char == '}':
-                    depth -= 1
-                    if depth == 0 and stack:
-                        result.append(stack.pop())
-                    elif stack:
-                        stack[-1] += char
-                elif stack:
-                    stack[-1] += char
-                else:
-                    if previous_char == '}' and (char == '_' or char == '^'): 
-                        return [s_sub]
-                    result.append(s_sub[i_ex_substr:])
-                    return result
-                previous_char = char
-            return result
-
-        sub_strs = extract_ms_equation_substrings(eqn_al)
-        return generate_align_from_equations(sub_strs)
-
-    def generate_align_from_equations(sub_strs: list[str]) -> str:
-
-        if len(sub_strs) <= 1:
-            if len(sub_strs) == 1:
-                return sub_strs[0]
+        return generate_align_from_equations(eqn_al, extract_ms_equation_spans(eqn_al))
+
+    def extract_ms_equation_spans(s_sub: str) -> list[tuple[int, int]]:
+        """Convert an equation in MS Word form with no conflicting braces
+        into the (start, end) spans of its equations in s_sub, so none
+        of them are copied until the output is put together.
+        ASSUMPTIONS: No spaces, well-formed
+        If the equation isn't well-formed, immediately give up.
+
+        Only the braces are looked at one by one; the text between them
+        is skipped over.
+        """
+        spans = []
+        depth = 0
+        row_start = -1  # where the equation being read starts, or -1 between equations
+        pos = 0  # everything before pos has been looked at
+        for match in _RAW_BRACE.finditer(s_sub):
+            i = match.start()
+            if i > pos and row_start == -1:
+                break  # text between equations; handled below
+            if s_sub[i] == '{':
+                if depth == 0:
+                    if i > 0 and s_sub[i - 1] != '}':
+                        return []
+                    row_start = i + 1
+                elif row_start == -1:
+                    return [(0, len(s_sub))]  # more closing braces than opening ones
+                depth += 1
             else:
-                return ""
-
-        str_builder = []
-
-        def add_and_to_symbol(text: str) -> str:
-            hierarchy = [
-                ["\\iff", "\\Leftrightarrow", "\\Rightarrow", "\\implies", "\\Leftarrow"],
-                ['<', '>', '\\leq', '\\geq', '\\approx'],
-                ['\\subset', '\\subseteq', '\\not\\subset'],
-                ['\\neq']
-            ]
-            target_index = 0  # start replacing BEFORE that index
-            target_precedence = len(hierarchy) - 1
-            for j, _ in enumerate(text):
-                if brace_depth(text, j) == 0 and left_right_depth(text, j):
-                    for k, row in enumerate(hierarchy):
-                        if k > target_precedence:
-                            continue
-                        for symbol in row:
-                            if text[j:].startswith(symbol):
-                                target_index = j
-                                target_precedence = k
-            return text[:target_index] + f" &" + text[target_index:]
-
-        for i, line in enumerate(sub_strs):
-            last = i == len(sub_strs) - 1
-            trailing = R" \\" if not last else ""
-            string_so_far = add_and_to_symbol(line)
-            str_builder.append(string_so_far + trailing)
-        return "\\begin{aligned}\n" + "\n".join(str_builder) + "\n\\end{aligned}"
-
-    eqn = multi_replace(eqn, [
-        ("\n", " "),
-        (R"\{", R"\lbrace"), (R"\}", R"\rbrace"),
-        ('≢', '\\not\\equiv '),
-        ("\\overrightarrow", "\\vec")
-    ])
-
-    eqn = fix_vectors_again(eqn)
+                depth -= 1
+                if depth == 0 and row_start != -1:
+                    spans.append((row_start, i))
+                    row_start = -1
+            pos = i + 1
+        if pos < len(s_sub) and row_start == -1:
+            # what comes after the last equation is the last equation, unless
+            # it's a sub/superscript of the one before
+            if s_sub[pos - 1] == '}' and s_sub[pos] in '_^':
+                return [(0, len(s_sub))]
+            spans.append((pos, len(s_sub)))
+        return spans
+
+    def replace_symbols(text: str) -> str:
+        """Makes the replacements in eqn_rules.json. str.replace hands back
+        the same string when there's nothing to replace, so this only
+        copies the equation for the rules that match it.
+        """
+        return multi_replace(text, SYMBOL_RULES)
+
+    if _profiler is not None:
+        return _profiler.run(eqn, (
+            ('multi_replace', replace_symbols),
+            ('fix_accents', fix_accents),
+            ('fix_equation_align_case', fix_equation_align_case),
+        )) + "  "
+
+    eqn = replace_symbols(eqn)
     eqn = fix_accents(eqn)
-    eqn = aug_matrix_spacing(eqn)
     eqn = fix_equation_align_case(eqn)
     return eqn + "  "
 
 
+def generate_align_from_equations(text: str, spans: list[tuple[int, int]]) -> str:
+    """Return the equations at spans in text as the rows of an aligned
+    environment, or the one equation as it is if there is only one."""
+    if len(spans) <= 1:
+        if len(spans) == 1:
+            return text[spans[0][0]:spans[0][1]]
+        else:
+            return ""
+
+    def alignment_point(start: int, end: int) -> int:
+        """Return where the & goes in text[start:end]: before the last
+        top-level relation of the highest precedence, or at start.
+        Depths are counted from start, as if text[start:end] stood alone.
+        """
+        target_index = start  # start replacing BEFORE that index
+        target_precedence = len(RELATIONS) - 1
+        brace, left_right = depths.brace, depths.left_right
+        base_brace, base_left_right = brace[start], left_right[start]
+        for match in RELATION_PATTERN.finditer(text, start, end):
+            j = match.start()
+            if brace[j] == base_brace and left_right[j] == base_left_right:
+                precedence = match.lastindex - 1
+                if precedence <= target_precedence:
+                    target_index = j
+                    target_precedence = precedence
+        return target_index
+
+    depths = DepthIndex(text)
+    pieces = ["\\begin{aligned}\n"]
+    for i, (start, end) in enumerate(spans):
+        check_deadline()
+        if i > 0:
+            pieces.append(" \\\\\n")
+        target = alignment_point(start, end)
+        pieces += [text[start:target], " &", text[target:end]]
+    pieces.append("\n\\end{aligned}")
+    return "".join(pieces)
+
+
+# Every brace, escaped or not, since MS Word's {row}{row} form is split on raw braces
+_RAW_BRACE = re.compile('[{}]')
+
+
 def find_nth(haystack: str, needle: str, __n: int, starter: Optional[int] = None, end: Optional[int] = None) -> int:
     """Needle in a haystack but awesome
     Return -1 on failure
@@ -299,15 +246,712 @@ def bracket_layers(text_bl: str, index: int,
         raise IndexError('Your index was out of bounds.')
 
 
+class DepthIndex:
+    """The brace depth and the \\left / \\right depth of every index in text,
+    built with a single pass over text.
+
+    brace[i] and left_right[i] count everything BEFORE index i, so both lists
+    have len(text) + 1 entries. Escaped braces (\\{ and \\}) are not braces,
+    and commands that merely start with \\left or \\right, like \\leftarrow
+    or \\rightarrow, are not counted.
+
+    Rebuild the index whenever text changes.
+    """
+    text: str
+    brace: list[int]
+    left_right: list[int]
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        brace = [0] * (len(text) + 1)
+        left_right = [0] * (len(text) + 1)
+        b_depth = 0
+        lr_depth = 0
+        for i, char in enumerate(text):
+            if char == '{' or char == '}':
+                if i == 0 or text[i - 1] != '\\':
+                    if char == '{':
+                        check_deadline()
+                        b_depth += 1
+                    else:
+                        b_depth -= 1
+            elif char == '\\':
+                if text.startswith('\\left', i) and not _is_letter_at(text, i + 5):
+                    lr_depth += 1
+                elif text.startswith('\\right', i) and not _is_letter_at(text, i + 6):
+                    lr_depth -= 1
+            brace[i + 1] = b_depth
+            left_right[i + 1] = lr_depth
+        self.brace = brace
+        self.left_right = left_right
+
+
+def _is_letter_at(text: str, index: int) -> bool:
+    return index < len(text) and text[index].isalpha()
+
+
+class TexCommand:
+    """A LaTeX command, like \\overset. Also covers control symbols
+    like \\{ or \\, which are a backslash and one other character.
+    """
+    name: str
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+class TexText:
+    """A run of text without any backslashes or braces. A closing brace
+    with no opening brace is kept as its own TexText.
+    """
+    text: str
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class TexGroup:
+    """Everything between a pair of braces. closed is False
+    if the group was never closed in the source text.
+    """
+    children: list
+    closed: bool
+
+    def __init__(self, children: Optional[list] = None, closed: bool = True) -> None:
+        self.children = [] if children is None else children
+        self.closed = closed
+
+    def is_text(self, text: str) -> bool:
+        """Return True if and only if this group is closed and only contains text."""
+        return self.closed and len(self.children) == 1 \
+            and type(self.children[0]) == TexText and self.children[0].text == text
+
+
+TexToken = Union[TexCommand, TexText, TexGroup]
+
+# A rewrite rule is called with (siblings, i, parent) where siblings[i] is the
+# command the rule was registered for, and parent is the group siblings are
+# in (None at the top level). If the rule applies, it returns how many
+# siblings, starting at i, it replaces, and what to replace them with.
+# Otherwise, it returns None.
+RewriteRule = Callable[[list, int, Optional[TexGroup]], Optional[tuple[int, list]]]
+
+_TEX_TOKEN = re.compile(r'\\[A-Za-z]+|\\.|\\|[{}]|[^\\{}]+', re.DOTALL)
+
+
+def tokenize_latex(text: str) -> list[TexToken]:
+    """Split text into a tree of commands, groups and text in one pass.
+    detokenize_latex(tokenize_latex(text)) == text always holds.
+    """
+    root: list[TexToken] = []
+    groups: list[TexGroup] = []
+    current = root
+    for match in _TEX_TOKEN.finditer(text):
+        token = match.group()
+        if token == '{':
+            check_deadline()
+            group = TexGroup(closed=False)
+            current.append(group)
+            groups.append(group)
+            current = group.children
+        elif token == '}':
+            if groups:
+                groups.pop().closed = True
+                current = groups[-1].children if groups else root
+            else:
+                current.append(TexText(token))
+        elif token[0] == '\\':
+            current.append(TexCommand(token))
+        else:
+            current.append(TexText(token))
+    return root
+
+
+def detokenize_latex(tokens: list[TexToken]) -> str:
+    """Put tokens from tokenize_latex back together into a string."""
+    parts: list[str] = []
+
+    def emit(tokens_em: list[TexToken]) -> None:
+        for token in tokens_em:
+            if type(token) == TexGroup:
+                parts.append('{')
+                emit(token.children)
+                if token.closed:
+                    parts.append('}')
+            elif type(token) == TexCommand:
+                parts.append(token.name)
+            else:
+                parts.append(token.text)
+
+    emit(tokens)
+    return ''.join(parts)
+
+
+def rewrite_latex(tokens: list[TexToken], rules: dict[str, list[RewriteRule]],
+                  parent: Optional[TexGroup] = None) -> list[TexToken]:
+    """Walk tokens once and apply rules, which map command names to the
+    rules tried on that command, in order. The first rule that applies wins.
+    Rules are not tried again on what they return, but groups they return
+    are still walked.
+    """
+    result: list[TexToken] = []
+    i = 0
+    while i < len(tokens):
+        check_deadline()
+        token = tokens[i]
+        replaced = None
+        if type(token) == TexCommand and token.name in rules:
+            for rule in rules[token.name]:
+                replaced = rule(tokens, i, parent)
+                if replaced is not None:
+                    break
+        if replaced is None:
+            consumed, new_tokens = 1, [token]
+        else:
+            consumed, new_tokens = replaced
+        for new_token in new_tokens:
+            if type(new_token) == TexGroup:
+                new_token.children = rewrite_latex(new_token.children, rules, new_token)
+            result.append(new_token)
+        i += consumed
+    return result
+
+
+def _group_at(tokens: list[TexToken], i: int) -> Optional[TexGroup]:
+    if i < len(tokens) and type(tokens[i]) == TexGroup and tokens[i].closed:
+        return tokens[i]
+    return None
+
+
+def _vector_rule(tokens: list[TexToken], i: int, parent: Optional[TexGroup]) -> Optional[tuple[int, list]]:
+    """\\overset{⃑} --> \\mathbf"""
+    accent = _group_at(tokens, i + 1)
+    if accent is not None and accent.is_text('⃑'):
+        return 2, [TexCommand('\\mathbf')]
+    return None
+
+
+def _left_arrow_rule(tokens: list[TexToken], i: int, parent: Optional[TexGroup]) -> Optional[tuple[int, list]]:
+    """\\overset{⃐} --> \\mathbf"""
+    accent = _group_at(tokens, i + 1)
+    if accent is not None and accent.is_text('⃐'):
+        return 2, [TexCommand('\\mathbf')]
+    return None
+
+
+def _underbrace_rule(tokens: list[TexToken], i: int, parent: Optional[TexGroup]) -> Optional[tuple[int, list]]:
+    """\\overset{above}{︸}} --> \\underbrace{above}}
+
+    The closing brace right after {︸} has to be there.
+    """
+    above = _group_at(tokens, i + 1)
+    brace = _group_at(tokens, i + 2)
+    if above is None or brace is None or not brace.is_text('︸'):
+        return None
+    if i + 3 < len(tokens):
+        closed_after = type(tokens[i + 3]) == TexText and tokens[i + 3].text == '}'
+    else:
+        closed_after = parent is not None and parent.closed
+    if closed_after:
+        return 3, [TexCommand('\\underbrace'), above]
+    return None
+
+
+def _overleftrightarrow_rule(tokens: list[TexToken], i: int,
+                             parent: Optional[TexGroup]) -> Optional[tuple[int, list]]:
+    """\\overset{\\overleftrightarrow{}}{contents} --> \\overleftrightarrow{contents}"""
+    accent = _group_at(tokens, i + 1)
+    contents = _group_at(tokens, i + 2)
+    if accent is None or contents is None or len(accent.children) != 2:
+        return None
+    command, empty = accent.children
+    if type(command) == TexCommand and command.name == '\\overleftrightarrow' \
+            and type(empty) == TexGroup and empty.closed and not empty.children:
+        return 3, [command, contents]
+    return None
+
+
+def _overrightarrow_rule(tokens: list[TexToken], i: int, parent: Optional[TexGroup]) -> Optional[tuple[int, list]]:
+    """\\overrightarrow --> \\vec"""
+    return 1, [TexCommand('\\vec')]
+
+
+# Rules fix_accents applies, by the command they start at. To handle another
+# quirk in how pandoc reads MS Word equations, add a rule here instead of
+# another pass over the equation.
+ACCENT_RULES: dict[str, list[RewriteRule]] = {
+    '\\overset': [_vector_rule, _underbrace_rule, _left_arrow_rule, _overleftrightarrow_rule],
+    '\\overrightarrow': [_overrightarrow_rule],
+}
+
+
+# Fixing an equation may take at most MS_WORD_EQN_MAX_SECONDS seconds (default 5,
+# 0 for no limit). An equation that takes longer, or that fix_equations fails
+# on, is left as it is, so one bad equation can't hold up or stop a whole
+# document. Each one is reported on stderr, and listed once the filter is done.
+MAX_SECONDS_ENV = 'MS_WORD_EQN_MAX_SECONDS'
+DEFAULT_MAX_SECONDS = 5.0
+
+
+class EquationTooSlow(Exception):
+    """Raised when fixing an equation goes past its deadline."""
+
+
+# When the equation being fixed has to be done by, or None if there's no limit
+_deadline: Optional[float] = None
+
+
+def check_deadline() -> None:
+    """Raise EquationTooSlow if the equation being fixed is out of time.
+    fix_equations calls this as it goes, so it stops soon after."""
+    if _deadline is not None and time.perf_counter() > _deadline:
+        raise EquationTooSlow()
+
+
+def fix_equation_guarded(eqn: str, max_seconds: Optional[float] = None) -> tuple[str, Optional[str]]:
+    """Return (fix_equations(eqn), None), or (eqn, why) if fixing eqn took
+    longer than max_seconds (MS_WORD_EQN_MAX_SECONDS by default) or failed.
+    """
+    global _deadline
+    if max_seconds is None:
+        max_seconds = float(os.environ.get(MAX_SECONDS_ENV, DEFAULT_MAX_SECONDS))
+    _deadline = time.perf_counter() + max_seconds if max_seconds > 0 else None
+    try:
+        return fix_equations(eqn), None
+    except EquationTooSlow:
+        return eqn, f'took longer than {max_seconds:g} s'
+    except Exception as error:  # malformed equations can trip up any stage
+        return eqn, f'{type(error).__name__}: {error}'
+    finally:
+        _deadline = None
+
+
+def shorten(text: str, width: int = 120) -> str:
+    return text if len(text) <= width else text[:width - 3] + '...'
+
+
+# The equations left as they are in this document, and why
+_gave_up: list[tuple[str, str]] = []
+
+
+def record_gave_up(eqn: str, why: str) -> None:
+    _gave_up.append((eqn, why))
+    print(f'[ms_word_eqn_filter] left an equation as it is ({why}): {shorten(eqn)}', file=sys.stderr)
+
+
+def finish_equation_guard(doc: Any = None) -> None:
+    """List the equations that were left as they are, if any."""
+    if not _gave_up:
+        return
+    lines = [f'[ms_word_eqn_filter] {len(_gave_up)} equations were left as they are:']
+    lines.extend(f'  {why}: {shorten(eqn)}' for eqn, why in _gave_up)
+    print('\n'.join(lines), file=sys.stderr)
+    _gave_up.clear()
+
+
+# The in-process cache holds this many equations (MS_WORD_EQN_CACHE_SIZE).
+# If MS_WORD_EQN_CACHE_DIR (or MS_WORD_CACHE_DIR, see fragment_cache.py) is set,
+# fixed equations are also kept on disk there between runs. If MS_WORD_EQN_VERBOSE
+# is set, cache hits and misses are reported on stderr once the filter is done.
+CACHE_SIZE_ENV = 'MS_WORD_EQN_CACHE_SIZE'
+CACHE_DIR_ENV = 'MS_WORD_EQN_CACHE_DIR'
+VERBOSE_ENV = 'MS_WORD_EQN_VERBOSE'
+DEFAULT_CACHE_SIZE = 4096
+
+# Equations that aren't cached are fixed on MS_WORD_EQN_WORKERS processes
+# (default: one per CPU) once they add up to MS_WORD_EQN_PARALLEL_MIN characters,
+# since below that starting the processes takes longer than it saves.
+WORKERS_ENV = 'MS_WORD_EQN_WORKERS'
+PARALLEL_MIN_ENV = 'MS_WORD_EQN_PARALLEL_MIN'
+DEFAULT_PARALLEL_MIN = 100_000
+
+# Changes whenever this file changes, so the disk cache never
+# hands back what an older version of fix_equations returned.
+FILTER_VERSION = source_version(__file__) + source_version(SYMBOL_RULES_FILE)
+
+
+class EquationCache:
+    """Remembers what fix_equations returned for each equation, since
+    documents repeat the same inline symbols over and over.
+
+    The least recently used equations are forgotten once there are more
+    than max_size of them. If disk is given, fixed equations are also
+    stored there, keyed by the equation and FILTER_VERSION, so the next
+    run can skip them too.
+    """
+    max_size: int
+    memo: OrderedDict
+    disk: Optional[FragmentCache]
+    hits: int
+    misses: int
+    disk_hits: int
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE, disk: Optional[FragmentCache] = None) -> None:
+        self.max_size = max_size
+        self.memo = OrderedDict()
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    def fix(self, eqn: str) -> str:
+        """Same as fix_equations(eqn), or eqn if fix_equation_guarded gave up on it."""
+        fixed = self.lookup(eqn)
+        if fixed is None:
+            fixed, why = fix_equation_guarded(eqn)
+            self.settle(eqn, fixed, why)
+        return fixed
+
+    def fix_many(self, eqns: Iterable[str], workers: int = 1,
+                 parallel_min: int = DEFAULT_PARALLEL_MIN) -> dict[str, str]:
+        """Fix every equation in eqns and return what each one became.
+
+        Each distinct equation is only looked up or fixed once. The ones
+        that aren't cached are fixed together by fix_equations_in_parallel.
+        """
+        fixed = {}
+        todo = []
+        for eqn in eqns:
+            if eqn in fixed:
+                self.hits += 1
+                continue
+            known = self.lookup(eqn)
+            if known is None:
+                todo.append(eqn)
+                fixed[eqn] = ''
+            else:
+                fixed[eqn] = known
+        for eqn, (out, why) in zip(todo, fix_equations_in_parallel(todo, workers, parallel_min)):
+            self.settle(eqn, out, why)
+            fixed[eqn] = out
+        return fixed
+
+    def lookup(self, eqn: str) -> Optional[str]:
+        """Return the fixed eqn from memory or disk, or None if it has to be fixed."""
+        fixed = self.memo.get(eqn)
+        if fixed is not None:
+            self.hits += 1
+            self.memo.move_to_end(eqn)
+            return fixed
+        self.misses += 1
+        if self.disk is not None:
+            fixed = self.disk.get('Math', FILTER_VERSION, eqn)
+            if fixed is not None:
+                self.disk_hits += 1
+                self.remember(eqn, fixed)
+        return fixed
+
+    def settle(self, eqn: str, fixed: str, why: Optional[str]) -> None:
+        """Keep what fix_equation_guarded returned. Equations it gave up on
+        are only remembered for this run, since they may not time out next time."""
+        if why is None:
+            self.store(eqn, fixed)
+        else:
+            record_gave_up(eqn, why)
+            self.remember(eqn, fixed)
+
+    def store(self, eqn: str, fixed: str) -> None:
+        if self.disk is not None:
+            self.disk.put('Math', FILTER_VERSION, eqn, fixed)
+        self.remember(eqn, fixed)
+
+    def remember(self, eqn: str, fixed: str) -> None:
+        self.memo[eqn] = fixed
+        if len(self.memo) > self.max_size:
+            self.memo.popitem(last=False)
+
+    def flush(self) -> None:
+        """Write everything new to disk, if there is a disk cache."""
+        if self.disk is not None:
+            self.disk.flush()
+
+    def report(self) -> str:
+        return (f'[ms_word_eqn_filter] cache: {self.hits} hits, {self.misses} misses '
+                f'({self.disk_hits} of those found on disk), {len(self.memo)} equations in memory')
+
+
+_equation_cache: Optional[EquationCache] = None
+
+
+def get_equation_cache() -> EquationCache:
+    """Return the cache fix_equations_pf uses, making it from the
+    environment variables above the first time.
+    """
+    global _equation_cache
+    if _equation_cache is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+        disk = open_fragment_cache(cache_dir) if cache_dir else get_fragment_cache()
+        _equation_cache = EquationCache(int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE)), disk)
+    return _equation_cache
+
+
+def peek_equation_cache() -> Optional[EquationCache]:
+    """Return the cache if get_equation_cache has made it, without making it."""
+    return _equation_cache
+
+
+def fix_equations_in_parallel(eqns: list[str], workers: int = 1,
+                              parallel_min: int = DEFAULT_PARALLEL_MIN) -> list[tuple[str, Optional[str]]]:
+    """Return [fix_equation_guarded(eqn) for eqn in eqns], fixed on a pool of
+    workers processes if eqns add up to at least parallel_min characters.
+
+    While profiling, everything is fixed in this process, so the
+    profiler sees every equation.
+    """
+    if workers <= 1 or _profiler is not None or sum(map(len, eqns)) < parallel_min:
+        return [fix_equation_guarded(eqn) for eqn in eqns]
+    # A few chunks per worker, so one slow chunk doesn't hold up the rest
+    chunksize = max(1, len(eqns) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fix_equation_guarded, eqns, chunksize=chunksize))
+
+
+def finish_equation_cache(doc: Any = None) -> None:
+    """Save the disk cache and report cache hits if MS_WORD_EQN_VERBOSE is set.
+    The cache is kept, so a process that filters several documents
+    keeps the equations it has already fixed.
+    """
+    if _equation_cache is None:
+        return
+    _equation_cache.flush()
+    if os.environ.get(VERBOSE_ENV):
+        print(_equation_cache.report(), file=sys.stderr)
+
+
+# If MS_WORD_EQN_PROFILE (or the ms-word-eqn-profile metadata field) is set,
+# fix_equations times each of its stages on each equation, and the stages and
+# the MS_WORD_EQN_PROFILE_TOP slowest equations are reported once the filter
+# is done: on stderr, or in a JSON file if the setting ends with .json.
+# Equations found in the cache aren't fixed again, so they aren't timed.
+PROFILE_ENV = 'MS_WORD_EQN_PROFILE'
+PROFILE_TOP_ENV = 'MS_WORD_EQN_PROFILE_TOP'
+PROFILE_META = 'ms-word-eqn-profile'
+DEFAULT_PROFILE_TOP = 10
+
+
+class EquationProfiler:
+    """Times every stage of fix_equations, adding up the time and the
+    characters in and out of each stage, and keeps the top_n slowest equations.
+    """
+    top_n: int
+    output: Optional[str]
+    equations: int
+    seconds: float
+    stages: dict[str, dict[str, float]]
+    slowest: list[tuple[float, int, dict]]
+
+    def __init__(self, top_n: int = DEFAULT_PROFILE_TOP, output: Optional[str] = None) -> None:
+        self.top_n = top_n
+        self.output = output
+        self.equations = 0
+        self.seconds = 0.0
+        self.stages = {}
+        self.slowest = []
+
+    def run(self, eqn: str, stages: Iterable[tuple[str, Callable[[str], str]]]) -> str:
+        """Run eqn through stages like fix_equations does, timing each one."""
+        source = eqn
+        record = {}
+        total = 0.0
+        for name, stage in stages:
+            start = time.perf_counter()
+            out = stage(eqn)
+            elapsed = time.perf_counter() - start
+            total += elapsed
+            record[name] = {'seconds': elapsed, 'chars_in': len(eqn), 'chars_out': len(out)}
+            totals = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'chars_in': 0, 'chars_out': 0})
+            totals['seconds'] += elapsed
+            totals['calls'] += 1
+            totals['chars_in'] += len(eqn)
+            totals['chars_out'] += len(out)
+            eqn = out
+        self.equations += 1
+        self.seconds += total
+        entry = (total, self.equations, {'equation': source, 'seconds': total, 'stages': record})
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, entry)
+        elif self.top_n > 0 and total > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+        return eqn
+
+    def summary(self) -> dict:
+        return {'equations': self.equations, 'seconds': self.seconds, 'stages': self.stages,
+                'slowest': [entry[2] for entry in sorted(self.slowest, reverse=True)]}
+
+    def report(self) -> str:
+        lines = [f'[ms_word_eqn_filter] profile: {self.equations} equations fixed '
+                 f'in {self.seconds * 1e3:.1f} ms',
+                 f'  {"stage":<24} {"ms":>9} {"share":>6} {"chars in":>10} {"chars out":>10}']
+        for name, totals in self.stages.items():
+            share = totals['seconds'] / self.seconds if self.seconds else 0.0
+            lines.append(f'  {name:<24} {totals["seconds"] * 1e3:9.2f} {share:6.1%} '
+                         f'{totals["chars_in"]:10} {totals["chars_out"]:10}')
+        lines.append(f'  slowest {len(self.slowest)} equations:')
+        for entry in self.summary()['slowest']:
+            stage = max(entry['stages'], key=lambda name: entry['stages'][name]['seconds'])
+            lines.append(f'  {entry["seconds"] * 1e3:9.2f} ms (mostly {stage})  {shorten(entry["equation"])}')
+        return '\n'.join(lines)
+
+
+_profiler: Optional[EquationProfiler] = None
+
+
+def start_equation_profile(doc: Any = None) -> None:
+    """Turn the profiler on if MS_WORD_EQN_PROFILE or the metadata field asks for it."""
+    global _profiler
+    setting = os.environ.get(PROFILE_ENV)
+    if not setting and doc is not None:
+        setting = doc.get_metadata(PROFILE_META, None)
+    if not setting or str(setting).lower() in ('0', 'false', 'no'):
+        return
+    output = setting if isinstance(setting, str) and setting.endswith('.json') else None
+    _profiler = EquationProfiler(int(os.environ.get(PROFILE_TOP_ENV, DEFAULT_PROFILE_TOP)), output)
+
+
+def finish_equation_profile(doc: Any = None) -> None:
+    """Report what the profiler found, and turn it off."""
+    global _profiler
+    if _profiler is None:
+        return
+    if _profiler.output is not None:
+        with open(_profiler.output, 'w', encoding='utf-8') as f:
+            json.dump(_profiler.summary(), f, ensure_ascii=False, indent=2)
+    else:
+        print(_profiler.report(), file=sys.stderr)
+    _profiler = None
+
+
+def start_equation_filter(doc: Any = None) -> None:
+    start_equation_profile(doc)
+    doc.ms_word_equations = []
+    doc.ms_word_note_equations = set()
+
+
+def finish_equation_filter(doc: Any = None) -> None:
+    """Fix the equations collect_equations found, if any,
+    then save the cache and report."""
+    if hasattr(doc, 'ms_word_equations'):
+        fix_collected_equations(doc)
+    finish_equation_guard(doc)
+    finish_equation_cache(doc)
+    finish_equation_profile(doc)
+
+
 def fix_equations_pf(elem: Any, doc: Any):
-    if type(elem) == Math:
+    if elem.tag == 'Math':
         txt = elem.text
-        elem.text = fix_equations(txt)
+        elem.text = get_equation_cache().fix(txt)
     return elem
 
 
+def collect_equations(elem: Any, doc: Any) -> None:
+    """Instead of fixing each equation as it's found, keep it in
+    doc.ms_word_equations so fix_collected_equations can fix them all at once."""
+    if elem.tag == 'Math':
+        doc.ms_word_equations.append(elem)
+    elif elem.tag == 'Note':
+        in_note = []
+        elem.walk(lambda child, doc: in_note.append(child) if child.tag == 'Math' else None)
+        mark_note_equations(doc, len(in_note))
+
+
+def mark_note_equations(doc: Any, count: int) -> None:
+    """Remember that the last count equations collected are in a footnote.
+    The walk reaches a note right after everything in it, and footnotes
+    aren't in word/document.xml, so omml_reader.py has to skip them."""
+    collected = len(doc.ms_word_equations)
+    doc.ms_word_note_equations.update(range(collected - count, collected))
+
+
+class RawMath:
+    """A Math element's JSON, with a text attribute like panflute's Math,
+    so fix_collected_equations can fix it the same way."""
+    __slots__ = ('content',)
+
+    def __init__(self, elem: dict) -> None:
+        self.content = elem['c']
+
+    @property
+    def text(self) -> str:
+        return self.content[1]
+
+    @text.setter
+    def text(self, text: str) -> None:
+        self.content[1] = text
+
+    @property
+    def format(self) -> str:
+        return self.content[0]['t']
+
+
+def collect_equations_raw(elem: dict, doc: Any) -> None:
+    """Same as collect_equations, on a Math element's JSON."""
+    doc.ms_word_equations.append(RawMath(elem))
+
+
+def count_math_raw(value: Any) -> int:
+    if isinstance(value, list):
+        return sum(count_math_raw(item) for item in value)
+    if isinstance(value, dict):
+        return 1 if value.get('t') == 'Math' else count_math_raw(value.get('c'))
+    return 0
+
+
+def mark_note_equations_raw(elem: dict, doc: Any) -> None:
+    """Same as collect_equations on a Note, on its JSON."""
+    mark_note_equations(doc, count_math_raw(elem['c']))
+
+
+# If the ms-word-docx metadata field (or MS_WORD_DOCX) is the .docx pandoc
+# is reading, the equations are translated straight from it by omml_reader.py
+# instead, and only the ones it can't translate are fixed by fix_equations.
+# The metadata field, which belongs to one document, wins over MS_WORD_DOCX,
+# which applies to every document the process filters.
+DOCX_META = 'ms-word-docx'
+DOCX_ENV = 'MS_WORD_DOCX'
+
+
+def read_docx_equations(doc: Any, equations: list, in_notes: set[int]) -> dict[int, str]:
+    """Return the LaTeX omml_reader.py translated, by the index of the
+    equation in equations it's for."""
+    path = doc.get_metadata(DOCX_META, None) or os.environ.get(DOCX_ENV)
+    if not path:
+        return {}
+    from omml_reader import translate_equations
+    in_body = [i for i in range(len(equations)) if i not in in_notes]
+    translated = translate_equations(path, [(equations[i].format == 'DisplayMath', equations[i].text)
+                                            for i in in_body])
+    if translated is None:
+        return {}
+    return {i: latex for i, latex in zip(in_body, translated) if latex is not None}
+
+
+def fix_collected_equations(doc: Any) -> None:
+    equations = doc.ms_word_equations
+    in_notes = doc.ms_word_note_equations
+    del doc.ms_word_equations
+    del doc.ms_word_note_equations
+    translated = read_docx_equations(doc, equations, in_notes)
+    to_fix = [elem for i, elem in enumerate(equations) if i not in translated]
+    fixed = get_equation_cache().fix_many([elem.text for elem in to_fix],
+                                          int(os.environ.get(WORKERS_ENV, os.cpu_count() or 1)),
+                                          int(os.environ.get(PARALLEL_MIN_ENV, DEFAULT_PARALLEL_MIN)))
+    for elem in to_fix:
+        elem.text = fixed[elem.text]
+    for i, latex in translated.items():
+        equations[i].text = latex
+
+
+RAW_ACTIONS = {'Math': [collect_equations_raw], 'Note': [mark_note_equations_raw]}
+
+
 def main(doc: Any = None) -> Any:
-    return run_filter(fix_equations_pf, doc=doc)
+    """Without a doc, the filter runs over the raw JSON (see raw_filter.py),
+    and panflute isn't imported at all."""
+    if doc is None:
+        return run_raw_filters(RAW_ACTIONS, prepare=start_equation_filter, finalize=finish_equation_filter)
+    from panflute import run_filter
+    return run_filter(collect_equations, prepare=start_equation_filter, finalize=finish_equation_filter, doc=doc)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""Python version of no_longtable.lua: for conversions to LaTeX,
+writes tables as tabular environments instead of longtables.
+
+Every cell of a table is written to LaTeX in a single call to
+pandoc, rather than one per cell, and cells that repeat are only
+written once. If MS_WORD_CACHE_DIR is set,
+tables are looked up in the fragment cache (see fragment_cache.py)
+by their JSON, so unchanged tables skip pandoc entirely.
+"""
+
+
+import json
+from typing import Any
+
+import panflute as pf
+
+from fragment_cache import finish_fragment_cache, get_fragment_cache, source_version
+
+FILTER_VERSION = source_version(__file__)
+ALIGNMENTS = {'AlignLeft': 'l', 'AlignRight': 'r'}
+HEADER_INCLUDES = ['\\usepackage{makecell}', '\\usepackage{graphicx}']
+# Goes between cells when they're written out together
+CELL_MARKER = '%%no_longtable-cell%%'
+
+
+def is_latex(doc: pf.Doc) -> bool:
+    return doc.format is not None and 'latex' in doc.format
+
+
+def add_header_includes(doc: pf.Doc) -> None:
+    includes = doc.metadata.content.get('header-includes')
+    if includes is None:
+        doc.metadata['header-includes'] = pf.MetaBlocks(*(pf.RawBlock(line, format='latex')
+                                                          for line in HEADER_INCLUDES))
+        return
+    if not isinstance(includes, pf.MetaList):
+        includes = pf.MetaList(includes)
+    for line in HEADER_INCLUDES:
+        includes.append(pf.MetaBlocks(pf.RawBlock(line, format='latex')))
+    doc.metadata['header-includes'] = includes
+
+
+def blocks_to_inlines(blocks: list) -> list:
+    """Same as pandoc.utils.blocks_to_inlines in Lua."""
+    inlines = []
+    for i, block in enumerate(blocks):
+        if i > 0:
+            inlines.append(pf.LineBreak())
+        inlines.extend(block_to_inlines(block))
+    return inlines
+
+
+def block_to_inlines(block: pf.Element) -> list:
+    if isinstance(block, (pf.Plain, pf.Header)):
+        return list(block.content)
+    if isinstance(block, pf.Para):
+        return list(block.content)
+    if isinstance(block, pf.LineBlock):
+        inlines = []
+        for i, line in enumerate(block.content):
+            if i > 0:
+                inlines.append(pf.LineBreak())
+            inlines.extend(line.content)
+        return inlines
+    if isinstance(block, pf.CodeBlock):
+        return [pf.Code(block.text, block.identifier, block.classes, block.attributes)]
+    if isinstance(block, pf.RawBlock):
+        return [pf.RawInline(block.text, block.format)]
+    if isinstance(block, (pf.BlockQuote, pf.Div)):
+        return blocks_to_inlines(block.content)
+    if isinstance(block, (pf.BulletList, pf.OrderedList)):
+        return [inline for item in block.content for inline in blocks_to_inlines(item.content)]
+    if isinstance(block, pf.DefinitionList):
+        inlines = []
+        for item in block.content:
+            inlines.extend(item.term)
+            for definition in item.definitions:
+                inlines.extend(blocks_to_inlines(definition.content))
+        return inlines
+    if hasattr(pf, 'Figure') and isinstance(block, pf.Figure):
+        return blocks_to_inlines(block.content)
+    return []
+
+
+def render_cells(cells: list) -> list[str]:
+    """Write every cell to LaTeX in one go, the same way no_longtable.lua does.
+    Cells with the same contents are only written once."""
+    keys = []
+    unique = {}
+    blocks = []
+    for cell in cells:
+        if len(cell.content) == 0:
+            keys.append(None)
+            continue
+        para = pf.Para(*blocks_to_inlines(cell.content))
+        key = json.dumps(para.to_json())
+        if key not in unique:
+            unique[key] = len(unique)
+            blocks.append(pf.RawBlock(CELL_MARKER, format='latex'))
+            blocks.append(para)
+        keys.append(key)
+    latex = pf.convert_text(blocks, input_format='panflute', output_format='latex') if blocks else ''
+    written = [text.strip('\n').replace('\\[', '\\(').replace('\\]', '\\)')
+               for text in latex.split(CELL_MARKER)[1:]]
+    return ['' if key is None else '\\makecell{' + written[unique[key]] + '}' for key in keys]
+
+
+def table_to_latex(table: pf.Table) -> str:
+    align_str = '|' + '|'.join(ALIGNMENTS.get(align, 'c') for align, _ in table.colspec) + '|'
+    head_rows = list(table.head.content)
+    body_rows = [row for body in table.content for row in body.content]
+    rendered = iter(render_cells([cell for row in head_rows + body_rows for cell in row.content]))
+
+    def row_line(row: pf.TableRow) -> str:
+        return ' & '.join(next(rendered) for _ in row.content) + ' \\\\'
+
+    lines = ['\\begin{tabular}{' + align_str + '}', '\\hline']
+    lines.extend(row_line(row) for row in head_rows)
+    lines.append('\\hline')
+    for row in body_rows:
+        lines.append(row_line(row))
+        lines.append('\\hline')
+    lines.append('\\end{tabular}')
+
+    caption = pf.stringify(table.caption) if table.caption is not None else ''
+    if caption != '':
+        lines = ['\\begin{table}[h]', '\\centering', '\n'.join(lines),
+                 '\\caption{' + caption + '}', '\\end{table}']
+    return '\n'.join(lines)
+
+
+def replace_table(elem: pf.Element, doc: pf.Doc) -> Any:
+    if type(elem) != pf.Table or not is_latex(doc):
+        return None
+    cache = get_fragment_cache()
+    if cache is None:
+        return pf.RawBlock(table_to_latex(elem), format='latex')
+    source = json.dumps(elem.to_json())
+    latex = cache.get('Table', FILTER_VERSION, source)
+    if latex is None:
+        latex = table_to_latex(elem)
+        cache.put('Table', FILTER_VERSION, source, latex)
+    return pf.RawBlock(latex, format='latex')
+
+
+def prepare(doc: pf.Doc) -> None:
+    if is_latex(doc):
+        add_header_includes(doc)
+
+
+def main(doc: Any = None) -> Any:
+    return pf.run_filter(replace_table, prepare=prepare, finalize=finish_fragment_cache, doc=doc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,706 @@
+#!/usr/bin/env python
+
+"""Reads the equations of a .docx straight from Word's XML, and writes
+them as the LaTeX the equation filter would have made of them.
+
+pandoc turns Word equations (OMML) into LaTeX, and ms_word_eqn_filter.py
+then repairs what that loses: accents it can't write, braces it puts
+around the rows of a multi-line equation. This module streams
+word/document.xml out of the .docx with an incremental parser and
+translates each m:oMath or m:oMathPara directly, so it can write the
+repaired LaTeX in one go. Only the equation being translated is held in
+memory, so the document can be as large as it likes.
+
+Running the equation filter with the ms-word-docx metadata field (or
+MS_WORD_DOCX) set to the .docx pandoc is reading uses it:
+
+    pandoc word_file.docx -M ms-word-docx=word_file.docx -o output.pdf --filter=ms_word_eqn_filter.py
+
+The equations in the .docx are lined up with pandoc's, and none are used
+unless the .docx has as many as pandoc read. Each one is then only used
+if it matches the one pandoc read: inline or displayed like it, and with
+the same letters, digits and symbols in the same order. An equation that
+doesn't match, or that uses something this module doesn't translate, is
+fixed by fix_equations as before.
+
+The LaTeX is written the way pandoc writes it, using the characters in
+omml_symbols.json (made by benchmarks/make_omml_symbols.py), except
+where eqn_corpus.json records what Word equations looked like coming out
+of pandoc when the filter was written: delimiters are always \\left and
+\\right, | between them is \\mid, limits under and over are \\underset
+and \\overset, and other function names are \\operatorname.
+
+Run on its own, it prints the equations of a .docx:
+
+    python omml_reader.py word_file.docx
+"""
+
+
+import json
+import os
+import re
+import sys
+import zipfile
+from typing import Iterator, NamedTuple, Optional
+from xml.etree import ElementTree
+
+from ms_word_eqn_filter import SYMBOL_RULES, generate_align_from_equations
+
+M = '{http://schemas.openxmlformats.org/officeDocument/2006/math}'
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+MC = '{http://schemas.openxmlformats.org/markup-compatibility/2006}'
+
+DOCUMENT_XML = 'word/document.xml'
+SYMBOLS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'omml_symbols.json')
+VERBOSE_ENV = 'MS_WORD_EQN_VERBOSE'
+
+
+def load_symbols(path: str = SYMBOLS_FILE) -> dict[str, dict]:
+    """Return what pandoc writes for each character that it doesn't write
+    as it is, and whether it puts spaces around it, from the file at path."""
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+SYMBOLS = load_symbols()
+
+# Runs pandoc writes as a command when they're all that's in the run
+FUNCTIONS = {'arccos', 'arcsin', 'arctan', 'arg', 'cos', 'cosh', 'cot', 'coth', 'csc', 'deg', 'det', 'dim',
+             'exp', 'gcd', 'hom', 'inf', 'ker', 'lg', 'lim', 'liminf', 'limsup', 'ln', 'log', 'max', 'min',
+             'Pr', 'sec', 'sin', 'sinh', 'sup', 'tan', 'tanh'}
+
+# The command runs in each variant are written with (see run_variant).
+# Runs next to each other are only written together if their variant
+# is the same, so bold and bold italic runs are kept apart.
+VARIANTS = {'normal': '\\text', 'italic': '\\mathit', 'bold': '\\mathbf', 'bold-italic': '\\mathbf',
+            'double-struck': '\\mathbb', 'script': '\\mathcal', 'bold-script': '\\mathcal',
+            'fraktur': '\\mathfrak', 'bold-fraktur': '\\mathfrak', 'sans-serif': '\\mathsf',
+            'sans-serif-italic': '\\mathsf', 'sans-serif-bold': '\\mathbf',
+            'sans-serif-bold-italic': '\\mathbf', 'monospace': '\\mathtt'}
+
+# Accents by their character. The last four are what fix_equations
+# turns pandoc's \overset{⃑}, \overrightarrow and so on into.
+ACCENTS = {'\u0302': '\\widehat', 'ˆ': '\\widehat', '^': '\\hat', '\u0303': '\\widetilde', '˜': '\\widetilde',
+           '\u0304': '\\bar', '\u0305': '\\overline', '\u0307': '\\dot', '\u0308': '\\ddot', '\u20db': '\\dddot',
+           '\u030c': '\\check', '\u0306': '\\breve', '\u0301': '\\acute', '´': '\\acute', '\u0300': '\\grave',
+           '\u20d7': '\\vec', '\u20d1': '\\mathbf', '\u20d0': '\\mathbf', '\u20e1': '\\overleftrightarrow'}
+
+# The characters \left and \right take. Other delimiters are written
+# after \left. and \right. instead.
+DELIMITERS = set('()[]{}|‖⟨⟩〈〉⌊⌋⌈⌉')
+
+# Delimiters around nothing but a matrix, and the matrix they make
+MATRICES = {('(', ')'): 'pmatrix', ('[', ']'): 'bmatrix', ('{', '}'): 'Bmatrix'}
+
+# Symbols pandoc braces, like {\mathbb{R}}, unless they're all there is in braces already
+BRACED_SYMBOLS = {symbol['tex'] for symbol in SYMBOLS.values() if symbol['tex'].startswith('{')}
+
+# Arguments whose runs pandoc writes one by one, even next to each
+# other in the same variant
+UNMERGED_ARGUMENTS = {M + 'e', M + 'fName'}
+
+# Characters under or over something that pandoc writes as a brace
+UNDER_BRACES = {'︸', '⏟'}
+OVER_BRACES = {'︷', '⏞'}
+
+# Structures pandoc braces when they're the base of a sub- or superscript
+BRACED_BASES = {M + 'acc', M + 'bar', M + 'func', M + 'groupChr', M + 'limLow', M + 'limUpp', M + 'nary',
+                M + 'phant', M + 'rad', M + 'sPre', M + 'sSub', M + 'sSubSup', M + 'sSup'}
+
+# Elements pandoc leaves out, with the equations in them
+SKIPPED = {W + 'del', W + 'moveFrom', W + 'hyperlink', MC + 'Fallback'}
+
+# Elements in an equation that don't change how it's written
+IGNORED = {M + 'ctrlPr', M + 'argPr', W + 'bookmarkStart', W + 'bookmarkEnd', W + 'proofErr',
+           W + 'permStart', W + 'permEnd', W + 'commentRangeStart', W + 'commentRangeEnd'}
+
+
+class UnsupportedOMML(Exception):
+    """Raised for an equation with an element this module doesn't translate."""
+
+
+class DocxEquation(NamedTuple):
+    """An equation read from word/document.xml."""
+    display: bool
+    latex: Optional[str]  # None if it couldn't be translated
+
+
+# A space that's only written between two things, and only once, like
+# the spaces pandoc puts around relations and binary operators
+SPACE = None
+
+# Ends with a command, which needs a space before a letter or digit
+_ENDS_WITH_COMMAND = re.compile(r'\\(?:[A-Za-z]+|[^A-Za-z ])$')
+
+
+def render(items: list, edges: bool = False) -> str:
+    """Join items, strings of LaTeX and SPACEs, the way pandoc does.
+    Each string is one thing pandoc would brace if it had to, like x, 12,
+    \\alpha or \\frac{1}{2}. SPACEs at either end are only written if edges."""
+    out = []
+    following = ''
+    space = False
+    for item in reversed(items):
+        if item is SPACE:
+            space = bool(out) or edges
+            continue
+        if not item:
+            continue
+        if space and following[:1] not in ('_', '^'):
+            out.append(' ')
+            following = ' '
+        space = False
+        if following[:1].isalnum() and _ENDS_WITH_COMMAND.search(item):
+            out.append(' ')
+        out.append(item)
+        following = item
+    if space and edges:
+        out.append(' ')
+    return ''.join(reversed(out))
+
+
+def join(parts: list[str], separator: str) -> str:
+    """Join parts with separator, writing the spaces where they meet once."""
+    text = parts[0] if parts else ''
+    for part in parts[1:]:
+        piece = separator
+        if text.endswith(' ') and not text.endswith('\\ ') and piece.startswith(' '):
+            piece = piece[1:]
+        if piece.endswith(' ') and part.startswith(' '):
+            part = part[1:]
+        text += piece + part
+    return text
+
+
+def count(items: list) -> int:
+    return sum(item is not SPACE for item in items)
+
+
+def braced(items: list) -> list:
+    """items as one thing, braced if there is more than one, or nothing
+    at all (only SPACEs are left as they are)."""
+    return items if items and count(items) <= 1 else ['{' + render(items) + '}']
+
+
+def unbraced(items: list) -> list:
+    """items, without the braces around a symbol in BRACED_SYMBOLS if
+    it's the only one, for when they're braced already."""
+    if count(items) != 1:
+        return items
+    return [item[1:-1] if item in BRACED_SYMBOLS else item for item in items]
+
+
+def child(elem: ElementTree.Element, tag: str) -> Optional[ElementTree.Element]:
+    return elem.find(M + tag)
+
+
+def argument(elem: ElementTree.Element, tag: str) -> ElementTree.Element:
+    """Return the argument of elem with tag, like m:e, which pandoc
+    leaves the whole of elem out without."""
+    found = elem.find(M + tag)
+    if found is None:
+        raise UnsupportedOMML(f'{elem.tag} without {M}{tag}')
+    return found
+
+
+def prop(elem: ElementTree.Element, properties: str, name: str, default: str) -> str:
+    """Return the m:val of the name property of elem, or default."""
+    found = elem.find(f'{M}{properties}/{M}{name}')
+    if found is None:
+        return default
+    return found.get(M + 'val', default)
+
+
+def symbol_items(char: str) -> list:
+    symbol = SYMBOLS.get(char)
+    if symbol is None:
+        return [char]
+    if not symbol['tex']:
+        return []
+    if symbol['tex'].isspace():
+        return [SPACE]
+    return [SPACE, symbol['tex'], SPACE] if symbol['spaced'] else [symbol['tex']]
+
+
+def text_items(text: str) -> list:
+    """The items of a run of plain math text: numbers, letters and symbols."""
+    items = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if '0' <= char <= '9':
+            start = i
+            while i < len(text) and '0' <= text[i] <= '9':
+                i += 1
+            items.append(text[start:i])
+            continue
+        items += symbol_items(char)
+        i += 1
+    return items
+
+
+# Characters \text{} can't hold as they are, or that pandoc writes differently in it
+_TEXT_ESCAPES = {'\\': '\\textbackslash', '~': '\\textasciitilde', '^': '\\textasciicircum',
+                 '&': '\\&', '%': '\\%', '$': '\\$', '#': '\\#', '_': '\\_', '{': '\\{', '}': '\\}',
+                 '\xa0': '~', '\u2001': '\\quad', '\u2003': '\\quad', '\u2004': '\\;', '\u2005': '\\:',
+                 '\u2006': '\\,', '\u200a': '\\,', '\u200b': '\\!', '′': "'", '″': "''", '‴': "'''"}
+
+
+# Commands in \text{} that pandoc puts a space after before any letter,
+# digit or character that isn't ASCII, not only before a letter
+_TEXT_SPACED = {'\\textbackslash', '\\textasciitilde'}
+
+_ENDS_WITH_WORD = re.compile(r'\\[A-Za-z]+$')
+
+
+def normal_text(text: str) -> str:
+    out: list[str] = []
+    for char in text:
+        tex = _TEXT_ESCAPES.get(char, char)
+        if out and _ENDS_WITH_WORD.search(out[-1]):
+            first = tex[0]
+            if first.isalpha() or out[-1] in _TEXT_SPACED and (first.isalnum() or not first.isascii()):
+                out.append(' ')
+        out.append(tex)
+    return '\\text{' + ''.join(out) + '}'
+
+
+def run_variant(run: ElementTree.Element) -> Optional[str]:
+    """Return the variant in VARIANTS a run is in, from its m:nor, m:scr
+    and m:sty the way pandoc reads them, or None for plain math."""
+    properties = child(run, 'rPr')
+    if properties is None:
+        return None
+    normal = child(properties, 'nor')
+    if normal is not None and normal.get(M + 'val', 'on') not in ('0', 'off', 'false'):
+        return 'normal'
+    script = prop(run, 'rPr', 'scr', 'roman')
+    style = prop(run, 'rPr', 'sty', '')
+    if script == 'sans-serif':
+        return {'i': 'sans-serif-italic', 'b': 'sans-serif-bold', 'bi': 'sans-serif-bold-italic'}.get(style, script)
+    if style == 'i':
+        return 'italic'
+    if style == 'b':
+        return {'script': 'bold-script', 'fraktur': 'bold-fraktur'}.get(script, 'bold')
+    if script == 'roman':
+        return 'bold-italic' if style == 'bi' else None
+    return script if script in VARIANTS else None
+
+
+def run_text(run: ElementTree.Element) -> str:
+    parts = []
+    for part in run:
+        if part.tag == M + 't':
+            parts.append(part.text or '')
+        elif part.tag not in (M + 'rPr', W + 'rPr') and part.tag not in IGNORED:
+            raise UnsupportedOMML(part.tag)
+    return ''.join(parts)
+
+
+def run_items(text: str) -> list:
+    if text in FUNCTIONS:
+        return ['\\' + text]
+    return text_items(text)
+
+
+def styled_items(texts: list[str], variant: str) -> list:
+    """The item of runs next to each other in variant, with texts."""
+    if variant == 'normal':
+        return [normal_text(''.join(texts))]
+    command = VARIANTS[variant]
+    items = []
+    for text in texts:
+        for item in run_items(text):
+            # A symbol in the variant already, like ℝ in \mathbb, is written as its letter
+            if item in BRACED_SYMBOLS and item.startswith('{' + command + '{'):
+                item = item[len(command) + 2:-2]
+            items.append(item)
+    return [command + '{' + render(unbraced(items)) + '}']
+
+
+def math_items(elem: Optional[ElementTree.Element], merge: Optional[bool] = None) -> list:
+    """The items of everything in elem, an m:oMath or an argument like m:e.
+    Runs next to each other in the same variant are written together if
+    merge, which by default they are unless elem is in UNMERGED_ARGUMENTS."""
+    items: list = []
+    if elem is None:
+        return items
+    if merge is None:
+        merge = elem.tag not in UNMERGED_ARGUMENTS
+    pending_texts: list[str] = []
+    pending_variant = None
+    for part in elem:
+        tag = part.tag
+        if tag == M + 'r':
+            variant = run_variant(part)
+            text = run_text(part)
+            if merge and variant is not None and variant == pending_variant:
+                pending_texts.append(text)
+                continue
+            if pending_variant is not None:
+                items += styled_items(pending_texts, pending_variant)
+            if variant is None:
+                items += run_items(text)
+                pending_variant = None
+            else:
+                pending_texts, pending_variant = [text], variant
+            continue
+        if pending_variant is not None:
+            items += styled_items(pending_texts, pending_variant)
+            pending_variant = None
+        if tag in IGNORED or tag in SKIPPED or (tag.startswith(M) and tag.endswith('Pr')):
+            continue
+        if tag == W + 'ins':
+            items += math_items(part, merge)
+            continue
+        structure = STRUCTURES.get(tag)
+        if structure is None:
+            raise UnsupportedOMML(tag)
+        items += structure(part)
+    if pending_variant is not None:
+        items += styled_items(pending_texts, pending_variant)
+    return items
+
+
+def group(elem: Optional[ElementTree.Element], merge: Optional[bool] = None) -> str:
+    return '{' + render(unbraced(math_items(elem, merge))) + '}'
+
+
+def accent(elem: ElementTree.Element) -> list:
+    char = prop(elem, 'accPr', 'chr', '\u0302')
+    command = ACCENTS.get(char)
+    if command is None:
+        return ['\\overset{' + render(symbol_items(char)) + '}' + group(argument(elem, 'e'))]
+    return [command + group(argument(elem, 'e'))]
+
+
+def bar(elem: ElementTree.Element) -> list:
+    command = '\\overline' if prop(elem, 'barPr', 'pos', 'bot') == 'top' else '\\underline'
+    return [command + group(argument(elem, 'e'))]
+
+
+def box(elem: ElementTree.Element) -> list:
+    return [group(argument(elem, 'e'), merge=True)]
+
+
+def border_box(elem: ElementTree.Element) -> list:
+    return ['\\boxed' + group(argument(elem, 'e'))]
+
+
+def delimiter(command: str, char: str) -> list:
+    """The items of \\left or \\right (command) with char."""
+    if not char:
+        return [command + '.']
+    symbol = SYMBOLS.get(char)
+    tex = char if symbol is None else symbol['tex']
+    if char in DELIMITERS:
+        return [command + tex]
+    return [command + '.', tex]
+
+
+def only_part(elem: ElementTree.Element) -> Optional[ElementTree.Element]:
+    """Return the one thing in elem, if there's only one."""
+    parts = [part for part in elem if part.tag not in IGNORED and not part.tag.endswith('Pr')]
+    return parts[0] if len(parts) == 1 else None
+
+
+def delimiters(elem: ElementTree.Element) -> list:
+    begin = prop(elem, 'dPr', 'begChr', '(')
+    end = prop(elem, 'dPr', 'endChr', ')')
+    separator = prop(elem, 'dPr', 'sepChr', '|')
+    arguments = elem.findall(M + 'e')
+    inner = only_part(arguments[0]) if len(arguments) == 1 else None
+    if inner is not None and inner.tag == M + 'm' and (begin, end) in MATRICES:
+        return [matrix(inner, MATRICES[begin, end])]
+    if inner is not None and inner.tag == M + 'f' and (begin, end) == ('(', ')') \
+            and prop(inner, 'fPr', 'type', 'bar') == 'noBar':
+        return fraction(inner)
+    opening = delimiter('\\left', begin)
+    items = opening[:1] + [SPACE] + opening[1:]
+    for i, argument in enumerate(arguments):
+        if i > 0:
+            items += ['\\mid'] if separator == '|' else symbol_items(separator)
+        items += math_items(argument)
+    items += [SPACE] + delimiter('\\right', end)
+    return [render(items)]
+
+
+def equation_array(elem: ElementTree.Element) -> list:
+    if any('&' in (text.text or '') for text in elem.iter(M + 't')):
+        raise UnsupportedOMML('alignment in ' + M + 'eqArr')
+    rows = [render(math_items(row), edges=True) for row in elem.findall(M + 'e')]
+    return ['\\begin{array}{r}\n' + join(rows, ' \\\\\n') + '\n\\end{array}']
+
+
+def fraction(elem: ElementTree.Element) -> list:
+    command = '\\binom' if prop(elem, 'fPr', 'type', 'bar') == 'noBar' else '\\frac'
+    return [command + group(argument(elem, 'num')) + group(argument(elem, 'den'))]
+
+
+def function(elem: ElementTree.Element) -> list:
+    name = child(elem, 'fName')
+    parts = [] if name is None else [part for part in name if part.tag not in IGNORED]
+    if len(parts) == 1 and parts[0].tag == M + 'r' and run_variant(parts[0]) is None:
+        text = run_text(parts[0])
+        if text.isalpha() and text not in FUNCTIONS:
+            return ['\\operatorname{' + text + '}'] + braced(math_items(argument(elem, 'e')))
+    return math_items(name) + braced(math_items(argument(elem, 'e')))
+
+
+def group_character(elem: ElementTree.Element) -> list:
+    char = prop(elem, 'groupChrPr', 'chr', '︸')
+    contents = group(argument(elem, 'e'))
+    if prop(elem, 'groupChrPr', 'pos', 'bot') == 'top':
+        if char == '⏞':
+            return ['\\overbrace' + contents]
+        return ['\\overset{' + render(symbol_items(char)) + '}' + contents]
+    if char in UNDER_BRACES:
+        return ['\\underbrace' + contents]
+    return ['\\overset' + contents + '{' + render(symbol_items(char)) + '}']
+
+
+def limit_text(elem: ElementTree.Element) -> str:
+    """The text of a limit that's nothing but one run, or ''."""
+    run = only_part(argument(elem, 'lim'))
+    return run_text(run) if run is not None and run.tag == M + 'r' else ''
+
+
+def lower_limit(elem: ElementTree.Element) -> list:
+    if limit_text(elem) in UNDER_BRACES:
+        return ['\\underbrace' + group(argument(elem, 'e'))]
+    return ['\\underset' + group(argument(elem, 'lim')) + group(argument(elem, 'e'))]
+
+
+def upper_limit(elem: ElementTree.Element) -> list:
+    if limit_text(elem) in OVER_BRACES:
+        return ['\\overbrace' + group(argument(elem, 'e'))]
+    return ['\\overset' + group(argument(elem, 'lim')) + group(argument(elem, 'e'))]
+
+
+def matrix(elem: ElementTree.Element, environment: str = 'matrix') -> str:
+    rows = [join([render(math_items(cell), edges=True) for cell in row.findall(M + 'e')], ' & ')
+            for row in elem.findall(M + 'mr')]
+    return f'\\begin{{{environment}}}\n' + join(rows, ' \\\\\n') + f'\n\\end{{{environment}}}'
+
+
+def matrix_items(elem: ElementTree.Element) -> list:
+    return [matrix(elem)]
+
+
+def n_ary(elem: ElementTree.Element) -> list:
+    operator = render(symbol_items(prop(elem, 'naryPr', 'chr', '∫')))
+    return [operator + '_' + group(argument(elem, 'sub')) + '^' + group(argument(elem, 'sup'))] \
+        + braced(math_items(argument(elem, 'e')))
+
+
+def phantom(elem: ElementTree.Element) -> list:
+    return ['\\phantom' + group(argument(elem, 'e'))]
+
+
+def radical(elem: ElementTree.Element) -> list:
+    degree = math_items(child(elem, 'deg'))
+    if not count(degree) or prop(elem, 'radPr', 'degHide', '0') in ('1', 'on', 'true'):
+        return ['\\sqrt' + group(argument(elem, 'e'))]
+    return ['\\sqrt[' + render(braced(degree)) + ']' + group(argument(elem, 'e'))]
+
+
+def base(elem: ElementTree.Element) -> str:
+    """The base of a sub- or superscript, braced if it's more than one
+    thing, or something pandoc braces anyway, like an accent."""
+    contents = argument(elem, 'e')
+    items = math_items(contents)
+    part = only_part(contents)
+    if count(items) == 1 and part is not None and part.tag in BRACED_BASES:
+        return '{' + render(items) + '}'
+    return render(braced(items))
+
+
+def pre_script(elem: ElementTree.Element) -> list:
+    return ['_' + group(argument(elem, 'sub')) + '^' + group(argument(elem, 'sup')) + base(elem)]
+
+
+def subscript(elem: ElementTree.Element) -> list:
+    return [base(elem) + '_' + group(argument(elem, 'sub'))]
+
+
+# A superscript of only these is written straight after its base, like f'
+PRIMES = {'′': "'", '″': "''", '‴': "'''", '⁗': "''''"}
+
+
+def primes(elem: Optional[ElementTree.Element]) -> Optional[str]:
+    """The primes in elem, like '' for ″, or None if it holds anything else."""
+    if elem is None:
+        return None
+    out = []
+    for part in elem:
+        if part.tag == M + 'r':
+            for char in run_text(part):
+                if char not in PRIMES:
+                    return None
+                out.append(PRIMES[char])
+        elif part.tag not in IGNORED:
+            return None
+    return ''.join(out) or None
+
+
+def superscript(elem: ElementTree.Element) -> list:
+    sup = argument(elem, 'sup')
+    return [base(elem) + (primes(sup) or '^' + group(sup))]
+
+
+def sub_superscript(elem: ElementTree.Element) -> list:
+    sup = argument(elem, 'sup')
+    return [base(elem) + '_' + group(argument(elem, 'sub')) + (primes(sup) or '^' + group(sup))]
+
+
+STRUCTURES = {
+    M + 'acc': accent,
+    M + 'bar': bar,
+    M + 'box': box,
+    M + 'borderBox': border_box,
+    M + 'd': delimiters,
+    M + 'eqArr': equation_array,
+    M + 'f': fraction,
+    M + 'func': function,
+    M + 'groupChr': group_character,
+    M + 'limLow': lower_limit,
+    M + 'limUpp': upper_limit,
+    M + 'm': matrix_items,
+    M + 'nary': n_ary,
+    M + 'phant': phantom,
+    M + 'rad': radical,
+    M + 'sPre': pre_script,
+    M + 'sSub': subscript,
+    M + 'sSup': superscript,
+    M + 'sSubSup': sub_superscript,
+}
+
+
+def equation_latex(elem: ElementTree.Element) -> str:
+    """Return what fix_equations would make of pandoc's LaTeX for elem,
+    an m:oMath or m:oMathPara. Raises UnsupportedOMML if it can't."""
+    if elem.tag == M + 'oMathPara':
+        rows = [render(unbraced(math_items(row))) for row in elem.findall(M + 'oMath')]
+    else:
+        rows = [render(unbraced(math_items(elem)))]
+    for old, new in SYMBOL_RULES:
+        rows = [row.replace(old, new) for row in rows]
+    if len(rows) == 1:
+        return rows[0].strip() + '  '
+    text = ''.join(rows)
+    spans = []
+    start = 0
+    for row in rows:
+        spans.append((start, start + len(row)))
+        start += len(row)
+    return generate_align_from_equations(text, spans) + '  '
+
+
+# Letters, digits, commands and environments, in an equation's signature
+_SIGNATURE_TOKENS = re.compile(r'\\(?:begin|end)\{[^}]*\}|\\[A-Za-z]+|[^\W_]')
+
+# Commands fix_equations adds or removes, which are left out of signatures
+REWRITTEN_COMMANDS = {'\\overset', '\\overrightarrow', '\\overleftrightarrow', '\\vec', '\\mathbf',
+                      '\\underbrace', '\\lbrace', '\\rbrace', '\\mid', '\\middle', '\\not', '\\equiv'}
+
+
+def signature(tex: str) -> str:
+    """The letters, digits and commands of tex in order, leaving out
+    environments and REWRITTEN_COMMANDS. An equation and what
+    fix_equations makes of it have the same signature."""
+    return ' '.join(token for token in _SIGNATURE_TOKENS.findall(tex)
+                    if token not in REWRITTEN_COMMANDS and not token.startswith(('\\begin{', '\\end{')))
+
+
+def read_equation(elem: ElementTree.Element) -> DocxEquation:
+    try:
+        latex: Optional[str] = equation_latex(elem)
+    except UnsupportedOMML:
+        latex = None
+    return DocxEquation(elem.tag == M + 'oMathPara', latex)
+
+
+def iter_docx_equations(path: str) -> Iterator[DocxEquation]:
+    """Yield the equations in the .docx at path that pandoc reads, in order.
+
+    word/document.xml is parsed as it's read out of the .docx, and
+    everything that has been looked at is thrown away, so memory stays
+    the same however long the document is.
+    """
+    with zipfile.ZipFile(path) as docx, docx.open(DOCUMENT_XML) as xml:
+        depth = 0
+        skipped = 0  # how many SKIPPED elements the parser is in
+        math_depth = 0  # how many m:oMathPara and m:oMath elements the parser is in
+        body = None
+        for event, elem in ElementTree.iterparse(xml, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                depth += 1
+                if tag in SKIPPED:
+                    skipped += 1
+                elif tag == M + 'oMathPara' or tag == M + 'oMath':
+                    math_depth += 1
+                elif tag == W + 'body':
+                    body = elem
+                continue
+            depth -= 1
+            if tag in SKIPPED:
+                skipped -= 1
+            elif tag == M + 'oMathPara' or tag == M + 'oMath':
+                math_depth -= 1
+                if math_depth == 0:
+                    if not skipped:
+                        yield read_equation(elem)
+                    elem.clear()
+            elif math_depth == 0 and (tag == W + 'p' or tag == W + 'tr'):
+                elem.clear()
+            if depth == 2 and body is not None:
+                body.clear()  # everything in the body so far has been read
+
+
+def translate_equations(path: str, equations: list[tuple[bool, str]]) -> Optional[list[Optional[str]]]:
+    """Return the LaTeX for each of equations, (displayed, pandoc's LaTeX)
+    pairs in the order pandoc read them from the .docx at path, or None
+    for the ones that couldn't be translated or don't match.
+
+    Returns None if the .docx doesn't have as many equations as
+    equations, which then have to be fixed the usual way.
+    """
+    translated: list[Optional[str]] = []
+    mismatched = 0
+    for docx_equation in iter_docx_equations(path):
+        i = len(translated)
+        if i == len(equations):
+            break
+        display, tex = equations[i]
+        latex = docx_equation.latex
+        if latex is not None and (docx_equation.display != display or signature(latex) != signature(tex)):
+            mismatched += 1
+            latex = None
+        translated.append(latex)
+    else:
+        if len(translated) == len(equations):
+            if mismatched:
+                print(f'[omml_reader] {mismatched} equations in {path} are not the ones pandoc read, '
+                      f'so they are fixed as usual', file=sys.stderr)
+            if os.environ.get(VERBOSE_ENV):
+                done = sum(latex is not None for latex in translated)
+                print(f'[omml_reader] {done} of {len(equations)} equations read from {path}', file=sys.stderr)
+            return translated
+    print(f'[omml_reader] {path} does not have as many equations as pandoc read, '
+          f'so {path} is not used', file=sys.stderr)
+    return None
+
+
+def main() -> int:
+    if len(sys.argv) != 2:
+        print('usage: omml_reader.py word_file.docx', file=sys.stderr)
+        return 2
+    for equation in iter_docx_equations(sys.argv[1]):
+        kind = 'display' if equation.display else 'inline'
+        print(f'{kind}: {equation.latex!r}' if equation.latex is not None else f'{kind}: (not translated)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Runs filters over pandoc's JSON AST as it is, in plain dicts and lists,
+instead of turning it into panflute elements and back like
+panflute.run_filter does. Filters only say which elements they want
+(Math, CodeBlock, ...), and only those are handed to them.
+
+Nothing here imports panflute, so a filter that runs this way doesn't
+pay for importing it either. The filters that can run this way have a
+_raw version of their action next to the panflute one, which takes the
+element's JSON dict instead, e.g. {'t': 'Math', 'c': [{'t': 'InlineMath'}, 'x']}.
+
+Those filters (ms_word_eqn_filter.py, code_block.py, image_captioner.py
+and image_optimizer.py) run this way when pandoc runs them, and only
+import panflute if a panflute Doc is passed to their main.
+"""
+
+
+import sys
+from typing import Any, BinaryIO, Callable, Optional
+
+from json_backend import get_json_backend, read_json
+
+# Called with an element's dict and the RawDoc. It may change the dict in
+# place, or return another element's dict to put in its place.
+RawAction = Callable[[dict, 'RawDoc'], Optional[dict]]
+
+# Meta values that hold inlines or blocks, and are read as text
+_TEXT_META = ('MetaInlines', 'MetaBlocks')
+
+
+class RawDoc:
+    """A pandoc JSON AST, and the output format pandoc passed to the filter.
+    Filters can keep what they need on it between elements, like on a panflute Doc.
+    """
+    ast: dict
+    format: Optional[str]
+
+    def __init__(self, ast: dict, format: Optional[str] = None) -> None:
+        self.ast = ast
+        self.format = format
+
+    def get_metadata(self, key: str, default: Any = None) -> Any:
+        """Same as panflute's Doc.get_metadata: the metadata field key as
+        str, bool, list or dict, or default if there's no such field."""
+        value = self.ast.get('meta', {}).get(key)
+        return default if value is None else meta_to_python(value)
+
+
+def meta_to_python(value: dict) -> Any:
+    kind, content = value.get('t'), value.get('c')
+    if kind == 'MetaString' or kind == 'MetaBool':
+        return content
+    if kind == 'MetaList':
+        return [meta_to_python(item) for item in content]
+    if kind == 'MetaMap':
+        return {key: meta_to_python(item) for key, item in content.items()}
+    if kind in _TEXT_META:
+        return stringify(content)
+    return content
+
+
+def stringify(nodes: Any) -> str:
+    """The text of some inlines or blocks, like panflute.stringify."""
+    parts: list[str] = []
+
+    def visit(node: Any) -> None:
+        if isinstance(node, list):
+            for child in node:
+                visit(child)
+        elif isinstance(node, dict):
+            kind = node.get('t')
+            if kind == 'Str':
+                parts.append(node['c'])
+            elif kind in ('Space', 'SoftBreak', 'LineBreak'):
+                parts.append(' ')
+            elif kind in ('Code', 'Math'):
+                parts.append(node['c'][1])
+            else:
+                visit(node.get('c'))
+
+    visit(nodes)
+    return ''.join(parts)
+
+
+def walk(nodes: list, actions: dict[str, list[RawAction]], doc: RawDoc) -> None:
+    """Call actions[t] on every element in nodes whose type is t, in
+    order, innermost elements first like panflute does. Elements are only
+    looked at, not copied; text (Str and the like) isn't gone into at all.
+    """
+    for i, node in enumerate(nodes):
+        if type(node) is dict:
+            content = node.get('c')
+            if type(content) is list:
+                walk(content, actions, doc)
+            elif type(content) is dict:  # MetaMap
+                walk_values(content, actions, doc)
+            node_actions = actions.get(node.get('t'))
+            if node_actions is not None:
+                for action in node_actions:
+                    result = action(node, doc)
+                    if result is not None:
+                        node = nodes[i] = result
+        elif type(node) is list:
+            walk(node, actions, doc)
+
+
+def walk_values(mapping: dict, actions: dict[str, list[RawAction]], doc: RawDoc) -> None:
+    """walk over the values of mapping, putting back any that were replaced."""
+    keys = list(mapping)
+    values = [mapping[key] for key in keys]
+    walk(values, actions, doc)
+    for key, value in zip(keys, values):
+        mapping[key] = value
+
+
+def read_doc(instream: Optional[BinaryIO] = None) -> RawDoc:
+    """Read the AST pandoc sends a filter, and the format from the command line."""
+    return RawDoc(read_json(instream), sys.argv[1] if len(sys.argv) > 1 else None)
+
+
+def write_doc(doc: RawDoc, outstream: Optional[BinaryIO] = None) -> None:
+    """Write doc's AST as JSON to outstream, stdout by default. The blocks
+    are encoded one at a time, so the whole document is never held as one string."""
+    if outstream is None:
+        outstream = sys.stdout.buffer
+    dumps = get_json_backend().dumps
+    outstream.write(b'{')
+    for i, (key, value) in enumerate(doc.ast.items()):
+        outstream.write((b',' if i else b'') + dumps(key) + b':')
+        if key == 'blocks':
+            outstream.write(b'[')
+            for j, block in enumerate(value):
+                outstream.write((b',' if j else b'') + dumps(block))
+            outstream.write(b']')
+        else:
+            outstream.write(dumps(value))
+    outstream.write(b'}')
+    outstream.flush()
+
+
+def run_raw_filter(actions: dict[str, list[RawAction]], doc: RawDoc,
+                   prepare: Optional[Callable[[RawDoc], None]] = None,
+                   finalize: Optional[Callable[[RawDoc], None]] = None) -> RawDoc:
+    """Run actions over doc, like panflute.run_filter: prepare(doc),
+    then the actions over the metadata and the blocks, then finalize(doc)."""
+    if prepare is not None:
+        prepare(doc)
+    walk_values(doc.ast.get('meta', {}), actions, doc)
+    walk(doc.ast.get('blocks', []), actions, doc)
+    if finalize is not None:
+        finalize(doc)
+    return doc
+
+
+def run_raw_filters(actions: dict[str, list[RawAction]],
+                    prepare: Optional[Callable[[RawDoc], None]] = None,
+                    finalize: Optional[Callable[[RawDoc], None]] = None) -> None:
+    """Read the document from stdin, run actions over it and write it to stdout."""
+    write_doc(run_raw_filter(actions, read_doc(), prepare, finalize))
@@ -19,13 +19,20 @@ I am defining
 
 \\end{definition}
 
+Environments can be nested in each other, and can be inside
+divs, block quotes and list items.
+
 Note that for Python's docstrings, I must use double backslashes.
 """
 
 
 import io
+import os
 import sys
 import json
+from typing import Optional, Iterable, Iterator, TextIO, BinaryIO, Any
+
+from json_backend import get_json_backend, read_json, write_json
 
 
 class ASTProcessor:
@@ -89,41 +96,12 @@ class ASTProcessor:
 
         This method fails if a blocks key doesn't
         exist in the root AST.
-        """
-        temp_blocks = self.c_ast.get("blocks")
-        if temp_blocks is None:
-            return
-
-        # true when we're inside a block, as detected
-        inside_key = False
-        block_pairs: list[tuple[int, int, str]] = []
-        start_block_index = 0
-        # end_block_index = 0
-        title_so_far = ''
-        for i, block in enumerate(temp_blocks):
-            if not inside_key:
-                if self.block_content_matches(block, self.start_block):
-                    start_block_index = i
-                    inside_key = True
-                    # otherwise do nothing
-                    title_so_far = pandoc_list_to_string(block['c'], self.start_block[0].__len__() + 1)
-
 
-            else:
-                if self.block_content_matches(block, self.end_block):
-                    end_block_index = i
-                    inside_key = False
-                    block_pairs.append((start_block_index, end_block_index, title_so_far))
-        # SO FAR: block_pairs contains all pairs of blocks, which we will
-        # need to put in its own type. start is the index where the block
-        # started (has the start flag) and end is the index where the block
-        # finished (has the finish flag)
-        for st, en, title_of in reversed(block_pairs):
-            # case 1: st < en
-            inner_blocks = temp_blocks[st + 1:en]
-            replacement_block = self.generate_wrapping_block(inner_blocks, title_of)
-            temp_blocks[st:en + 1] = [replacement_block]
-        # end of function. all blocks should be replaced.
+        To wrap several kinds of environments, put them all
+        in one EnvironmentRegistry instead of calling this
+        on each of them, so the blocks are only walked once.
+        """
+        EnvironmentRegistry(self.c_ast, [self]).process()
 
     def generate_wrapping_block(self, inner_blocks: list[dict], title_of: str) -> dict:
         """Generates the wrapping block. How the block is made will
@@ -169,6 +147,149 @@ class ASTProcessor:
         return list_startswith_same([target_block][0]['c'], check_block[0]['c'])
 
 
+class EnvironmentRegistry:
+    """Wraps the blocks of every environment in processors
+    in a single walk over the blocks.
+
+    Start and end flag paragraphs are looked up by
+    (delimiter, key) in a dict, so the number of
+    environments doesn't matter. Environments may be
+    nested; an end flag closes the innermost open
+    environment it belongs to. Start flags that are never
+    closed, and end flags that close nothing, are left alone.
+    """
+    c_ast: dict
+    processors: list[ASTProcessor]
+    starts: dict[tuple[str, str], ASTProcessor]
+    ends: dict[tuple[str, str], list[ASTProcessor]]
+
+    def __init__(self, c_ast: dict, processors: list[ASTProcessor]) -> None:
+        self.c_ast = c_ast
+        self.processors = processors
+        self.starts = {}
+        self.ends = {}
+        for processor in processors:
+            self.starts.setdefault((processor.delimiter, processor.start_key), processor)
+            self.ends.setdefault((processor.ending_flag, processor.end_key), []).append(processor)
+
+    def process(self) -> None:
+        """Replace c_ast's blocks with wrapped blocks.
+        Does nothing if the root AST has no blocks.
+        """
+        blocks = self.c_ast.get("blocks")
+        if blocks is None:
+            return
+        blocks[:] = self.process_blocks(blocks)
+
+    def process_blocks(self, blocks: list[dict]) -> list[dict]:
+        """Return blocks with every environment wrapped."""
+        return list(self.iter_process_blocks(blocks))
+
+    def iter_process_blocks(self, blocks: Iterable[dict]) -> Iterator[dict]:
+        """Yield blocks with every environment wrapped.
+
+        A block is yielded as soon as it is known not to be inside an
+        environment, so only the blocks of open environments are held on to.
+
+        Blocks that hold other blocks (see child_block_lists) are processed
+        too, each list of blocks on its own, as they go by. Every block is
+        only looked at once, however deeply things are nested.
+        """
+        # each open environment: (processor, start flag block, title, blocks inside so far)
+        open_envs: list[tuple[ASTProcessor, dict, str, list[dict]]] = []
+        for block in blocks:
+            for child_blocks in self.child_block_lists(block):
+                child_blocks[:] = self.iter_process_blocks(child_blocks)
+            flag = self.flag_of(block)
+            if flag is not None:
+                processor = self.starts.get(flag)
+                if processor is not None:
+                    open_envs.append((processor, block, self.title_of(processor, block), []))
+                    continue
+                closes = self.ends.get(flag)
+                if closes is not None and any(env[0] in closes for env in open_envs):
+                    # anything opened after the environment being closed was never closed
+                    while open_envs[-1][0] not in closes:
+                        yield from self._abandon(open_envs)
+                    processor, _, title, inner_blocks = open_envs.pop()
+                    block = self.wrap(processor, inner_blocks, title)
+            if open_envs:
+                open_envs[-1][3].append(block)
+            else:
+                yield block
+        while open_envs:
+            yield from self._abandon(open_envs)
+
+    # The methods below are all this class knows about how blocks are
+    # represented. Override them to wrap environments in something other
+    # than the raw pandoc JSON AST.
+
+    def child_block_lists(self, block: dict) -> list[list[dict]]:
+        """Return every list of blocks directly inside block."""
+        return child_block_lists(block)
+
+    def flag_of(self, block: dict) -> Optional[tuple[str, str]]:
+        """Return the (delimiter, key) block would be if it were a flag."""
+        return flag_of(block)
+
+    def title_of(self, processor: ASTProcessor, start_block: dict) -> str:
+        """Return the title that follows the key in a start flag."""
+        return pandoc_list_to_string(start_block['c'], len(processor.start_block[0]['c']))
+
+    def wrap(self, processor: ASTProcessor, inner_blocks: list[dict], title: str) -> dict:
+        """Return inner_blocks wrapped in the processor's environment."""
+        return processor.generate_wrapping_block(inner_blocks, title)
+
+    @staticmethod
+    def _abandon(open_envs: list[tuple[ASTProcessor, dict, str, list[dict]]]) -> list[dict]:
+        """Put the innermost open environment's start flag and
+        blocks back where they were, without wrapping them.
+        Return them if that is the top level.
+        """
+        _, start_block, _, inner_blocks = open_envs.pop()
+        if not open_envs:
+            return [start_block] + inner_blocks
+        open_envs[-1][3].append(start_block)
+        open_envs[-1][3].extend(inner_blocks)
+        return []
+
+
+def child_block_lists(block: dict) -> list[list[dict]]:
+    """Return every list of blocks directly inside block, like the
+    contents of a Div, a block quote or each item of a list.
+    """
+    kind = block.get("t")
+    content = block.get("c")
+    if kind == 'Div':
+        return [content[1]]
+    if kind == 'BlockQuote':
+        return [content]
+    if kind == 'BulletList':
+        return content
+    if kind == 'OrderedList':
+        return content[1]
+    if kind == 'DefinitionList':
+        return [definition for _, definitions in content for definition in definitions]
+    if kind == 'Figure':
+        return [content[2]]
+    return []
+
+
+def flag_of(block: dict) -> Optional[tuple[str, str]]:
+    """If block is a paragraph that starts with
+    a word, a space and another word, return both words.
+    """
+    if block.get("t") != 'Para':
+        return None
+    content = block.get('c')
+    if not content or len(content) < 3:
+        return None
+    first, space, second = content[0], content[1], content[2]
+    if first.get('t') != 'Str' or space.get('t') != 'Space' or second.get('t') != 'Str':
+        return None
+    return first['c'], second['c']
+
+
 def list_startswith_same(c1: list, c2: list) -> bool:
     for item1, item2 in zip(c1, c2):
         if item1 != item2:
@@ -186,26 +307,151 @@ def pandoc_list_to_string(li: list[dict[str, str]], skip: int) -> str:
     return' '.join(words)
 
 
-if __name__ == '__main__':
-    # Read the AST from stdin
-    # input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    ast = json.loads(sys.stdin.read())
-    # astp = ASTProcessor(ast, "proof", "proof", "QED", ':::')
-    # astp.process_ast_first_time()
-    starter_flag = ':::'
-    ending_flag_f = '///'
-
-    asts = [  # ast, div name, start flag, end flag
-        ASTProcessor(ast, "note", "note", "note", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "tip", "tip", "tip", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "warning", "warning", "warning", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "caution", "caution", "caution", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "important", "important", "important", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "proof", "proof", "QED", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "definition", "definition", "definition", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "solution", "solution", "solution", starter_flag, ending_flag_f),
-        ASTProcessor(ast, "box", "box", "box", starter_flag, ending_flag_f)
+# Set this environment variable to stream the AST instead of reading all of it
+# first. The output is the same, but only the blocks inside environments
+# are kept in memory, which matters for huge documents with embedded images.
+STREAM_ENV = 'START_WRAPPER_STREAM'
+
+
+def make_processors(c_ast: dict, starter_flag: str = ':::', ending_flag: str = '///') -> list[ASTProcessor]:
+    """Return every environment this filter knows about."""
+    return [  # ast, div name, start flag, end flag
+        ASTProcessor(c_ast, "note", "note", "note", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "tip", "tip", "tip", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "warning", "warning", "warning", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "caution", "caution", "caution", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "important", "important", "important", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "proof", "proof", "QED", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "definition", "definition", "definition", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "solution", "solution", "solution", starter_flag, ending_flag),
+        ASTProcessor(c_ast, "box", "box", "box", starter_flag, ending_flag)
     ]
-    for ast_p in asts:
-        ast_p.process_ast_first_time()
-    sys.stdout.write(json.dumps(ast))
+
+
+class StreamingJSONReader:
+    """Reads a JSON document from a text stream a piece at a time,
+    so values can be decoded one by one without reading everything first.
+    """
+    stream: TextIO
+    chunk_size: int
+    buffer: str
+    pos: int
+    eof: bool
+
+    def __init__(self, stream: TextIO, chunk_size: int = 1 << 16) -> None:
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read_more(self) -> bool:
+        """Read more of the stream into the buffer. Return False at the end of the stream.
+        Reads at least as much as is already buffered, so a value that takes many
+        reads to arrive is still only decoded a handful of times.
+        """
+        if self.eof:
+            return False
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        chunk = self.stream.read(max(self.chunk_size, len(self.buffer)))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def peek(self) -> str:
+        """Return the next character that isn't whitespace without consuming it,
+        or '' at the end of the stream.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read_more():
+                return ''
+
+    def expect(self, char: str) -> None:
+        """Consume char, which must be the next character that isn't whitespace."""
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'Expected {char!r} in the JSON input, found {found!r}')
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode and consume the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                result, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise
+                continue
+            # a number at the end of the buffer may have been cut off
+            if end == len(self.buffer) and self._read_more():
+                continue
+            self.pos = end
+            return result
+
+
+def stream_ast(registry: EnvironmentRegistry, instream: TextIO, outstream: BinaryIO) -> None:
+    """Read a pandoc JSON AST from instream and write it to outstream
+    with every environment in registry wrapped, exactly as
+    write_json would have written the whole AST.
+
+    Only the top-level blocks array is streamed; everything else
+    in the root object is small and is decoded in one go.
+    """
+    dumps = get_json_backend().dumps
+    reader = StreamingJSONReader(instream)
+    reader.expect('{')
+    outstream.write(b'{')
+    first_key = True
+    while reader.peek() != '}':
+        if not first_key:
+            reader.expect(',')
+            outstream.write(b',')
+        first_key = False
+        key = reader.value()
+        reader.expect(':')
+        outstream.write(dumps(key) + b':')
+        if key == 'blocks' and reader.peek() == '[':
+            outstream.write(b'[')
+            first_block = True
+            for block in registry.iter_process_blocks(_iter_json_array(reader)):
+                outstream.write(dumps(block) if first_block else b',' + dumps(block))
+                first_block = False
+            outstream.write(b']')
+        else:
+            outstream.write(dumps(reader.value()))
+    reader.expect('}')
+    outstream.write(b'}')
+    outstream.flush()
+
+
+def _iter_json_array(reader: StreamingJSONReader) -> Iterator[Any]:
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() == ']':
+            reader.pos += 1
+            return
+        reader.expect(',')
+
+
+if __name__ == '__main__':
+    if os.environ.get(STREAM_ENV):
+        stream_ast(EnvironmentRegistry({}, make_processors({})),
+                   io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8'), sys.stdout.buffer)
+    else:
+        # Read the AST from stdin
+        ast = read_json()
+        EnvironmentRegistry(ast, make_processors(ast)).process()
+        write_json(ast)
@@ -1,5 +1,101 @@
 local utils = require("pandoc.utils")
 
+-- Goes between cells when a table's cells are written out together
+local CELL_MARKER = "%%no_longtable-cell%%"
+
+-- Tables repeat the same few cells ("0", "-", ...) over and over, so
+-- written cells are remembered by their contents. Like word_eqn.lua, the
+-- memo keeps two generations of at most NO_LONGTABLE_CACHE_SIZE cells each.
+local cache_size = tonumber(os.getenv("NO_LONGTABLE_CACHE_SIZE") or "") or 4096
+local cache_current, cache_old = {}, {}
+local cache_count = 0
+
+-- Cells are told apart by their JSON, which pandoc can only write from
+-- Lua since 3.1.1. Before that, cells aren't remembered at all.
+local encode_json = pandoc.json and pandoc.json.encode
+
+-- If set, tables are written out NO_LONGTABLE_CHUNK_ROWS rows at a time,
+-- each chunk as its own raw piece, instead of as one string. The pieces
+-- are raw inlines of one Plain block, so pandoc writes them back to back:
+-- a blank line between them would be a paragraph break inside the tabular.
+local chunk_rows = tonumber(os.getenv("NO_LONGTABLE_CHUNK_ROWS") or "") or 0
+
+local function remember_cell(key, latex)
+  if cache_count >= cache_size then
+    cache_current, cache_old = {}, cache_current
+    cache_count = 0
+  end
+  cache_current[key] = latex
+  cache_count = cache_count + 1
+end
+
+local function recall_cell(key)
+  local latex = cache_current[key]
+  if latex == nil then
+    latex = cache_old[key]
+    if latex ~= nil then
+      remember_cell(key, latex)
+    end
+  end
+  return latex
+end
+
+local function finish_cell(latex)
+  latex = latex:gsub("^\n+", ""):gsub("\n+$", "")
+  latex = latex:gsub("\\%[", "\\(")
+  latex = latex:gsub("\\%]", "\\)")
+  return "\\makecell{" .. latex .. "}"
+end
+
+-- Writes cells to LaTeX with a single call to the writer: cells that
+-- were written before come from the memo, and the rest are written
+-- together, separated by CELL_MARKER, then split back apart.
+local function render_cells(cells)
+  local rendered = {}
+  local waiting = {}  -- where each cell still to be written goes
+  local keys = {}
+  local blocks = {}
+  for i, cell in ipairs(cells) do
+    local content = cell.content or cell.contents or {}
+    if type(content) ~= "table" or next(content) == nil then
+      rendered[i] = ""
+    else
+      local para = pandoc.Para(utils.blocks_to_inlines(content))
+      local key = encode_json and encode_json(para) or i
+      local latex = encode_json and recall_cell(key)
+      if latex then
+        rendered[i] = latex
+      elseif waiting[key] ~= nil then
+        table.insert(waiting[key], i)
+      else
+        waiting[key] = {i}
+        table.insert(keys, key)
+        table.insert(blocks, pandoc.RawBlock("latex", CELL_MARKER))
+        table.insert(blocks, para)
+      end
+    end
+  end
+  if #keys == 0 then
+    return rendered
+  end
+
+  local latex = pandoc.write(pandoc.Pandoc(blocks), "latex")
+  local _, piece_start = latex:find(CELL_MARKER, 1, true)
+  for _, key in ipairs(keys) do
+    local next_marker, next_start = latex:find(CELL_MARKER, piece_start + 1, true)
+    local piece = finish_cell(latex:sub(piece_start + 1, (next_marker or #latex + 1) - 1))
+    if encode_json then
+      remember_cell(key, piece)
+    end
+    for _, i in ipairs(waiting[key]) do
+      rendered[i] = piece
+    end
+    piece_start = next_start
+  end
+  return rendered
+end
+
+
 function Meta(meta)
   if FORMAT:match("latex") then
     
@@ -31,66 +127,69 @@ function Table(tbl)
   end
   local align_str = "|" .. table.concat(alignment, "|") .. "|"
 
-  local lines = {}
-  table.insert(lines, "\\begin{tabular}{" .. align_str .. "}")
+  local cells = {}
+  for _, row in ipairs(tbl.head.rows) do
+    for _, cell in ipairs(row.cells) do
+      table.insert(cells, cell)
+    end
+  end
+  local body_rows = {}
+  for _, body in ipairs(tbl.bodies) do
+    for _, row in ipairs(body.body) do
+      table.insert(body_rows, row)
+      for _, cell in ipairs(row.cells) do
+        table.insert(cells, cell)
+      end
+    end
+  end
+  local rendered = render_cells(cells)
+  local next_cell = 0
 
-  
-  local function render_cell(cell)
-    
-    local content = cell.content or cell.contents or {}
-  
-    if type(content) ~= "table" or next(content) == nil then
-      return ""
+  local function row_line(row)
+    local row_cells = {}
+    for _ in ipairs(row.cells) do
+      next_cell = next_cell + 1
+      table.insert(row_cells, rendered[next_cell])
     end
+    return table.concat(row_cells, " & ") .. " \\\\"
+  end
+
   
-    
-    local inlines = pandoc.utils.blocks_to_inlines(content)
-    local latex = pandoc.write(pandoc.Pandoc({pandoc.Para(inlines)}), "latex")
-    latex = latex:gsub("\n$", "")
-    latex = latex:gsub("\\%[", "\\(")
-    latex = latex:gsub("\\%]", "\\)")
-    
-    latex = "\\makecell{" .. latex .. "}"
-    
-    return latex
+  local caption = utils.stringify(tbl.caption)
+  local lines = {}
+  if caption ~= "" then
+    table.insert(lines, "\\begin{table}[h]")
+    table.insert(lines, "\\centering")
   end
+  table.insert(lines, "\\begin{tabular}{" .. align_str .. "}")
 
   
   table.insert(lines, "\\hline")
   for _, row in ipairs(tbl.head.rows) do
-    local cells = {}
-    for _, cell in ipairs(row.cells) do
-      table.insert(cells, render_cell(cell))
-    end
-    table.insert(lines, table.concat(cells, " & ") .. " \\\\")
+    table.insert(lines, row_line(row))
   end
   table.insert(lines, "\\hline")
 
   
-  for _, body in ipairs(tbl.bodies) do
-    for _, row in ipairs(body.body) do
-      local cells = {}
-      for _, cell in ipairs(row.cells) do
-        table.insert(cells, render_cell(cell))
-      end
-      table.insert(lines, table.concat(cells, " & ") .. " \\\\")
-      table.insert(lines, "\\hline")
+  local chunks = {}
+  for i, row in ipairs(body_rows) do
+    table.insert(lines, row_line(row))
+    table.insert(lines, "\\hline")
+    if chunk_rows > 0 and i % chunk_rows == 0 and i < #body_rows then
+      table.insert(chunks, pandoc.RawInline("latex", table.concat(lines, "\n") .. "\n"))
+      lines = {}
     end
   end
 
   table.insert(lines, "\\end{tabular}")
-
-  
-  local caption = utils.stringify(tbl.caption)
   if caption ~= "" then
-    lines = {
-      "\\begin{table}[h]",
-      "\\centering",
-      table.concat(lines, "\n"),
-      "\\caption{" .. caption .. "}",
-      "\\end{table}"
-    }
+    table.insert(lines, "\\caption{" .. caption .. "}")
+    table.insert(lines, "\\end{table}")
   end
 
+  if #chunks > 0 then
+    table.insert(chunks, pandoc.RawInline("latex", table.concat(lines, "\n")))
+    return pandoc.Plain(chunks)
+  end
   return pandoc.RawBlock("latex", table.concat(lines, "\n"))
 end
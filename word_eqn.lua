@@ -80,6 +80,151 @@ local function bracket_layers(text_bl, index, opening_brace, closing_brace, esca
     end
 end
 
+-- Builds the matched-brace table of text_bt in one pass forward and one pass back,
+-- so that closing brace lookups don't have to call bracket_layers over and over.
+-- Escaped braces (\{ and \}) are not braces. Every table is indexed 1-based:
+--   partner[i]          the index of the brace that pairs with the brace at i
+--   next_open[i]        the first opening brace at or after i at the same depth as i
+--   enclosing_close[i]  the first closing brace at or after i that closes the group i is in
+-- Missing entries are nil. Rebuild the table whenever text_bt changes.
+local function brace_table(text_bt)
+    local OPEN, CLOSE, BACKSLASH = 123, 125, 92 -- "{", "}", "\"
+    local len = #text_bt
+    local depth = {}
+    local kind = {}
+    local partner = {}
+    local stack = {}
+    local d = 0
+    local previous_byte = nil
+
+    for i = 1, len do
+        local byte = text_bt:byte(i)
+        depth[i] = d
+        if (byte == OPEN or byte == CLOSE) and previous_byte ~= BACKSLASH then
+            if byte == OPEN then
+                kind[i] = OPEN
+                table.insert(stack, i)
+                d = d + 1
+            else
+                kind[i] = CLOSE
+                local opener = table.remove(stack)
+                if opener ~= nil then
+                    partner[opener] = i
+                    partner[i] = opener
+                end
+                d = d - 1
+            end
+        end
+        previous_byte = byte
+    end
+
+    -- walk back from the end, remembering the nearest brace of each kind at each depth
+    local next_open = {}
+    local enclosing_close = {}
+    local open_at = {}
+    local close_at = {}
+    for i = len, 1, -1 do
+        if kind[i] == OPEN then
+            open_at[depth[i]] = i
+        elseif kind[i] == CLOSE then
+            close_at[depth[i]] = i
+        end
+        next_open[i] = open_at[depth[i]]
+        enclosing_close[i] = close_at[depth[i]]
+    end
+
+    return {
+        partner = partner,
+        next_open = next_open,
+        enclosing_close = enclosing_close
+    }
+end
+
+-- The rules in eqn_rules.json as it ships, for pandoc before 3.1.1,
+-- which can't read JSON from Lua (pandoc.json). Keep them the same.
+local BUILTIN_EQN_RULES = {
+    rules = {
+        {old = "\n", new = " "},
+        {old = "\\{", new = "\\lbrace"},
+        {old = "\\}", new = "\\rbrace"},
+        {old = "≢", new = "\\not\\equiv "},
+        {old = "\\overrightarrow", new = "\\vec", filters = {"lua"}},
+        {old = "\\overset{⃑}", new = "\\mathbf", filters = {"lua"}},
+        {old = "\\end{matrix}\\mid\\begin{matrix}", new = "\\end{matrix}\\;\\middle|\\;\\begin{matrix}"},
+        {old = "–", new = "-", filters = {"lua"}},
+        {old = "^{'}", new = " '", filters = {"lua"}},
+    },
+    relations = {
+        {"\\iff", "\\Leftrightarrow", "\\Rightarrow", "\\implies", "\\Leftarrow"},
+        {"<", ">", "\\leq", "\\geq", "\\approx"},
+        {"\\subset", "\\subseteq", "\\not\\subset"},
+        {"\\neq"},
+    },
+}
+
+-- Plain text replacements made on every equation before anything else,
+-- and the relations aligned equations are lined up on.
+-- They're shared with the Python filter, in eqn_rules.json next to this file,
+-- so add new ones there.
+local function read_eqn_rules()
+    if pandoc.json == nil then
+        io.stderr:write("[word_eqn] pandoc " .. tostring(PANDOC_VERSION) .. " can't read eqn_rules.json "
+            .. "(that needs pandoc 3.1.1), so the rules it shipped with are used\n")
+        return BUILTIN_EQN_RULES
+    end
+    local script = PANDOC_SCRIPT_FILE or ""
+    local path = (script:match("^(.*)[/\\]") or ".") .. "/eqn_rules.json"
+    local file = io.open(path, "r")
+    if file == nil then
+        error("word_eqn.lua needs eqn_rules.json next to it, but it isn't at " .. path)
+    end
+    local eqn_rules = pandoc.json.decode(file:read("a"), false)
+    file:close()
+    return eqn_rules
+end
+
+local EQN_RULES = read_eqn_rules()
+
+-- Each old is escaped so it's matched as plain text.
+local function load_symbol_rules(rules)
+    local compiled = {}
+    for _, rule in ipairs(rules) do
+        local applies = rule.filters == nil
+        for _, name in ipairs(rule.filters or {}) do
+            applies = applies or name == "lua"
+        end
+        if applies then
+            table.insert(compiled, {
+                rule.old:gsub("[%^%$%(%)%%%.%[%]%*%+%-%?]", "%%%0"),
+                (rule.new:gsub("%%", "%%%%"))
+            })
+        end
+    end
+    return compiled
+end
+
+local SYMBOL_RULES = load_symbol_rules(EQN_RULES.rules)
+
+-- Relations are indexed by their first byte, along with their precedence
+-- (1 being the most important), so each place in an equation is only
+-- compared with the relations that could start there.
+local function index_relations(relations)
+    local by_first_byte = {}
+    for k, row in ipairs(relations) do
+        for _, symbol in ipairs(row) do
+            if #symbol > 0 then
+                local byte = symbol:byte(1)
+                by_first_byte[byte] = by_first_byte[byte] or {}
+                table.insert(by_first_byte[byte], {symbol, k})
+            end
+        end
+    end
+    return by_first_byte
+end
+
+local RELATION_COUNT = #EQN_RULES.relations
+local RELATIONS_BY_BYTE = index_relations(EQN_RULES.relations)
+
 -- fix equations. takes a string, returns a string.
 local function fix_equations(eqn)
 
@@ -133,60 +278,27 @@ local function fix_equations(eqn)
         return depth
     end
 
-    local function fix_vectors_again(txt)
-        local arg1 = "overset{⃑}"
-        local replace1 = "mathbf"
-        -- Escape the backslash for Lua patterns
-        local pattern = "\\" .. arg1
-        local replacement = "\\" .. replace1
-        -- Use gsub for global substitution
-        local x = txt:gsub(pattern, replacement)
-        return x
-    end
-
     local function fix_accents(text)
     -- Find the next closing bracket
-        local function find_next_closing_bracket(text_fncb, index)
-            local skip_fncb = 1
-            while true do
-                local ind = find_nth(text_fncb, "}", skip_fncb, index)
-                if ind == -1 then
-                    return -1
-                end
-                if text_fncb:sub(ind - 1, ind - 1) == "\\" then
-                    skip_fncb = skip_fncb + 1
-                    -- goto continue
-                elseif bracket_layers(text_fncb, ind, nil, nil, nil, index) ~= -1 then
-                    skip_fncb = skip_fncb + 1
-                    -- goto continue
-                else
-                    return ind
-                end
-                -- ::continue::
-            end
+        local function find_next_closing_bracket(braces, index)
+            return braces.enclosing_close[index] or -1
         end
 
         -- Return the position of the closing brace where the local environment ends
-        ---@param text_local_env_end string
+        ---@param braces table -- from brace_table
         ---@param index number
         ---@return number
-        local function local_env_end(text_local_env_end, index)
-            local n = 1
-            while true do
-                local closest_bracket = find_nth(text_local_env_end, "}", n, index)
-                if closest_bracket == -1 then
-                    error("Opening bracket without a closing bracket detected")
-                end
-                local b_layer = bracket_layers(text_local_env_end, closest_bracket, nil, nil, nil, index)
-                if b_layer == 0 then
-                    return closest_bracket
-                else
-                    n = n + 1
-                end
+        local function local_env_end(braces, index)
+            local opener = braces.next_open[index]
+            local closest_bracket = opener and braces.partner[opener]
+            if closest_bracket == nil then
+                error("Opening bracket without a closing bracket detected")
             end
-            return -1
+            return closest_bracket
         end
 
+        local braces = brace_table(text)
+
         -- Underbrace replacement
         local skip = 1
         while true do
@@ -194,15 +306,17 @@ local function fix_equations(eqn)
             if overset_ind == -1 then
                 break
             end
-            local overset_end = local_env_end(text, overset_ind)
+            local overset_end = local_env_end(braces, overset_ind)
             local contents = text:sub(overset_ind + #("\\overset") + 1, overset_end - 1)
             
             local pattern_1 = "}{︸}}"
             local pattern_2 = "}{´©©}}"
             if startswith(text:sub(overset_end), pattern_1) then
                 text = text:sub(1, overset_ind - 1) .. "\\underbrace{" .. contents .. "}}" .. text:sub(overset_end + #pattern_1)
+                braces = brace_table(text)
             elseif startswith(text:sub(overset_end), pattern_2) then
                 text = text:sub(1, overset_ind - 1) .. "\\underbrace{" .. contents .. "}}" .. text:sub(overset_end + #pattern_2)
+                braces = brace_table(text)
             else
                 skip = skip + 1
             end
@@ -210,6 +324,7 @@ local function fix_equations(eqn)
 
         -- weird left arrow
         text = text:gsub("\\overset{⃐}", "\\mathbf")
+        braces = brace_table(text)
 
         -- overleftrightarrow replacement
         skip = 1
@@ -221,10 +336,11 @@ local function fix_equations(eqn)
             end
             local os_ind_after = os_ind + #("\\overset{")
             if text:sub(os_ind_after, os_ind_after + #over_lra - 1) == over_lra then
-                local ending = find_next_closing_bracket(text, os_ind_after + #over_lra)
+                local ending = find_next_closing_bracket(braces, os_ind_after + #over_lra)
                 assert(ending ~= -1)
                 local contents = text:sub(os_ind_after + #over_lra, ending - 1)
                 text = text:sub(1, os_ind - 1) .. "\\overleftrightarrow{" .. contents .. text:sub(ending)
+                braces = brace_table(text)
             else
                 skip = skip + 1
             end
@@ -233,12 +349,6 @@ local function fix_equations(eqn)
         return text
     end
 
-    local function aug_matrix_spacing(__text)
-        local __old = "\\end{matrix}\\mid\\begin{matrix}"
-        local __new = "\\end{matrix}\\;\\middle|\\;\\begin{matrix}"
-        return __text:gsub(__old, __new)
-    end
-
     local function extract_ms_equation_substrings(s_sub)
         -- Convert an equation in MS Word form with no conflicting braces into a list of equations.
         -- ASSUMPTIONS: No spaces, well-formed
@@ -294,30 +404,25 @@ local function fix_equations(eqn)
 
         local str_builder = {}
 
-        local hierarchy = {
-            {"\\iff", "\\Leftrightarrow", "\\Rightarrow", "\\implies", "\\Leftarrow"},
-            {"<", ">", "\\leq", "\\geq", "\\approx"},
-            {"\\subset", "\\subseteq", "\\not\\subset"},
-            {"\\neq"}
-        }
-
         local function add_and_to_symbol(text)
             local target_index = 1
-            local target_precedence = #hierarchy
+            local target_precedence = RELATION_COUNT
             for j = 1, #text do
-                if brace_depth(text, j) == 0 and left_right_depth(text, j) == 0 then
-                    for k, row in ipairs(hierarchy) do
-                        if k > target_precedence then
-                            -- goto continue_row
-                        else
-                            for _, symbol in ipairs(row) do
-                                if text:sub(j, j + #symbol - 1) == symbol then
-                                    target_index = j
-                                    target_precedence = k
-                                end
-                            end
+                local candidates = RELATIONS_BY_BYTE[text:byte(j)]
+                if candidates ~= nil then
+                    -- the most important relation starting at j, if any
+                    local precedence = nil
+                    for _, candidate in ipairs(candidates) do
+                        local symbol, k = candidate[1], candidate[2]
+                        if (precedence == nil or k < precedence) and text:sub(j, j + #symbol - 1) == symbol then
+                            precedence = k
                         end
                     end
+                    if precedence ~= nil and precedence <= target_precedence
+                            and brace_depth(text, j) == 0 and left_right_depth(text, j) == 0 then
+                        target_index = j
+                        target_precedence = precedence
+                    end
                 end
             end
             return text:sub(1, target_index - 1) .. " &" .. text:sub(target_index)
@@ -348,20 +453,8 @@ local function fix_equations(eqn)
     end
 
 
-    eqn = multi_replace(eqn, {
-        {"\n", " "},
-        {"\\{", "\\lbrace"},
-        {"\\}", "\\rbrace"},
-        {"≢", "\\not\\equiv "},
-        {"\\overrightarrow", "\\vec"}
-    })
-
-    eqn = fix_vectors_again(eqn)
+    eqn = multi_replace(eqn, SYMBOL_RULES)
     eqn = fix_accents(eqn)
-    eqn = aug_matrix_spacing(eqn)
-    -- eqn = eqn:gsub("^{'}", " '")
-    eqn = string.gsub(eqn, "–", "-")
-    eqn = string.gsub(eqn, "%^{'}", " '")
     eqn = fix_equation_align_case(eqn)
 
     return eqn .. " "
@@ -372,9 +465,93 @@ end
 -- ]]
 -- print(fix_equations(ab))
 
+-- Fixing an equation may take at most MS_WORD_EQN_MAX_SECONDS seconds (default 5,
+-- 0 for no limit). An equation that takes longer, or that fix_equations fails
+-- on, is left as it is, so one bad equation can't hold up or stop a whole
+-- document. Each one is reported on stderr, and listed once the filter is done.
+-- The clock is checked every GUARD_INSTRUCTIONS Lua instructions.
+local max_seconds = tonumber(os.getenv("MS_WORD_EQN_MAX_SECONDS") or "") or 5
+local GUARD_INSTRUCTIONS = 10000
+local gave_up = {}
+
+local function shorten(text)
+    if #text <= 120 then
+        return text
+    end
+    return text:sub(1, 117) .. "..."
+end
+
+local function fix_equations_guarded(eqn)
+    if max_seconds > 0 then
+        local deadline = os.clock() + max_seconds
+        debug.sethook(function()
+            if os.clock() > deadline then
+                error("took longer than " .. max_seconds .. " s", 0)
+            end
+        end, "", GUARD_INSTRUCTIONS)
+    end
+    local ok, result = pcall(fix_equations, eqn)
+    debug.sethook()
+    if ok then
+        return result
+    end
+    local why = tostring(result)
+    table.insert(gave_up, {eqn, why})
+    io.stderr:write("[word_eqn] left an equation as it is (" .. why .. "): " .. shorten(eqn) .. "\n")
+    return eqn
+end
+
+-- Documents repeat the same inline symbols over and over, so fixed equations
+-- are remembered. The cache keeps two generations of at most
+-- MS_WORD_EQN_CACHE_SIZE equations each: when the current one fills up, it
+-- becomes the old one, so the least recently used equations are dropped.
+-- If MS_WORD_EQN_VERBOSE is set, cache hits and misses go to stderr at the end.
+local cache_size = tonumber(os.getenv("MS_WORD_EQN_CACHE_SIZE") or "") or 4096
+local verbose = os.getenv("MS_WORD_EQN_VERBOSE")
+local cache_current, cache_old = {}, {}
+local cache_count = 0
+local cache_hits, cache_misses = 0, 0
+
+local function cached_fix_equations(eqn)
+    local fixed = cache_current[eqn]
+    if fixed ~= nil then
+        cache_hits = cache_hits + 1
+        return fixed
+    end
+    fixed = cache_old[eqn]
+    if fixed ~= nil then
+        cache_hits = cache_hits + 1
+    else
+        cache_misses = cache_misses + 1
+        fixed = fix_equations_guarded(eqn)
+    end
+    if cache_count >= cache_size then
+        cache_current, cache_old = {}, cache_current
+        cache_count = 0
+    end
+    cache_current[eqn] = fixed
+    cache_count = cache_count + 1
+    return fixed
+end
+
 function Math(elem)
     if elem.text ~= nil then
-        elem.text = fix_equations(elem.text)
+        elem.text = cached_fix_equations(elem.text)
     end
     return elem
-end
\ No newline at end of file
+end
+
+-- runs after every Math element has been fixed
+function Pandoc(doc)
+    if #gave_up > 0 then
+        local lines = {string.format("[word_eqn] %d equations were left as they are:", #gave_up)}
+        for _, entry in ipairs(gave_up) do
+            table.insert(lines, "  " .. entry[2] .. ": " .. shorten(entry[1]))
+        end
+        io.stderr:write(table.concat(lines, "\n") .. "\n")
+    end
+    if verbose then
+        io.stderr:write(string.format("[word_eqn] cache: %d hits, %d misses\n", cache_hits, cache_misses))
+    end
+    return nil
+end